@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Streaming audit export of users' auth configs and linked connections.
+
+For each user in a manifest (see manifest.py), with their master password,
+the auth db and QGIS2.ini under --out-dir/<user>/ are read, and one JSON line
+is written per auth config::
+
+  {"user": "rod", "configid": "0k1a2b3", "type": "PKI_PKCS12",
+   "name": "My PKI PKCS#12 Config", "uri": "https://localhost:8443",
+   "fields": {"bundlePath": "/srv/PKI/rod.p12",
+              "bundlePassphrase": "<redacted>", ...},
+   "connections": [{"kind": "WMS", "name": "My WMS SSL Server",
+                    "url": "https://localhost:8443/geoserver/wms"}, ...]}
+
+The config type is that of QgsAuthManager.configProviderType(). Secrets
+(passwords and passphrases) are redacted, unless --include-secrets is given.
+Connections are those whose `/Qgis/<KIND>/<name>/authid` links them to the
+config, found in the settings' LinkIndex (see authlinks.py), which is reused
+if saved and current, but never written by an audit. A user whose auth db can
+not be read gets one line, with `error`, instead.
+
+Users are read across a pool of worker processes, each booting QGIS once,
+with at most a few users per process read ahead of it, and each user's lines
+are written as they arrive, so memory stays constant however many users there
+are. Lines of different users may interleave in any order; those of one user
+are together, sorted by config ID.
+
+Requires the same environment variables as populate_qgis_creds.py.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/22'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import json
+import multiprocessing
+
+import authlinks
+import backends
+from auth_template import load_configs
+from configcache import ConfigCache
+from manifest import STDIN, ManifestError, iter_manifest, record_error
+from passwords import PasswordError, fill_passwords, source_from_uri
+from populate_qgis_creds import (
+    WINDOW_PER_PROCESS,
+    JobWindow,
+    PopulateError,
+    ProvisionSession
+)
+
+# Content accessors, per config type
+CONFIG_FIELDS = {
+    backends.BASIC: ('username', 'password', 'realm'),
+    backends.PKI_PATHS: ('certId', 'keyId', 'keyPassphrase', 'issuerId',
+                         'issuerSelfSigned'),
+    backends.PKI_PKCS12: ('bundlePath', 'bundlePassphrase', 'issuerPath',
+                          'issuerSelfSigned'),
+}
+
+SECRET_FIELDS = ('password', 'keyPassphrase', 'bundlePassphrase')
+
+REDACTED = '<redacted>'
+
+# Session of a worker process, booted once per process
+_WORKER_SESSION = None
+
+
+def config_record(kind, config, secrets=False):
+    """Audit record of a loaded config, without its connections.
+
+    :param kind: Config type, e.g. backends.PKI_PKCS12
+    :type config: QgsAuthConfigBase
+    :param secrets: Include secrets, rather than REDACTED for those set
+    :type secrets: bool
+    :rtype: dict
+    """
+    fields = {}
+    for field in CONFIG_FIELDS.get(kind, ()):
+        value = getattr(config, field)()
+        if field in SECRET_FIELDS and value and not secrets:
+            value = REDACTED
+        fields[field] = value
+    return {'configid': config.id(), 'type': kind, 'name': config.name(),
+            'uri': config.uri(), 'fields': fields}
+
+
+def linked_connections(settings, links, configid):
+    """Connections linked to a config, with their URL.
+
+    :type settings: QSettings
+    :type links: authlinks.LinkIndex
+    :returns: `kind`, `name` and `url` of each connection
+    :rtype: list of dict
+    """
+    conns = []
+    for key in links.keys(configid, settings):
+        # /Qgis/<KIND>/<name>/authid
+        kind, name = key[len('/Qgis/'):-len(authlinks.AUTHID_SUFFIX)].split(
+            '/', 1)
+        url = settings.value('/Qgis/connections-{0}/{1}/url'.format(
+            kind.lower(), name))
+        conns.append({'kind': kind, 'name': name,
+                      'url': url if url is None else unicode(url)})
+    return conns
+
+
+def audit_user(session, authdbdir, masterpass, secrets=False):
+    """Audit records of every config in one user's auth db.
+
+    :type session: ProvisionSession
+    :returns: Records, sorted by config ID, see config_record(), with
+        `connections`
+    :rtype: list of dict
+    :raises PopulateError: if the db is missing, the master password can not
+        be verified, or a config can not be loaded
+    """
+    if not session.backend.db_exists(authdbdir):
+        raise PopulateError('No auth db in {0}'.format(authdbdir))
+    session.switch_db(authdbdir)
+    try:
+        if not session.authm.setMasterPassword(masterpass, True):
+            raise PopulateError('Failed to verify master password')
+        configs = load_configs(session)
+    finally:
+        session.authm.clearMasterPassword()
+
+    settings = session.settings()
+    links = authlinks.load_index(settings, session.settings_path(),
+                                 save=False)
+    records = []
+    for configid in sorted(configs):
+        kind, config = configs[configid]
+        record = config_record(kind, config, secrets)
+        record['connections'] = linked_connections(settings, links, configid)
+        records.append(record)
+    return records
+
+
+def _worker_init():
+    """Boot QGIS once for the lifetime of a worker process."""
+    global _WORKER_SESSION  # pylint: disable=W0603
+    if _WORKER_SESSION is None:
+        _WORKER_SESSION = ProvisionSession(
+            configcache=ConfigCache()).start()
+
+
+def _audit_user(job):
+    """Audit one user's auth db and settings, in a worker process.
+
+    :param job: (record, outdir, secrets)
+    :returns: Whether the user was read, and their audit lines, each a JSON
+        string, as (ok, lines)
+    :rtype: tuple
+    """
+    record, outdir, secrets = job
+    user = record['user']
+    error = record_error(record, ('user', 'masterpass'))
+    if not error:
+        try:
+            records = audit_user(_WORKER_SESSION, os.path.join(outdir, user),
+                                 record['masterpass'], secrets)
+        except Exception as e:
+            # e.g. a corrupt auth db: fail this user, not the whole export
+            error = str(e) or e.__class__.__name__
+        else:
+            for rec in records:
+                rec['user'] = user
+            return True, [json.dumps(rec, sort_keys=True) for rec in records]
+    return False, [json.dumps({'user': user, 'error': error}, sort_keys=True)]
+
+
+def audit_main(manifest, outdir, out=None, processes=None, secrets=False,
+               source=None):
+    """Write the audit lines of every user in a manifest, as they arrive.
+
+    :param out: File to write lines to (default: stdout)
+    :type out: file
+    :returns: Number of configs written, and users that failed, as
+        (configs, failed)
+    :rtype: tuple
+    """
+    out = out or sys.stdout
+    records = iter_manifest(manifest)
+    if source is not None:
+        records = fill_passwords(records, source)
+
+    processes = processes or multiprocessing.cpu_count()
+    window = JobWindow(processes * WINDOW_PER_PROCESS)
+    configs = failed = 0
+    pool = multiprocessing.Pool(processes, initializer=_worker_init)
+    try:
+        jobs = ((record, outdir, secrets) for record in records)
+        for ok, lines in pool.imap_unordered(_audit_user,
+                                             window.feed(jobs)):
+            window.done()
+            for line in lines:
+                out.write(line + '\n')
+            out.flush()
+            if ok:
+                configs += len(lines)
+            else:
+                failed += 1
+        pool.close()
+    except BaseException:
+        # e.g. ManifestError: otherwise pool.join() would mask it
+        window.close()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return configs, failed
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Export one JSON line per auth config of each user in a '
+                    'manifest, with its linked connections, secrets '
+                    'redacted.'
+    )
+    parser.add_argument(
+        'manifest', metavar='manifest-path',
+        help='CSV or JSON lines manifest of users (user,masterpass), or - '
+             'for stdin'
+    )
+    parser.add_argument(
+        '-o', '--out-dir', dest='outdir', metavar='directory-path',
+        required=True,
+        help='Directory with a subdirectory of auth db and QGIS2.ini per user'
+    )
+    parser.add_argument(
+        '-r', '--results', dest='results', metavar='jsonl-path',
+        default=STDIN,
+        help='File to write audit lines to (default: - for stdout)'
+    )
+    parser.add_argument(
+        '-s', '--masterpass-source', dest='source', metavar='uri',
+        help='Source of master passwords missing in manifest: file:path, '
+             'env:VAR or ldap://host/base-dn'
+    )
+    parser.add_argument(
+        '-j', '--processes', dest='processes', metavar='count', type=int,
+        help='Worker processes (default: number of CPU cores)'
+    )
+    parser.add_argument(
+        '--include-secrets', dest='secrets', action='store_true',
+        help='Include passwords and passphrases, rather than redacting them'
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    try:
+        src = source_from_uri(args.source) if args.source else None
+        outf = (sys.stdout if args.results == STDIN
+                else open(args.results, 'wb'))
+        try:
+            nconfigs, nfailed = audit_main(
+                args.manifest, os.path.realpath(args.outdir), outf,
+                args.processes, args.secrets, src)
+        finally:
+            if outf is not sys.stdout:
+                outf.close()
+    except (ManifestError, PasswordError, IOError) as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    print >> sys.stderr, 'Exported {0} configs; {1} users failed'.format(
+        nconfigs, nfailed)
+    sys.exit(1 if nfailed else 0)
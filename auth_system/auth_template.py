@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Per-user auth databases cloned from one golden template.
+
+The template qgis-auth.db and QGIS2.ini are provisioned once, through QGIS,
+for a placeholder user (@USER@) whose PKI components are in a placeholder
+directory (@PKIDIR@). Anything else set up in them once, e.g. with the QGIS
+GUI, is cloned too: more configs, of any type, and more connections than the
+spec defines. Each worker process loads, and decrypts, the template's configs
+and reads its settings once, with load_template(). Each user's copy is then
+made by:
+
+1. clone_template(): creating the user's auth db, with their own master
+   password, and storing each template config in it, with the placeholders
+   in its name, URI and PKI paths replaced. Each config is encrypted once;
+   nothing is decrypted or re-keyed per user, and nothing is matched or
+   planned against an existing db, as populate_qgis_creds.py --batch does.
+
+2. finalize_clone(): writing the template's settings to the user's
+   QGIS2.ini, with the placeholders replaced, and each /authid linked to the
+   user's copy of its config, as stored configs get new IDs.
+
+3. verify_clone(), optional: loads each config with
+   loadAuthenticationConfig() and checks no placeholders remain and the PKI
+   paths exist.
+
+An existing auth db is never overwritten: its user fails, and is to be
+updated with populate_qgis_creds.py --batch instead.
+
+Users are spread across a pool of worker processes, each booting QGIS once.
+The template is built by one of the workers, so QGIS is never booted in the
+parent process, which the pool is forked from. Requires the same
+environment variables as populate_qgis_creds.py.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/08'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import multiprocessing
+import tempfile
+
+import backends
+import connections
+from manifest import (
+    DEFAULT_PASSPHRASE,
+    ManifestError,
+    read_manifest,
+    record_error
+)
+from populate_qgis_creds import (
+    SETTINGSNAME,
+    PopulateError,
+    ProvisionSession,
+    unlock,
+)
+
+PLACEHOLDER_USER = '@USER@'
+PLACEHOLDER_PKIDIR = '@PKIDIR@'
+
+# Plain text accessors of every config type, whose values may hold
+# placeholders
+TEXT_FIELDS = (('name', 'setName'), ('uri', 'setUri'))
+
+# Path accessors, per config type, whose values may hold placeholders
+PATH_FIELDS = {
+    backends.PKI_PATHS: (('certId', 'setCertId'),
+                         ('keyId', 'setKeyId'),
+                         ('issuerId', 'setIssuerId')),
+    backends.PKI_PKCS12: (('bundlePath', 'setBundlePath'),
+                          ('issuerPath', 'setIssuerPath')),
+}
+
+# Session of a worker process, booted once per process
+_WORKER_SESSION = None
+
+# Templates loaded by a worker process, by template directory
+_WORKER_TEMPLATES = {}
+
+
+def substitute(text, user, pkidir):
+    """Replace the template placeholders in text."""
+    return text.replace(PLACEHOLDER_PKIDIR, pkidir) \
+        .replace(PLACEHOLDER_USER, user)
+
+
+def build_template(session, templatedir, masterpass,
+                   passphrase=DEFAULT_PASSPHRASE):
+    """Provision the template auth db and settings for the placeholder user.
+
+    :type session: ProvisionSession
+    :returns: See ProvisionSession.provision()
+    :rtype: dict
+    """
+    return session.provision(PLACEHOLDER_USER, masterpass, PLACEHOLDER_PKIDIR,
+                             templatedir, passphrase)
+
+
+def load_configs(session):
+    """Fully load, and decrypt, every config in the session's current db.
+
+    Configs are read through the session's config cache, if it has one, so
+    a db loaded again within the cache's TTL is not decrypted again, see
+    configcache.py.
+
+    :type session: ProvisionSession
+    :returns: (config type, config) pairs, by config ID
+    :rtype: dict
+    :raises PopulateError: if a config can not be loaded
+    """
+    authm = session.authm
+    configs = {}
+    for configid in authm.configIds():
+        kind = session.backend.config_kind(authm, configid)
+        config = session.backend.config_class(kind)()
+        if not authm.loadAuthenticationConfig(configid, config, True):
+            raise PopulateError('Failed to load config {0}'.format(configid))
+        configs[configid] = (kind, config)
+    return configs
+
+
+def load_template(session, templatedir, templatepass):
+    """Load, and decrypt, the template's configs, and read its settings.
+
+    :type session: ProvisionSession
+    :returns: Template configs, see load_configs(), and settings, as
+        (key, value) pairs
+    :rtype: tuple
+    :raises PopulateError: if the template can not be unlocked or loaded
+    """
+    session.switch_db(templatedir)
+    authm = session.authm
+    try:
+        if not authm.setMasterPassword(templatepass, True):
+            raise PopulateError('Failed to verify template master password')
+        configs = load_configs(session)
+    finally:
+        authm.clearMasterPassword()
+    settings = session.settings()
+    return configs, [(key, settings.value(key)) for key in settings.allKeys()]
+
+
+def _store_copy(authm, configid, kind, config, user, pkidir):
+    """Store a user's copy of a template config, leaving config as it was.
+
+    :returns: Config ID of the copy
+    :rtype: str
+    :raises PopulateError: if the copy can not be stored
+    """
+    fields = TEXT_FIELDS + PATH_FIELDS.get(kind, ())
+    values = [(setter, getattr(config, getter)()) for getter, setter in fields]
+    try:
+        for setter, value in values:
+            getattr(config, setter)(substitute(value, user, pkidir))
+        config.setId('')
+        if not authm.storeAuthenticationConfig(config)[0]:
+            raise PopulateError('Failed to store copy of config {0}'
+                                .format(configid))
+        return config.id()
+    finally:
+        for setter, value in values:
+            getattr(config, setter)(value)
+        config.setId(configid)
+
+
+def clone_template(session, configs, authdbdir, user, pkidir, masterpass):
+    """Create a user's auth db, with a copy of each template config.
+
+    :type session: ProvisionSession
+    :param configs: Template configs, see load_template()
+    :type configs: dict
+    :returns: Config IDs of the copies, by template config ID
+    :rtype: dict
+    :raises PopulateError: if authdbdir already has an auth db, or a copy
+        can not be stored
+    """
+    if session.backend.db_exists(authdbdir):
+        raise PopulateError('Auth db already exists in {0}, update it with '
+                            'populate_qgis_creds.py --batch'
+                            .format(authdbdir))
+    session.switch_db(authdbdir)
+    authm = session.authm
+    ids = {}
+    try:
+        # Stores the user's master password in the new db, so no re-keying
+        unlock(authm, user, masterpass)
+        for configid, (kind, config) in sorted(configs.iteritems()):
+            ids[configid] = _store_copy(authm, configid, kind, config, user,
+                                        pkidir)
+    finally:
+        authm.clearMasterPassword()
+    return ids
+
+
+def finalize_clone(session, settings, authdbdir, user, pkidir, ids):
+    """Write the template's settings to a clone's QGIS2.ini.
+
+    Placeholders are replaced, and each /authid is linked to the user's copy
+    of its config.
+
+    :type session: ProvisionSession
+    :param settings: Template settings, see load_template()
+    :type settings: list of tuple
+    :param ids: Config IDs of the copies, see clone_template()
+    :type ids: dict
+    :returns: Number of settings keys written
+    :rtype: int
+    """
+    clone = session.backend.settings(os.path.join(authdbdir, SETTINGSNAME))
+    for key, value in settings:
+        if key.endswith('/authid'):
+            value = ids.get(value, value)
+        elif isinstance(value, basestring):
+            value = substitute(value, user, pkidir)
+        clone.setValue(key, value)
+    clone.sync()
+    return len(settings)
+
+
+def verify_clone(session, authdbdir, masterpass):
+    """Check every config of a clone loads, with real, existing PKI paths.
+
+    :type session: ProvisionSession
+    :returns: Problems found, empty if none
+    :rtype: list of str
+    """
+    session.switch_db(authdbdir)
+    authm = session.authm
+    problems = []
+    try:
+        if not authm.setMasterPassword(masterpass, True):
+            return ['Failed to verify master password']
+        try:
+            configs = load_configs(session)
+        except PopulateError as e:
+            return [str(e)]
+        for configid, (kind, config) in configs.iteritems():
+            for getter, _ in PATH_FIELDS.get(kind, ()):
+                value = getattr(config, getter)()
+                if PLACEHOLDER_USER in value or PLACEHOLDER_PKIDIR in value:
+                    problems.append('{0} {1} not rewritten: {2}'.format(
+                        configid, getter, value))
+                elif value and not os.path.exists(value):
+                    problems.append('{0} {1} does not exist: {2}'.format(
+                        configid, getter, value))
+    finally:
+        authm.clearMasterPassword()
+    return problems
+
+
+def _worker_init(specpath):
+    """Boot QGIS once for the lifetime of a worker process."""
+    global _WORKER_SESSION  # pylint: disable=W0603
+    if _WORKER_SESSION is None:
+        _WORKER_SESSION = ProvisionSession(specpath=specpath).start()
+
+
+def _build_template(templatedir, masterpass, passphrase):
+    """Build the template, in a worker process, see build_template()."""
+    return build_template(_WORKER_SESSION, templatedir, masterpass,
+                          passphrase)
+
+
+def _load_template(templatedir, templatepass):
+    """The template, loaded once per worker process, see load_template()."""
+    if templatedir not in _WORKER_TEMPLATES:
+        _WORKER_TEMPLATES[templatedir] = load_template(
+            _WORKER_SESSION, templatedir, templatepass)
+    return _WORKER_TEMPLATES[templatedir]
+
+
+def _clone_user(job):
+    """Clone, finalize and, optionally, verify one user's auth db, in a
+    worker process.
+
+    :param job: (record, templatedir, templatepass, outdir, verify)
+    :returns: `user`, `ok` and `error` or the numbers of `configs` stored
+        and settings keys `written`
+    :rtype: dict
+    """
+    record, templatedir, templatepass, outdir, verify = job
+    user = record['user']
+    result = {'user': user, 'ok': False}
+    error = record_error(record)
+    if error:
+        result['error'] = error
+        return result
+
+    authdbdir = os.path.join(outdir, user)
+    try:
+        configs, settings = _load_template(templatedir, templatepass)
+        ids = clone_template(_WORKER_SESSION, configs, authdbdir, user,
+                             record['pkidir'], record['masterpass'])
+        result['configs'] = len(ids)
+        result['written'] = finalize_clone(_WORKER_SESSION, settings,
+                                           authdbdir, user, record['pkidir'],
+                                           ids)
+        problems = []
+        if verify:
+            problems = verify_clone(_WORKER_SESSION, authdbdir,
+                                    record['masterpass'])
+    except Exception as e:
+        # e.g. a corrupt auth db: fail this user, not the whole batch
+        result['error'] = str(e) or e.__class__.__name__
+        return result
+    if problems:
+        result['error'] = '; '.join(problems)
+        return result
+    result['ok'] = True
+    return result
+
+
+def clone_main(manifest, outdir, templatepass, pkidir='', processes=None,
+               specpath=connections.DEFAULT_SPEC,
+               passphrase=DEFAULT_PASSPHRASE, verify=False):
+    """Build a template, in a worker, then clone it for every user in a
+    manifest.
+
+    All users share the template's PKI bundle passphrase.
+
+    :param verify: Also verify each clone, see verify_clone()
+    :type verify: bool
+
+    :returns: Number of users that failed
+    :rtype: int
+    """
+    # fail early on a bad spec, rather than in every worker
+    connections.compile_spec(connections.load_spec(specpath))
+    records = read_manifest(manifest, pkidir)
+    templatedir = os.path.join(outdir, '.template')
+
+    failed = 0
+    processes = processes or multiprocessing.cpu_count()
+    # Forked before QGIS is booted anywhere; each worker boots its own
+    pool = multiprocessing.Pool(processes, initializer=_worker_init,
+                                initargs=(specpath,))
+    try:
+        pool.apply(_build_template, (templatedir, templatepass, passphrase))
+        print 'Built template in {0}'.format(templatedir)
+        jobs = ((r, templatedir, templatepass, outdir, verify)
+                for r in records)
+        for result in pool.imap_unordered(_clone_user, jobs):
+            if result['ok']:
+                print '  OK    {user}: {configs} configs, {written} ' \
+                    'settings'.format(**result)
+            else:
+                failed += 1
+                print '  FAIL  {user}: {error}'.format(**result)
+        pool.close()
+    except BaseException:
+        # e.g. PopulateError: otherwise pool.join() would mask it
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    print 'Cloned {0} of {1} users'.format(len(records) - failed,
+                                           len(records))
+    return failed
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Build one template qgis-auth.db and QGIS2.ini, then '
+                    'clone it for each user without an auth db in a '
+                    'manifest, replacing the placeholder user and PKI '
+                    'directory.'
+    )
+    parser.add_argument(
+        'manifest', metavar='manifest-path',
+        help='CSV manifest of users (user,masterpass[,pkidir])'
+    )
+    parser.add_argument(
+        '-t', '--template-pass', dest='tpass', metavar='master-password',
+        required=True,
+        help='Master password of the template auth db'
+    )
+    parser.add_argument(
+        '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
+        default='',
+        help='PKI components directory for users without one in manifest'
+    )
+    parser.add_argument(
+        '-k', '--pki-passphrase', dest='pkipass', metavar='passphrase',
+        default=DEFAULT_PASSPHRASE,
+        help='Passphrase of users\' PKI bundles (default: sample data\'s)'
+    )
+    parser.add_argument(
+        '-c', '--connections', dest='specpath', metavar='spec-path',
+        default=connections.DEFAULT_SPEC,
+        help='JSON or YAML spec of OWS connections (default: '
+             'connections.json)'
+    )
+    parser.add_argument(
+        '-o', '--out-dir', dest='outdir', metavar='directory-path',
+        help='Output directory, with a subdirectory per user (default: new '
+             'temporary directory)'
+    )
+    parser.add_argument(
+        '-j', '--processes', dest='processes', metavar='count', type=int,
+        help='Worker processes (default: number of CPU cores)'
+    )
+    parser.add_argument(
+        '--verify', dest='verify', action='store_true',
+        help='Load each clone\'s configs back, and check their PKI paths exist'
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    outd = os.path.realpath(
+        args.outdir or tempfile.mkdtemp(prefix='qgis-auth-'))
+    pkid = os.path.realpath(args.pkidir) if args.pkidir else ''
+    try:
+        failures = clone_main(args.manifest, outd, args.tpass, pkidir=pkid,
+                              processes=args.processes,
+                              specpath=args.specpath,
+                              passphrase=args.pkipass, verify=args.verify)
+    except (PopulateError, ManifestError, IOError,
+            connections.SpecError) as e:
+        print e
+        sys.exit(1)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""Reverse index of auth config IDs to the connections linked to them.
+
+A connection is linked to an auth config by its `/Qgis/<KIND>/<name>/authid`
+settings key. Finding the connections of one config otherwise means reading
+every key of the settings (allKeys()). A LinkIndex maps each config ID to its
+linked keys, so removing, rotating or relinking a config reads and writes only
+its own connections:
+
+- LinkIndex.build() reads every key once
+- the index is saved alongside the settings file (QGIS2.ini.authlinks), with
+  the file's modification time and size, and load_index() reuses it while the
+  file is unchanged, rebuilding it only after the settings were changed
+  elsewhere (e.g. in QGIS)
+- links written or removed through the index (set(), discard(), relink(),
+  unlink()) update it in place, and save() re-stamps it after a sync()
+- keys() re-reads the keys it returns, so a link changed since the index was
+  built is dropped rather than reported
+
+Does not require QGIS.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/19'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import json
+
+from settings_writer import normalize
+
+AUTHID_SUFFIX = '/authid'
+
+# Suffix of the saved index, after the settings file name
+INDEX_SUFFIX = '.authlinks'
+
+
+def _key(key):
+    # QSettings.allKeys() lists keys without their leading '/'
+    return key.lstrip('/')
+
+
+def is_link(key):
+    """Whether a settings key links a connection to an auth config.
+
+    :rtype: bool
+    """
+    key = _key(key)
+    return key.startswith('Qgis/') and key.endswith(AUTHID_SUFFIX)
+
+
+def settings_stamp(path):
+    """Modification time and size of a settings file, or None if missing.
+
+    :rtype: list
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+class LinkIndex(object):
+    """Settings keys linked to each auth config ID."""
+
+    def __init__(self, links=None):
+        """Constructor.
+
+        :param links: Config ID, by linked key without its leading '/'
+        :type links: dict
+        """
+        # key: configid, and configid: set of keys
+        self._config = {}
+        self._keys = {}
+        for key, configid in (links or {}).iteritems():
+            self.set(key, configid)
+
+    @classmethod
+    def build(cls, settings):
+        """Index every link in settings, reading all of its keys once.
+
+        :type settings: QSettings
+        :rtype: LinkIndex
+        """
+        index = cls()
+        for key in settings.allKeys():
+            if is_link(key):
+                configid = normalize(settings.value(key))
+                if configid:
+                    index.set(key, configid)
+        return index
+
+    def __len__(self):
+        return len(self._config)
+
+    def configs(self):
+        """IDs of the configs with linked connections.
+
+        :rtype: list of str
+        """
+        return sorted(self._keys)
+
+    def set(self, key, configid):
+        """Record that key links to configid."""
+        key = _key(key)
+        self.discard(key)
+        self._config[key] = configid
+        self._keys.setdefault(configid, set()).add(key)
+
+    def discard(self, key):
+        """Forget the link of key, if any."""
+        key = _key(key)
+        configid = self._config.pop(key, None)
+        if configid is not None:
+            keys = self._keys[configid]
+            keys.discard(key)
+            if not keys:
+                del self._keys[configid]
+
+    def keys(self, configid, settings=None):
+        """Keys linked to a config.
+
+        :param settings: Settings to re-read the keys from, dropping any no
+            longer linked to configid (default: trust the index)
+        :type settings: QSettings
+        :returns: Keys, with a leading '/'
+        :rtype: list of str
+        """
+        keys = sorted(self._keys.get(configid, ()))
+        if settings is not None:
+            for key in keys:
+                current = normalize(settings.value(key))
+                if current != configid:
+                    if current:
+                        self.set(key, current)
+                    else:
+                        self.discard(key)
+            keys = sorted(self._keys.get(configid, ()))
+        return ['/' + key for key in keys]
+
+    def refresh(self, settings, keys):
+        """Re-read only the given keys, e.g. after writing them elsewhere.
+
+        :type settings: QSettings
+        :type keys: iterable of str
+        """
+        for key in keys:
+            if not is_link(key):
+                continue
+            configid = normalize(settings.value(key))
+            if configid:
+                self.set(key, configid)
+            else:
+                self.discard(key)
+
+    def relink(self, settings, old, new):
+        """Link the connections of config old to config new.
+
+        :returns: Number of keys written; settings are synced once, if any
+        :rtype: int
+        """
+        keys = self.keys(old, settings)
+        for key in keys:
+            settings.setValue(key, new)
+            self.set(key, new)
+        if keys:
+            settings.sync()
+        return len(keys)
+
+    def unlink(self, settings, configid):
+        """Clear the links of connections to a config, e.g. once removed.
+
+        :returns: Number of keys cleared; settings are synced once, if any
+        :rtype: int
+        """
+        keys = self.keys(configid, settings)
+        for key in keys:
+            settings.setValue(key, '')
+            self.discard(key)
+        if keys:
+            settings.sync()
+        return len(keys)
+
+    def save(self, path, stamp):
+        """Write the index, stamped with its settings file's state.
+
+        :param path: Index file, see index_path()
+        :type path: str
+        :param stamp: settings_stamp() of the settings file, as indexed
+        :type stamp: list
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump({'stamp': stamp, 'links': self._config}, f,
+                      sort_keys=True)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, stamp):
+        """Read a saved index, or None if missing, unreadable or stale.
+
+        :param stamp: settings_stamp() of the settings file now
+        :type stamp: list
+        :rtype: LinkIndex
+        """
+        try:
+            with open(path, 'rb') as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(saved, dict) or saved.get('stamp') != stamp:
+            return None
+        return cls(saved.get('links'))
+
+
+def index_path(settingspath):
+    """Path of the saved index of a settings file.
+
+    :rtype: str
+    """
+    return settingspath + INDEX_SUFFIX
+
+
+def load_index(settings, settingspath, save=True):
+    """Index of settings, reused from its saved copy if still current.
+
+    :param settings: Settings, read if the index has to be rebuilt
+    :type settings: QSettings
+    :param settingspath: INI file of settings; if it does not exist, the
+        index is built, and not saved
+    :type settingspath: str
+    :param save: Save a rebuilt index, for later runs
+    :type save: bool
+    :rtype: LinkIndex
+    """
+    stamp = settings_stamp(settingspath)
+    if stamp is not None:
+        index = LinkIndex.load(index_path(settingspath), stamp)
+        if index is not None:
+            return index
+    index = LinkIndex.build(settings)
+    if save and stamp is not None:
+        index.save(index_path(settingspath), stamp)
+    return index
+
+
+def save_index(index, settingspath):
+    """Save an index, after its settings file was synced.
+
+    :type index: LinkIndex
+    :type settingspath: str
+    """
+    stamp = settings_stamp(settingspath)
+    if stamp is not None:
+        index.save(index_path(settingspath), stamp)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Idempotent storage of authentication configs.
+
+QgsAuthManager.storeAuthenticationConfig() assigns a new config ID on every
+call, so re-running a provisioning script leaves duplicate encrypted rows
+behind, and the connections linked to the previous ID orphaned. store_config()
+first looks for an existing config of the same name and provider type:
+
+- same content fingerprint: the existing config (and its ID) is reused
+- different content: the existing config is updated in place, keeping its ID
+- none found: a new config is stored
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/03'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import hashlib
+
+# Results of store_config()
+STORED = 'stored'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+
+# Accessors of config content; those a config class lacks are skipped
+FINGERPRINT_FIELDS = (
+    'name',
+    'uri',
+    # QgsAuthConfigBasic
+    'username',
+    'password',
+    'realm',
+    # QgsAuthConfigPkiPaths
+    'certId',
+    'keyId',
+    'keyPassphrase',
+    'issuerId',
+    # QgsAuthConfigPkiPkcs12
+    'bundlePath',
+    'bundlePassphrase',
+    'issuerPath',
+    # QgsAuthConfigPkiPaths and QgsAuthConfigPkiPkcs12
+    'issuerSelfSigned',
+)
+
+
+class StoreError(Exception):
+    """Raised when an auth config can not be stored or updated."""
+    pass
+
+
+def fingerprint(config):
+    """Content fingerprint of an auth config, excluding its ID.
+
+    Secrets are included, so a changed passphrase also updates the config, but
+    only their digest is kept.
+
+    :type config: QgsAuthConfigBase
+    :rtype: str
+    """
+    digest = hashlib.sha1(type(config).__name__)
+    for field in FINGERPRINT_FIELDS:
+        getter = getattr(config, field, None)
+        if getter is None:
+            continue
+        value = getter()
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        digest.update(u'\0{0}={1}'.format(field, value).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def find_configs(authm, config):
+    """IDs of stored configs with the same name and provider type as config.
+
+    :type authm: QgsAuthManager
+    :type config: QgsAuthConfigBase
+    :rtype: list of str
+    """
+    return sorted(
+        configid for configid, base in authm.availableConfigs().iteritems()
+        if base.name() == config.name()
+        and authm.configProviderType(configid) == config.type())
+
+
+def load_config(authm, configid, cls):
+    """Fully load, and decrypt, a stored config as an instance of cls.
+
+    :returns: Loaded config, or None if it could not be loaded
+    :rtype: QgsAuthConfigBase
+    """
+    config = cls()
+    if not authm.loadAuthenticationConfig(configid, config, True):
+        return None
+    return config
+
+
+def match_config(authm, config):
+    """How config would be stored, without changing the auth db.
+
+    A stored config of the same name and provider type is reused when its
+    content is unchanged, or else updated in place; any others of that name
+    and type are duplicates, e.g. left by earlier runs.
+
+    :param authm: Auth manager with the master password set
+    :type authm: QgsAuthManager
+    :type config: QgsAuthConfigBase
+    :returns: STORED, UPDATED or UNCHANGED, the ID of the config to update or
+        reuse (None when storing anew), and the IDs of duplicates, as
+        (action, configid, duplicates)
+    :rtype: tuple
+    """
+    candidates = find_configs(authm, config)
+    if not candidates:
+        return STORED, None, []
+    configfp = fingerprint(config)
+    for configid in candidates:
+        existing = load_config(authm, configid, type(config))
+        if existing is not None and fingerprint(existing) == configfp:
+            break
+    else:
+        return UPDATED, candidates[0], candidates[1:]
+    return UNCHANGED, configid, [c for c in candidates if c != configid]
+
+
+def commit_config(authm, config, action, configid=None):
+    """Store or update config, as decided by match_config().
+
+    On return, config.id() is the ID of the stored config.
+
+    :returns: Config ID
+    :rtype: str
+    :raises StoreError: if the config can not be stored or updated
+    """
+    if action == STORED:
+        res = authm.storeAuthenticationConfig(config)
+        if not res[0]:
+            raise StoreError(
+                'Failed to store {0} config'.format(config.name()))
+        return config.id()
+
+    config.setId(configid)
+    if action == UPDATED and not authm.updateAuthenticationConfig(config):
+        raise StoreError('Failed to update {0} config'.format(config.name()))
+    return configid
+
+
+def store_config(authm, config):
+    """Store config, reusing or updating an existing one of the same name.
+
+    On return, config.id() is the ID of the stored config.
+
+    :param authm: Auth manager with the master password set
+    :type authm: QgsAuthManager
+    :param config: Config to store; its ID is ignored
+    :type config: QgsAuthConfigBase
+    :returns: Config ID and one of STORED, UPDATED or UNCHANGED
+    :rtype: tuple
+    :raises StoreError: if the config can not be stored or updated
+    """
+    action, configid, _ = match_config(authm, config)
+    return commit_config(authm, config, action, configid), action
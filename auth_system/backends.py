@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+"""Auth and settings backends that provisioning runs against.
+
+A backend boots its application, hands out the auth manager and settings
+objects, and the config classes for each auth config type:
+
+- QgisBackend: QGIS itself, i.e. QgsAuthManager.instance() and QSettings.
+  QGIS is only imported when the backend is used.
+
+- MemoryBackend: an in-memory fake, for tests and benchmarks on hosts without
+  QGIS or a display. Its auth manager keeps each auth db directory in its own
+  in-memory SQLite database, with the storeAuthenticationConfig(),
+  updateAuthenticationConfig(), loadAuthenticationConfig(), configIds(),
+  availableConfigs() and master password semantics of QgsAuthManager. Config
+  contents are not encrypted.
+
+Both have the same methods, so code that takes a backend works with either::
+
+    backend = MemoryBackend().start()
+    authm = backend.auth_manager()
+    authm.init('/tmp/rod')
+    authm.setMasterPassword('pass', True)
+    config = backend.config_class(PKI_PKCS12)()
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/10'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import hashlib
+import json
+import random
+import sqlite3
+import string
+
+import timing
+
+AUTHDBNAME = 'qgis-auth.db'
+SETTINGSNAME = 'QGIS2.ini'
+
+# Auth config types, as named by QgsAuthType.typeToString()
+BASIC = 'Basic'
+PKI_PATHS = 'PKI-Paths'
+PKI_PKCS12 = 'PKI-PKCS#12'
+
+_SCHEMA = (
+    'CREATE TABLE auth_pass (salt TEXT NOT NULL, hash TEXT NOT NULL)',
+    'CREATE TABLE auth_configs (id TEXT UNIQUE NOT NULL, name TEXT NOT NULL, '
+    'uri TEXT, type TEXT NOT NULL, version INTEGER NOT NULL, '
+    'config TEXT NOT NULL)',
+)
+
+# Seconds to wait for another connection's lock on an auth db
+DB_TIMEOUT = 30.0
+
+
+def _tables(conn, schema):
+    """Names of the tables in an attached SQLite database."""
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM {0}.sqlite_master WHERE type = 'table' "
+        "AND name NOT LIKE 'sqlite_%'".format(schema))]
+
+
+def copy_db(src, dest):
+    """Copy the SQLite database src to a new database at dest.
+
+    The copy is made through SQLite, in one read transaction, rather than
+    of the file, so it is consistent while another connection, e.g. that of
+    QgsAuthManager, has src open. (Python 2's sqlite3 has no backup API.)
+
+    :raises IOError: if src can not be read, or dest written
+    """
+    if os.path.exists(dest):
+        os.remove(dest)
+    conn = sqlite3.connect(dest, timeout=DB_TIMEOUT, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS src', (src,))
+        conn.execute('BEGIN')
+        schema = conn.execute(
+            "SELECT type, name, sql FROM src.sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY type = 'index'").fetchall()
+        for kind, name, sql in schema:
+            conn.execute(sql)
+            if kind == 'table':
+                conn.execute('INSERT INTO main."{0}" SELECT * FROM '
+                             'src."{0}"'.format(name))
+        conn.execute('COMMIT')
+    except sqlite3.Error as e:
+        raise IOError('Failed to copy {0} to {1}: {2}'.format(src, dest, e))
+    finally:
+        conn.close()
+
+
+def restore_copy(dbpath, backup):
+    """Replace the rows of the SQLite database dbpath with those of backup.
+
+    The rows are replaced in one write transaction, rather than the file,
+    so other connections that have dbpath open see an ordinary commit, and
+    an interrupted restore is rolled back.
+
+    :param backup: Copy of dbpath made by copy_db()
+    :type backup: str
+    :raises IOError: if backup can not be read, or dbpath written
+    """
+    conn = sqlite3.connect(dbpath, timeout=DB_TIMEOUT, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS backup', (backup,))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for name in _tables(conn, 'backup'):
+                conn.execute('DELETE FROM main."{0}"'.format(name))
+                conn.execute('INSERT INTO main."{0}" SELECT * FROM '
+                             'backup."{0}"'.format(name))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+    except sqlite3.Error as e:
+        raise IOError('Failed to restore {0} from {1}: {2}'.format(
+            dbpath, backup, e))
+    finally:
+        conn.close()
+
+
+def init_qgis():
+    """Instantiate and initialize QGIS for the current process.
+
+    :rtype: QgsApplication
+    """
+    from qgis.core import QgsApplication
+    from PyQt4.QtCore import QCoreApplication
+
+    with timing.phase('qgis_app'):
+        qgsapp = QgsApplication(sys.argv, True)
+
+    # These are for referencing the correct QSettings for the QGIS app
+    QCoreApplication.setOrganizationName('QGIS')
+    QCoreApplication.setOrganizationDomain('qgis.org')
+    QCoreApplication.setApplicationName('QGIS2')
+
+    # Initialize QGIS
+    with timing.phase('init_qgis'):
+        qgsapp.initQgis()
+    return qgsapp
+
+
+class QgisBackend(object):
+    """QGIS auth manager and QSettings."""
+
+    def __init__(self, qgsapp=None):
+        """Constructor.
+
+        :param qgsapp: Already initialized QGIS app to reuse, if any
+        :type qgsapp: QgsApplication
+        """
+        self.qgsapp = qgsapp
+
+    def start(self):
+        """Boot QGIS, unless already done."""
+        if self.qgsapp is None:
+            self.qgsapp = init_qgis()
+        return self
+
+    def auth_manager(self):
+        """:rtype: QgsAuthManager"""
+        from qgis.core import QgsAuthManager
+        # noinspection PyArgumentList
+        return QgsAuthManager.instance()
+
+    def settings(self, path=None):
+        """INI settings at path, or the application's settings if None.
+
+        :rtype: QSettings
+        """
+        from PyQt4.QtCore import QSettings
+        if path is None:
+            return QSettings()
+        return QSettings(path, QSettings.IniFormat)
+
+    def config_class(self, kind):
+        """Config class of an auth config type, e.g. PKI_PKCS12."""
+        from qgis.core import (
+            QgsAuthConfigBasic,
+            QgsAuthConfigPkiPaths,
+            QgsAuthConfigPkiPkcs12
+        )
+        return {BASIC: QgsAuthConfigBasic,
+                PKI_PATHS: QgsAuthConfigPkiPaths,
+                PKI_PKCS12: QgsAuthConfigPkiPkcs12}[kind]
+
+    def db_exists(self, authdbdir):
+        """Whether a directory has an auth db, without creating one."""
+        return os.path.exists(os.path.join(authdbdir, AUTHDBNAME))
+
+    def backup_db(self, authdbdir, backup):
+        """Copy the auth db of a directory to the path backup, see
+        copy_db()."""
+        copy_db(os.path.join(authdbdir, AUTHDBNAME), backup)
+
+    def restore_db(self, authdbdir, backup):
+        """Replace the auth db of a directory with a copy made by backup_db(),
+        see restore_copy().
+
+        The auth manager should be re-initialized on the directory before
+        it is used again.
+        """
+        restore_copy(os.path.join(authdbdir, AUTHDBNAME), backup)
+
+    def config_kind(self, authm, configid):
+        """Auth config type of a stored config, e.g. PKI_PKCS12."""
+        from qgis.core import QgsAuthType
+        return QgsAuthType.typeToString(authm.configProviderType(configid))
+
+    def close(self):
+        """Shut down QGIS."""
+        if self.qgsapp is not None:
+            from qgis.core import QgsApplication
+            # noinspection PyArgumentList
+            QgsApplication.exitQgis()
+            self.qgsapp = None
+
+
+class MemoryConfig(object):
+    """In-memory auth config; see the subclasses for each type.
+
+    Has the id, name and uri accessors of QgsAuthConfigBase, and a getter and
+    setter for each of FIELDS, e.g. bundlePath() and setBundlePath().
+    """
+
+    KIND = None
+    FIELDS = ()
+    _DEFAULTS = {'issuerSelfSigned': False}
+
+    def __init__(self):
+        self.__dict__['_base'] = {'id': '', 'name': '', 'uri': ''}
+        self.__dict__['_values'] = {}
+
+    def id(self):
+        return self._base['id']
+
+    def setId(self, configid):
+        self._base['id'] = configid
+
+    def name(self):
+        return self._base['name']
+
+    def setName(self, name):
+        self._base['name'] = name
+
+    def uri(self):
+        return self._base['uri']
+
+    def setUri(self, uri):
+        self._base['uri'] = uri
+
+    def type(self):
+        return self.KIND
+
+    def version(self):
+        return 1
+
+    def values(self):
+        """Values of FIELDS, by field name.
+
+        :rtype: dict
+        """
+        return dict((f, getattr(self, f)()) for f in self.FIELDS)
+
+    def setValues(self, values):
+        self._values.update((f, values[f]) for f in self.FIELDS if f in values)
+
+    def __getattr__(self, attr):
+        if attr in self.FIELDS:
+            return lambda: self._values.get(attr, self._DEFAULTS.get(attr, ''))
+        field = attr[3:4].lower() + attr[4:]
+        if attr.startswith('set') and field in self.FIELDS:
+            return lambda value: self._values.__setitem__(field, value)
+        raise AttributeError(attr)
+
+
+class MemoryConfigBasic(MemoryConfig):
+    KIND = BASIC
+    FIELDS = ('username', 'password', 'realm')
+
+
+class MemoryConfigPkiPaths(MemoryConfig):
+    KIND = PKI_PATHS
+    FIELDS = ('certId', 'keyId', 'keyPassphrase', 'issuerId',
+              'issuerSelfSigned')
+
+
+class MemoryConfigPkiPkcs12(MemoryConfig):
+    KIND = PKI_PKCS12
+    FIELDS = ('bundlePath', 'bundlePassphrase', 'issuerPath',
+              'issuerSelfSigned')
+
+MEMORY_CONFIGS = dict((cls.KIND, cls) for cls in (
+    MemoryConfigBasic, MemoryConfigPkiPaths, MemoryConfigPkiPkcs12))
+
+
+class MemoryAuthManager(object):
+    """In-memory stand-in for QgsAuthManager.
+
+    Each auth db directory passed to init() is an in-memory SQLite database,
+    kept until the manager is discarded, so re-initializing a directory sees
+    its earlier master password and configs.
+    """
+
+    def __init__(self):
+        self._dbs = {}
+        self._dbdir = None
+        self._masterpass = None
+
+    @property
+    def _conn(self):
+        return self._dbs[self._dbdir]
+
+    def init(self, authdbdir=None):
+        """Switch to the auth db of a directory, creating it if needed."""
+        self._dbdir = authdbdir or ''
+        if self._dbdir not in self._dbs:
+            conn = sqlite3.connect(':memory:')
+            for sql in _SCHEMA:
+                conn.execute(sql)
+            self._dbs[self._dbdir] = conn
+        self._masterpass = None
+        return True
+
+    def has_db(self, authdbdir):
+        """Whether init() has created the auth db of a directory."""
+        return (authdbdir or '') in self._dbs
+
+    def dump_db(self, authdbdir):
+        """SQL dump of the auth db of a directory.
+
+        :rtype: list of str
+        """
+        return list(self._dbs[authdbdir or ''].iterdump())
+
+    def load_db(self, authdbdir, dump):
+        """Replace the auth db of a directory with a dump_db() dump."""
+        conn = sqlite3.connect(':memory:')
+        conn.executescript('\n'.join(dump))
+        self._dbs[authdbdir or ''] = conn
+
+    def authenticationDbPath(self):
+        return os.path.join(self._dbdir, AUTHDBNAME)
+
+    @staticmethod
+    def _hash(salt, password):
+        return hashlib.sha256(salt + password.encode('utf-8')).hexdigest()
+
+    def setMasterPassword(self, password, verify=False):
+        """Set, and store if none is stored yet, the master password.
+
+        There is no one to prompt, so a non-string password (e.g. True, to
+        ask the user) fails.
+
+        :returns: Whether the password was set and matches the stored hash
+        :rtype: bool
+        """
+        if not isinstance(password, basestring) or not password:
+            return False
+        row = self._conn.execute('SELECT salt, hash FROM auth_pass').fetchone()
+        if row is None:
+            salt = os.urandom(8).encode('hex')
+            with self._conn:
+                self._conn.execute('INSERT INTO auth_pass VALUES (?, ?)',
+                                   (salt, self._hash(salt, password)))
+        elif self._hash(str(row[0]), password) != row[1]:
+            return False
+        self._masterpass = password
+        return True
+
+    def masterPasswordIsSet(self):
+        return self._masterpass is not None
+
+    def clearMasterPassword(self):
+        self._masterpass = None
+
+    def resetMasterPassword(self, newpass, *args):
+        """Replace the master password; the current one must be set."""
+        if not self.masterPasswordIsSet() or not newpass:
+            return False
+        salt = os.urandom(8).encode('hex')
+        with self._conn:
+            self._conn.execute('UPDATE auth_pass SET salt = ?, hash = ?',
+                               (salt, self._hash(salt, newpass)))
+        self._masterpass = newpass
+        return True
+
+    def _unique_id(self):
+        chars = string.ascii_lowercase + string.digits
+        while True:
+            configid = ''.join(random.choice(chars) for _ in range(7))
+            if self.configProviderType(configid) is None:
+                return configid
+
+    def storeAuthenticationConfig(self, config):
+        """Store config as a new config, setting its ID.
+
+        :returns: Whether stored, and the config ID, as (ok, configid)
+        :rtype: tuple
+        """
+        if not self.masterPasswordIsSet() or not config.name():
+            return False, ''
+        config.setId(self._unique_id())
+        with self._conn:
+            self._conn.execute(
+                'INSERT INTO auth_configs VALUES (?, ?, ?, ?, ?, ?)',
+                (config.id(), config.name(), config.uri(), config.type(),
+                 config.version(), json.dumps(config.values())))
+        return True, config.id()
+
+    def updateAuthenticationConfig(self, config):
+        if not self.masterPasswordIsSet():
+            return False
+        with self._conn:
+            cur = self._conn.execute(
+                'UPDATE auth_configs SET name = ?, uri = ?, version = ?, '
+                'config = ? WHERE id = ? AND type = ?',
+                (config.name(), config.uri(), config.version(),
+                 json.dumps(config.values()), config.id(), config.type()))
+        return cur.rowcount == 1
+
+    def loadAuthenticationConfig(self, configid, config, full=False):
+        """Load a stored config into config, of the same type.
+
+        :param full: Also load type-specific contents; needs master password
+        :rtype: bool
+        """
+        if full and not self.masterPasswordIsSet():
+            return False
+        row = self._conn.execute(
+            'SELECT name, uri, type, config FROM auth_configs WHERE id = ?',
+            (configid,)).fetchone()
+        if row is None or row[2] != config.type():
+            return False
+        config.setId(configid)
+        config.setName(row[0])
+        config.setUri(row[1])
+        if full:
+            config.setValues(json.loads(row[3]))
+        return True
+
+    def removeAuthenticationConfig(self, configid):
+        with self._conn:
+            cur = self._conn.execute('DELETE FROM auth_configs WHERE id = ?',
+                                     (configid,))
+        return cur.rowcount == 1
+
+    def configIds(self):
+        return [r[0] for r in
+                self._conn.execute('SELECT id FROM auth_configs ORDER BY id')]
+
+    def configProviderType(self, configid):
+        row = self._conn.execute(
+            'SELECT type FROM auth_configs WHERE id = ?',
+            (configid,)).fetchone()
+        return row[0] if row else None
+
+    def availableConfigs(self):
+        """Stored configs, without type-specific contents, by config ID.
+
+        :rtype: dict
+        """
+        configs = {}
+        for configid, name, uri, kind in self._conn.execute(
+                'SELECT id, name, uri, type FROM auth_configs'):
+            config = MEMORY_CONFIGS[kind]()
+            config.setId(configid)
+            config.setName(name)
+            config.setUri(uri)
+            configs[configid] = config
+        return configs
+
+
+class MemorySettings(object):
+    """In-memory stand-in for an INI-backed QSettings.
+
+    Like an INI file, values read back as strings once synced.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.syncs = 0
+
+    @staticmethod
+    def _key(key):
+        # QSettings treats keys with and without a leading '/' as the same
+        return '/' + key.lstrip('/')
+
+    def allKeys(self):
+        return sorted(key.lstrip('/') for key in self.values)
+
+    def contains(self, key):
+        return self._key(key) in self.values
+
+    def value(self, key, default=None):
+        return self.values.get(self._key(key), default)
+
+    def setValue(self, key, value):
+        self.values[self._key(key)] = value
+
+    def remove(self, key):
+        self.values.pop(self._key(key), None)
+
+    def sync(self):
+        self.syncs += 1
+        for key, value in self.values.items():
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            self.values[key] = unicode(value)
+
+
+class MemoryBackend(object):
+    """In-memory auth manager and settings, needing no QGIS."""
+
+    def __init__(self):
+        self.authm = MemoryAuthManager()
+        self._settings = {}
+        # Auth db dumps, by backup path
+        self.backups = {}
+
+    def start(self):
+        return self
+
+    def auth_manager(self):
+        """:rtype: MemoryAuthManager"""
+        return self.authm
+
+    def settings(self, path=None):
+        """Settings of a path, kept for the lifetime of the backend.
+
+        :rtype: MemorySettings
+        """
+        return self._settings.setdefault(path, MemorySettings())
+
+    def config_class(self, kind):
+        return MEMORY_CONFIGS[kind]
+
+    def db_exists(self, authdbdir):
+        return self.authm.has_db(authdbdir)
+
+    def backup_db(self, authdbdir, backup):
+        self.backups[backup] = self.authm.dump_db(authdbdir)
+
+    def restore_db(self, authdbdir, backup):
+        self.authm.load_db(authdbdir, self.backups[backup])
+
+    def config_kind(self, authm, configid):
+        return authm.configProviderType(configid)
+
+    def close(self):
+        pass
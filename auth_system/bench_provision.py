@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark suite of end-to-end provisioning throughput.
+
+Times the same work as populate_qgis_creds.main() for a matrix of scenarios:
+each auth config type (Basic, PKI-Paths and PKI-PKCS#12), each number of
+users (default: 1 and 100; pass `--users 1 100 10000` for the full suite) and
+each number of connections per user (default: 1, 10, 100 and 500).
+
+Every scenario runs in a fresh process, which boots QGIS once, so that its
+peak RSS is its own, then provisions each user's qgis-auth.db and QGIS2.ini in
+a temporary directory, using the sample PKI data. Each user's directory is
+removed once provisioned, so 10,000 users do not fill the disk. Reported, as
+JSON, per scenario:
+
+- wall: total seconds, including QGIS startup
+- per_user: seconds per user, excluding QGIS startup
+- peak_rss_kb: peak resident set size of the scenario's process
+- phases: total seconds in each phase (startup, switch_db, masterpass,
+  store_config and settings)
+
+With `--baseline`, per-user times are compared to those of a previous run's
+results file, and scenarios slower by more than `--tolerance` are listed as
+regressions, making the exit status non-zero. Use `--save` to write results.
+
+With `--memory`, the in-memory backend of backends.py stands in for QGIS, to
+time the provisioning logic alone.
+
+Runs offline. Linux only, for peak RSS. Requires the same environment
+variables as populate_qgis_creds.py.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/09'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import json
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import time
+
+import authstore
+import backends
+import connections
+import populate_qgis_creds as pqc
+from manifest import DEFAULT_PASSPHRASE
+from pki_index import user_credentials
+
+PKIDATA = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       'pki_sample_data')
+
+BASIC = 'basic'
+PKI_PATHS = 'pki-paths'
+PKI_PKCS12 = 'pki-pkcs12'
+CONFIG_KINDS = (BASIC, PKI_PATHS, PKI_PKCS12)
+
+# Auth config types of CONFIG_KINDS, see backends.py
+CONFIG_TYPES = {
+    BASIC: backends.BASIC,
+    PKI_PATHS: backends.PKI_PATHS,
+    PKI_PKCS12: backends.PKI_PKCS12,
+}
+
+PHASES = ('startup', 'switch_db', 'masterpass', 'store_config', 'settings')
+
+
+def make_config(backend, kind, creds, passphrase=DEFAULT_PASSPHRASE):
+    """Auth config of a kind, for the PKI components in creds.
+
+    :param backend: Backend whose config classes to use, see backends.py
+    :param kind: BASIC, PKI_PATHS or PKI_PKCS12
+    :param creds: Paths of components, see pki_index.user_credentials()
+    :type creds: dict
+    """
+    config = backend.config_class(CONFIG_TYPES[kind])()
+    if kind == BASIC:
+        config.setUsername('username')
+        config.setPassword(passphrase)
+        config.setRealm('Realm')
+    elif kind == PKI_PATHS:
+        config.setCertId(creds['cert'])
+        config.setKeyId(creds['key'])
+        config.setKeyPassphrase('')
+        config.setIssuerId(creds['issuer'])
+        config.setIssuerSelfSigned(creds['issuer_self_signed'])
+    else:
+        config.setBundlePath(creds['bundle'])
+        config.setBundlePassphrase(passphrase)
+        config.setIssuerPath(creds['issuer'])
+        config.setIssuerSelfSigned(creds['issuer_self_signed'])
+    config.setName('Bench {0} Config'.format(kind))
+    config.setUri('https://localhost:8443')
+    return config
+
+
+def make_spec(count):
+    """Connection spec of count connections, cycling through WMS, WCS, WFS.
+
+    :rtype: dict
+    """
+    spec = connections.load_spec()
+    kinds = ('WMS', 'WCS', 'WFS')
+    spec['connections'] = [
+        {'kind': kinds[i % 3],
+         'name': 'Bench {0} {1:03d}'.format(kinds[i % 3], i),
+         'url': 'https://localhost:8443/geoserver/{0}'.format(
+             kinds[i % 3].lower())}
+        for i in range(count)]
+    return spec
+
+
+def scenario_id(kind, users, conns):
+    return '{0}-u{1}-c{2}'.format(kind, users, conns)
+
+
+def _run_scenario(job):
+    """Run one scenario, in a fresh process.
+
+    :param job: (kind, users, conns, user, masterpass, pkidir, outdir,
+        memory), where memory selects the in-memory backend over QGIS
+    :rtype: dict
+    """
+    kind, users, conns, user, masterpass, pkidir, outdir, memory = job
+    phases = dict.fromkeys(PHASES, 0.0)
+    creds = user_credentials(user, pkidir)
+    writes = connections.compile_spec(make_spec(conns))
+
+    start = time.time()
+    session = pqc.ProvisionSession(
+        backend=backends.MemoryBackend() if memory else None).start()
+    phases['startup'] = time.time() - start
+    try:
+        authm = session.authm
+        for i in range(users):
+            authdbdir = os.path.join(outdir, '{0:05d}'.format(i))
+            t = time.time()
+            session.switch_db(authdbdir)
+            phases['switch_db'] += time.time() - t
+
+            t = time.time()
+            if not authm.setMasterPassword(masterpass, True):
+                raise pqc.PopulateError('Failed to set master password')
+            phases['masterpass'] += time.time() - t
+
+            t = time.time()
+            config = make_config(session.backend, kind, creds)
+            configid, _ = authstore.store_config(authm, config)
+            phases['store_config'] += time.time() - t
+
+            t = time.time()
+            connections.apply_writes(session.settings(), writes, configid)
+            phases['settings'] += time.time() - t
+
+            authm.clearMasterPassword()
+            shutil.rmtree(authdbdir, ignore_errors=True)
+    finally:
+        session.close()
+    wall = time.time() - start
+
+    return {
+        'id': scenario_id(kind, users, conns),
+        'kind': kind,
+        'users': users,
+        'connections': conns,
+        'wall': wall,
+        'per_user': (wall - phases['startup']) / users,
+        # kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'phases': phases,
+    }
+
+
+def run_suite(kinds, users, conns, user, masterpass, pkidir, memory=False):
+    """Run every scenario of the matrix, each in its own process.
+
+    :rtype: list of dict
+    """
+    outdir = tempfile.mkdtemp(prefix='qgis-auth-bench-')
+    results = []
+    try:
+        for kind in kinds:
+            for nusers in users:
+                for nconns in conns:
+                    # maxtasksperchild=1 gives each scenario a fresh process
+                    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+                    try:
+                        result = pool.apply(_run_scenario, ((
+                            kind, nusers, nconns, user, masterpass, pkidir,
+                            os.path.join(outdir, scenario_id(
+                                kind, nusers, nconns)), memory),))
+                        pool.close()
+                    finally:
+                        pool.join()
+                    print >> sys.stderr, '{0}: {1:.4f} s/user'.format(
+                        result['id'], result['per_user'])
+                    results.append(result)
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Scenarios whose per-user time regressed against a baseline.
+
+    :param baseline: Results of a previous run, as saved with --save
+    :type baseline: dict
+    :param tolerance: Allowed slowdown, as a fraction of the baseline
+    :type tolerance: float
+    :returns: `id`, `baseline`, `per_user` and `change` of regressions
+    :rtype: list of dict
+    """
+    before = dict((r['id'], r['per_user'])
+                  for r in baseline.get('scenarios') or [])
+    regressions = []
+    for r in results:
+        if not before.get(r['id']):
+            continue
+        change = r['per_user'] / before[r['id']] - 1
+        if change > tolerance:
+            regressions.append({'id': r['id'], 'baseline': before[r['id']],
+                                'per_user': r['per_user'], 'change': change})
+    return regressions
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark provisioning throughput across config types, '
+                    'numbers of users and connections per user.'
+    )
+    parser.add_argument(
+        '-n', '--users', dest='users', metavar='count', type=int, nargs='+',
+        default=[1, 100],
+        help='Numbers of users to provision per scenario (default: 1 100)'
+    )
+    parser.add_argument(
+        '-c', '--connections', dest='conns', metavar='count', type=int,
+        nargs='+', default=[1, 10, 100, 500],
+        help='Numbers of connections per user (default: 1 10 100 500)'
+    )
+    parser.add_argument(
+        '-t', '--types', dest='kinds', metavar='type', nargs='+',
+        choices=CONFIG_KINDS, default=list(CONFIG_KINDS),
+        help='Auth config types: {0} (default: all)'.format(
+            ', '.join(CONFIG_KINDS))
+    )
+    parser.add_argument(
+        '-u', '--user', dest='user', metavar='username', default='rod',
+        help='User whose PKI components are in the PKI directory'
+    )
+    parser.add_argument(
+        '-m', '--masterpass', dest='mpass', metavar='master-password',
+        default='password',
+        help='Master password for each generated auth db'
+    )
+    parser.add_argument(
+        '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
+        default=PKIDATA,
+        help='PKI components directory path (default: sample data)'
+    )
+    parser.add_argument(
+        '--memory', dest='memory', action='store_true',
+        help='Use the in-memory backend instead of QGIS, to time the '
+             'provisioning logic alone'
+    )
+    parser.add_argument(
+        '-b', '--baseline', dest='baseline', metavar='results-path',
+        help='Results of a previous run to compare per-user times to'
+    )
+    parser.add_argument(
+        '--tolerance', dest='tolerance', metavar='fraction', type=float,
+        default=0.2,
+        help='Allowed per-user slowdown against the baseline (default: 0.2)'
+    )
+    parser.add_argument(
+        '-s', '--save', dest='save', metavar='results-path',
+        help='Write results to file, for use as a later baseline'
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    if min(args.users + args.conns) < 1:
+        print 'Numbers of users and connections must be at least 1.'
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            baseline = json.load(f)
+
+    res = {'scenarios': run_suite(args.kinds, args.users, args.conns,
+                                  args.user, args.mpass,
+                                  os.path.realpath(args.pkidir),
+                                  args.memory)}
+    if baseline is not None:
+        res['regressions'] = compare(res['scenarios'], baseline,
+                                     args.tolerance)
+
+    if args.save:
+        with open(args.save, 'wb') as f:
+            json.dump(res, f, indent=2, sort_keys=True)
+    print json.dumps(res, indent=2, sort_keys=True)
+    sys.exit(1 if res.get('regressions') else 0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare per-user provisioning time of cold and warm QGIS startup.
+
+Cold path: every user gets a fresh process, which boots QGIS, initializes the
+auth system, provisions the user's qgis-auth.db and QGIS2.ini, then exits; this
+is what running populate_qgis_creds.py once per user costs.
+
+Warm path: one ProvisionSession boots QGIS once, then switches the auth manager
+between each user's database directory.
+
+Results are printed as JSON. Requires the same environment variables as
+populate_qgis_creds.py.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/01'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+import populate_qgis_creds as pqc
+
+PKIDATA = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       'pki_sample_data')
+
+
+def _cold_provision(job):
+    """Boot QGIS, provision one user and shut down; run in a fresh process."""
+    user, masterpass, pkidir, authdbdir = job
+    start = time.time()
+    with pqc.ProvisionSession() as session:
+        session.provision(user, masterpass, pkidir, authdbdir)
+    return time.time() - start
+
+
+def bench_cold(user, masterpass, pkidir, outdir, count):
+    """Provision count dbs, each in a new process with its own QGIS boot."""
+    start = time.time()
+    # maxtasksperchild=1 retires the worker after each user, so every user
+    # pays the full process and QGIS startup
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        jobs = [(user, masterpass, pkidir,
+                 os.path.join(outdir, 'cold', '{0:05d}'.format(i)))
+                for i in range(count)]
+        pool.map(_cold_provision, jobs, chunksize=1)
+        pool.close()
+    finally:
+        pool.join()
+    total = time.time() - start
+    return {'users': count, 'total': total, 'per_user': total / count}
+
+
+def bench_warm(user, masterpass, pkidir, outdir, count):
+    """Provision count dbs with one session, booted once."""
+    start = time.time()
+    session = pqc.ProvisionSession().start()
+    startup = time.time() - start
+    try:
+        for i in range(count):
+            authdbdir = os.path.join(outdir, 'warm', '{0:05d}'.format(i))
+            session.provision(user, masterpass, pkidir, authdbdir)
+    finally:
+        session.close()
+    total = time.time() - start
+    return {'users': count, 'total': total, 'startup': startup,
+            'per_user': total / count,
+            'per_user_excl_startup': (total - startup) / count}
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark cold vs. warm (session) provisioning per user.'
+    )
+    parser.add_argument(
+        '-n', '--users', dest='count', metavar='count', type=int, default=20,
+        help='Number of per-user auth dbs to generate for each path'
+    )
+    parser.add_argument(
+        '-u', '--user', dest='user', metavar='username', default='rod',
+        help='User whose {user}.p12 is in the PKI directory'
+    )
+    parser.add_argument(
+        '-m', '--masterpass', dest='mpass', metavar='master-password',
+        default='password',
+        help='Master password for each generated auth db'
+    )
+    parser.add_argument(
+        '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
+        default=PKIDATA,
+        help='PKI components directory path (default: sample data)'
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    if args.count < 1:
+        print 'Number of users must be at least 1.'
+        sys.exit(1)
+
+    outd = tempfile.mkdtemp(prefix='qgis-auth-bench-')
+    try:
+        # cold first, so this process has not booted QGIS before forking
+        cold = bench_cold(args.user, args.mpass, os.path.realpath(args.pkidir),
+                          outd, args.count)
+        warm = bench_warm(args.user, args.mpass, os.path.realpath(args.pkidir),
+                          outd, args.count)
+    finally:
+        shutil.rmtree(outd, ignore_errors=True)
+
+    print json.dumps({'cold': cold, 'warm': warm,
+                      'speedup': cold['per_user'] / warm['per_user']},
+                     indent=2, sort_keys=True)
+    sys.exit(0)
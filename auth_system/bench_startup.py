@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare startup time of the QGIS-free paths of populate_qgis_creds.py.
+
+Each command is run in a fresh interpreter, a number of times, and its wall
+time is reported (min and median seconds, as JSON):
+
+- import: importing populate_qgis_creds, which no longer loads QGIS
+- help: `populate_qgis_creds.py --help`
+- check: `populate_qgis_creds.py --check`, validating a user of the sample data
+- qgis_import: importing qgis.core and PyQt4, the cost every run paid at
+  import before QGIS was loaded lazily
+- qgis_boot: also instantiating and initializing QGIS, as a provisioning run
+  does
+
+Commands that fail, e.g. the QGIS ones where QGIS is not installed, are
+reported with their error instead.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/13'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import json
+import subprocess
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+PKIDATA = os.path.join(SCRIPT_DIR, 'pki_sample_data')
+SCRIPT = os.path.join(SCRIPT_DIR, 'populate_qgis_creds.py')
+
+
+def commands(user, pkidir):
+    """Commands to time, by name.
+
+    :rtype: list of tuple
+    """
+    python = sys.executable
+    return [
+        ('import', [python, '-c', 'import populate_qgis_creds']),
+        ('help', [python, SCRIPT, '--help']),
+        ('check', [python, SCRIPT, '--check', '--allow-expired', '-u', user,
+                   '-m', 'password', '-d', pkidir]),
+        ('qgis_import', [python, '-c',
+                         'import qgis.core, PyQt4.QtCore, PyQt4.QtGui']),
+        ('qgis_boot', [python, '-c',
+                       'import backends; backends.init_qgis()']),
+    ]
+
+
+def time_command(args, repeat):
+    """Wall times of repeat runs of a command.
+
+    :returns: `min` and `median` seconds, or `error` if a run failed
+    :rtype: dict
+    """
+    times = []
+    with open(os.devnull, 'wb') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            proc = subprocess.Popen(args, cwd=SCRIPT_DIR, stdout=devnull,
+                                    stderr=subprocess.PIPE)
+            _, err = proc.communicate()
+            if proc.returncode != 0:
+                lines = err.strip().splitlines()
+                return {'error': lines[-1] if lines else
+                        'exit code {0}'.format(proc.returncode)}
+            times.append(time.time() - start)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2]}
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Compare startup time of QGIS-free and QGIS paths.'
+    )
+    parser.add_argument(
+        '-r', '--repeat', dest='repeat', metavar='count', type=int,
+        default=5,
+        help='Runs of each command (default: 5)'
+    )
+    parser.add_argument(
+        '-u', '--user', dest='user', metavar='username', default='rod',
+        help='User whose PKI components to check'
+    )
+    parser.add_argument(
+        '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
+        default=PKIDATA,
+        help='PKI components directory path (default: sample data)'
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    if args.repeat < 1:
+        print 'Number of runs must be at least 1.'
+        sys.exit(1)
+
+    res = {}
+    for name, cmd in commands(args.user, os.path.realpath(args.pkidir)):
+        res[name] = time_command(cmd, args.repeat)
+    print json.dumps(res, indent=2, sort_keys=True)
+    sys.exit(0)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Read cache of fully loaded, decrypted auth configs.
+
+QgsAuthManager.loadAuthenticationConfig(configid, config, True) decrypts the
+config on every call. A CachingAuthManager wraps an auth manager, and serves
+full loads from a ConfigCache, keyed by auth db path and config ID:
+
+- the cache holds at most maxsize configs, evicting the least recently used
+- a cached config is reloaded once it is older than ttl seconds, so changes
+  made by other processes (e.g. QGIS) are seen within ttl
+- storing, updating or removing a config through the wrapper invalidates it,
+  and resetting the master password invalidates the whole auth db
+- a config is only served while the master password is set, as for an
+  uncached full load
+
+The cache keeps its own copy of each config, and copies it into the config
+passed to loadAuthenticationConfig(), so callers may change what they load.
+Decrypted secrets (e.g. passphrases) stay in memory for up to ttl seconds;
+clear() forgets them.
+
+Does not require QGIS.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/21'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import time
+from collections import OrderedDict
+
+from authstore import FINGERPRINT_FIELDS
+
+# Configs kept
+MAXSIZE = 1024
+
+# Seconds a config is served from the cache
+TTL = 300
+
+# Accessors copied between configs; those a config class lacks are skipped
+COPY_FIELDS = ('id',) + FINGERPRINT_FIELDS
+
+
+def copy_config(source, target):
+    """Copy the ID and content of one config into another, of the same type.
+
+    :type source: QgsAuthConfigBase
+    :type target: QgsAuthConfigBase
+    :returns: target
+    """
+    for field in COPY_FIELDS:
+        getter = getattr(source, field, None)
+        if getter is not None:
+            setter = 'set' + field[0].upper() + field[1:]
+            getattr(target, setter)(getter())
+    return target
+
+
+class ConfigCache(object):
+    """Bounded LRU of loaded configs, by (auth db path, config ID)."""
+
+    def __init__(self, maxsize=MAXSIZE, ttl=TTL, clock=time.time):
+        """Constructor.
+
+        :param maxsize: Most configs kept
+        :type maxsize: int
+        :param ttl: Seconds a config is kept after it is put
+        :type ttl: float
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        # (dbpath, configid): (expiry time, config), least recent first
+        self._entries = OrderedDict()
+        # dbpath: set of configid
+        self._bydb = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        del self._entries[key]
+        configids = self._bydb[key[0]]
+        configids.discard(key[1])
+        if not configids:
+            del self._bydb[key[0]]
+
+    def get(self, dbpath, configid):
+        """Cached copy of a config, or None if not cached or expired.
+
+        The config is not copied; use copy_config() before changing it.
+
+        :rtype: QgsAuthConfigBase
+        """
+        key = (dbpath, configid)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= self._clock():
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        # Most recently used last
+        del self._entries[key]
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, dbpath, configid, config):
+        """Cache a copy of a loaded config, evicting the least recently used.
+
+        :type config: QgsAuthConfigBase
+        """
+        key = (dbpath, configid)
+        if key in self._entries:
+            self._drop(key)
+        while self._entries and len(self._entries) >= self.maxsize:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+        self._entries[key] = (self._clock() + self.ttl,
+                              copy_config(config, type(config)()))
+        self._bydb.setdefault(dbpath, set()).add(configid)
+
+    def invalidate(self, dbpath, configid=None):
+        """Forget a cached config, or, if configid is None, a whole auth db."""
+        configids = [configid] if configid is not None else list(
+            self._bydb.get(dbpath, ()))
+        for cid in configids:
+            if (dbpath, cid) in self._entries:
+                self._drop((dbpath, cid))
+
+    def clear(self):
+        self._entries.clear()
+        self._bydb.clear()
+
+    def stats(self):
+        """Counts of `hits`, `misses`, `evictions` and configs kept (`size`).
+
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._entries)}
+
+
+class CachingAuthManager(object):
+    """Auth manager whose full config loads are read through a ConfigCache.
+
+    Every other method is the wrapped auth manager's.
+    """
+
+    def __init__(self, authm, cache=None):
+        """Constructor.
+
+        :param authm: Auth manager to wrap
+        :type authm: QgsAuthManager
+        :param cache: Cache to read through (default: a new one)
+        :type cache: ConfigCache
+        """
+        self.authm = authm
+        self.cache = cache if cache is not None else ConfigCache()
+
+    def __getattr__(self, attr):
+        return getattr(self.authm, attr)
+
+    def _dbpath(self):
+        return self.authm.authenticationDbPath()
+
+    def loadAuthenticationConfig(self, configid, config, full=False):
+        if not full or not self.authm.masterPasswordIsSet():
+            return self.authm.loadAuthenticationConfig(configid, config, full)
+        dbpath = self._dbpath()
+        cached = self.cache.get(dbpath, configid)
+        if cached is not None and type(cached) is type(config):
+            copy_config(cached, config)
+            return True
+        if not self.authm.loadAuthenticationConfig(configid, config, True):
+            return False
+        self.cache.put(dbpath, configid, config)
+        return True
+
+    def storeAuthenticationConfig(self, config):
+        res = self.authm.storeAuthenticationConfig(config)
+        self.cache.invalidate(self._dbpath(), config.id())
+        return res
+
+    def updateAuthenticationConfig(self, config):
+        self.cache.invalidate(self._dbpath(), config.id())
+        return self.authm.updateAuthenticationConfig(config)
+
+    def removeAuthenticationConfig(self, configid):
+        self.cache.invalidate(self._dbpath(), configid)
+        return self.authm.removeAuthenticationConfig(configid)
+
+    def resetMasterPassword(self, *args):
+        # Every config is re-encrypted
+        self.cache.invalidate(self._dbpath())
+        return self.authm.resetMasterPassword(*args)
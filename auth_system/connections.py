@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Declarative OWS connection spec, compiled to flat lists of settings writes.
+
+A spec is a JSON (or, if PyYAML is installed, YAML) document of per-kind
+default settings and a list of connections::
+
+  {
+    "defaults": {
+      "WMS": {"dpiMode": 7, "referer": ""},
+      "WFS": {"referer": ""}
+    },
+    "connections": [
+      {"kind": "WMS", "name": "My WMS SSL Server",
+       "url": "https://localhost:8443/geoserver/wms"},
+      {"kind": "WMS", "name": "Other WMS", "url": "https://other/wms",
+       "dpiMode": 4}
+    ]
+  }
+
+Any connection member other than `kind`, `name` and `url` overrides the
+kind's default of the same name. Compiling the spec once yields (key, value)
+pairs, in which the auth config ID is left as the AUTHID placeholder, so the
+same compiled list can be applied for every user's config.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/01'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import json
+
+from settings_writer import SettingsWriter
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DEFAULT_SPEC = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'connections.json')
+
+# Placeholder value of compiled /authid keys, replaced by the auth config ID
+AUTHID = object()
+
+_RESERVED = ('kind', 'name', 'url')
+
+
+class SpecError(Exception):
+    """Raised when a connection spec can not be read or is malformed."""
+    pass
+
+
+def load_spec(path=DEFAULT_SPEC):
+    """Read a connection spec from a JSON or YAML file.
+
+    :param path: Path to spec; .yaml or .yml files require PyYAML
+    :type path: str
+    :rtype: dict
+    """
+    try:
+        with open(path, 'rb') as f:
+            if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+                if yaml is None:
+                    raise SpecError(
+                        'PyYAML is required to read spec: {0}'.format(path))
+                spec = yaml.safe_load(f)
+            else:
+                spec = json.load(f)
+    except (IOError, ValueError) as e:
+        raise SpecError('Could not read spec {0}: {1}'.format(path, e))
+    if not isinstance(spec, dict):
+        raise SpecError('Spec is not a mapping: {0}'.format(path))
+    return spec
+
+
+def compile_spec(spec):
+    """Flatten a spec to the ordered settings writes for all connections.
+
+    :param spec: Connection spec, as returned by load_spec()
+    :type spec: dict
+    :returns: (settings key, value) pairs, with AUTHID as /authid values
+    :rtype: list of tuple
+    """
+    defaults = spec.get('defaults') or {}
+    writes = []
+    for i, conn in enumerate(spec.get('connections') or []):
+        missing = [k for k in _RESERVED if not conn.get(k)]
+        if missing:
+            raise SpecError('Connection {0} is missing: {1}'
+                            .format(i, ', '.join(missing)))
+        connkind = conn['kind'].upper()
+        connname = conn['name']
+        credskey = '/Qgis/{0}/{1}'.format(connkind, connname)
+        connkey = '/Qgis/connections-{0}/{1}'.format(connkind.lower(),
+                                                     connname)
+
+        writes.append((credskey + '/authid', AUTHID))  # link to auth config
+        writes.append((credskey + '/username', ''))  # deprecated
+        writes.append((credskey + '/password', ''))  # deprecated
+        writes.append((connkey + '/url', conn['url']))
+
+        options = dict(defaults.get(connkind) or {})
+        options.update((k, v) for k, v in conn.items() if k not in _RESERVED)
+        for name in sorted(options):
+            writes.append((connkey + '/' + name, options[name]))
+    return writes
+
+
+def connection_names(spec):
+    """Names of the connections defined in a spec, in order.
+
+    :rtype: list of str
+    """
+    return [conn.get('name', '') for conn in spec.get('connections') or []]
+
+
+def apply_writes(settings, writes, configid):
+    """Write compiled settings, linking connections to an auth config.
+
+    Only keys whose current value differs are written, then settings are
+    synced once; see settings_writer.SettingsWriter.
+
+    :param settings: Application, or per-user INI, settings object
+    :type settings: QSettings
+    :param writes: Compiled writes, as returned by compile_spec()
+    :type writes: list of tuple
+    :param configid: ID of auth config to link connections to
+    :type configid: str
+    :returns: Number of keys written and skipped, as (written, skipped)
+    :rtype: tuple
+    """
+    writer = SettingsWriter(settings)
+    for key, value in writes:
+        writer.stage(key, configid if value is AUTHID else value)
+    return writer.commit()
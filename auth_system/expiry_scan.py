@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Certificate expiry scanner of a fleet of auth dbs and PKI directories.
+
+Reports the certificates that expire within --days days, soonest first, from:
+
+- the auth dbs of users in a manifest (see manifest.py), under
+  --out-dir/<user>/qgis-auth.db: each user's configs are loaded, with their
+  master password, and the certificates they reference are scanned; the
+  bundle of a PKI-PKCS#12 config (decrypted with its stored passphrase), the
+  certificate of a PKI-Paths config, and the issuer of either. The auth dbs are
+  spread across a pool of worker processes, each booting QGIS once.
+- every certificate and PKCS#12 bundle in --pki-dir directories, which does
+  not need QGIS; bundles are decrypted with the --passphrase candidates
+
+Each file referenced, however many configs share it (e.g. a CA's issuer
+file), is parsed at most once per scan, across a pool of worker processes.
+Results are cached by content hash (SHA-256), in --cache, so a later scan
+re-parses only files whose content changed; files whose size and mtime did
+not change are not even re-read.
+
+Exits with 1 if any certificate expires within --days, or can not be read.
+
+Requires the same environment variables as populate_qgis_creds.py, if a
+manifest is given; see pkiutils.py for the `openssl` requirement.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/20'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import hashlib
+import json
+import multiprocessing
+import sqlite3
+import time
+
+import backends
+import pkiutils
+from auth_template import load_configs
+from configcache import ConfigCache
+from manifest import ManifestError, iter_manifest, record_error
+from passwords import PasswordError, fill_passwords, source_from_uri
+from pki_index import parse_file
+from populate_qgis_creds import ProvisionSession
+
+CACHENAME = '.expiry-cache.db'
+
+# Days ahead to report expiring certificates for
+DAYS = 30
+
+# Certificate paths, per config type: (path getter, role, passphrase getter)
+CERT_FIELDS = {
+    backends.PKI_PATHS: (('certId', 'cert', None),
+                         ('issuerId', 'issuer', None)),
+    backends.PKI_PKCS12: (('bundlePath', 'bundle', 'bundlePassphrase'),
+                          ('issuerPath', 'issuer', None)),
+}
+
+_INFO_COLUMNS = ('subject', 'issuer', 'serial', 'not_after', 'error')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+    'size INTEGER NOT NULL, mtime REAL NOT NULL, digest TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS certs (key TEXT PRIMARY KEY, subject TEXT, '
+    'issuer TEXT, serial TEXT, not_after INTEGER, error TEXT)',
+)
+
+# Session of a worker process, booted once per process
+_WORKER_SESSION = None
+
+
+class ScanError(Exception):
+    """Raised when a scan can not be started."""
+    pass
+
+
+class ExpiryCache(object):
+    """Parsed certificates, by content hash, in an SQLite file.
+
+    Only the scanning process reads and writes it, not its workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        for sql in _SCHEMA:
+            self.conn.execute(sql)
+        self.hashed = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def digest(self, path):
+        """SHA-256 of a file's content, re-read only if its stat changed.
+
+        :rtype: str
+        :raises OSError, IOError: if the file can not be read
+        """
+        st = os.stat(path)
+        row = self.conn.execute(
+            'SELECT size, mtime, digest FROM files WHERE path = ?',
+            (path,)).fetchone()
+        if row is not None and (row[0], row[1]) == (st.st_size, st.st_mtime):
+            return row[2]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                sha.update(chunk)
+        self.hashed += 1
+        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                          (path, st.st_size, st.st_mtime, sha.hexdigest()))
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Parsed certificate of a cache key, see cache_key(), or None.
+
+        :rtype: dict
+        """
+        row = self.conn.execute(
+            'SELECT {0} FROM certs WHERE key = ?'.format(
+                ', '.join(_INFO_COLUMNS)), (key,)).fetchone()
+        return dict(zip(_INFO_COLUMNS, row)) if row is not None else None
+
+    def put(self, key, info):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO certs VALUES (?, ?, ?, ?, ?, ?)',
+            (key,) + tuple(info.get(c) for c in _INFO_COLUMNS))
+
+
+def cache_key(digest, kind, passphrases):
+    """Cache key of a file's content, as parsed as kind with passphrases.
+
+    A bundle's passphrases are part of the key, so a bundle that could not be
+    decrypted is parsed again with others.
+
+    :rtype: str
+    """
+    sha = hashlib.sha256('\0'.join([digest, kind] + list(passphrases)))
+    return sha.hexdigest()
+
+
+def config_refs(configs):
+    """Certificate files referenced by loaded auth configs.
+
+    :param configs: (config type, config) pairs, by config ID, see
+        auth_template.load_configs()
+    :type configs: dict
+    :returns: `configid`, `name`, `role`, `path`, `kind` and `passphrases`
+        of each file
+    :rtype: list of dict
+    """
+    refs = []
+    for configid in sorted(configs):
+        kind, config = configs[configid]
+        for getter, role, passgetter in CERT_FIELDS.get(kind, ()):
+            path = getattr(config, getter)()
+            if not path:
+                continue
+            refs.append({
+                'configid': configid, 'name': config.name(), 'role': role,
+                'path': path,
+                'kind': pkiutils.PKCS12 if role == 'bundle' else
+                pkiutils.CERT,
+                'passphrases': [getattr(config, passgetter)()]
+                if passgetter else [],
+            })
+    return refs
+
+
+def pki_refs(pkidir, passphrases=()):
+    """Certificate files, and PKCS#12 bundles, in a PKI directory.
+
+    Hidden files and directories (e.g. the PKI index) are skipped.
+
+    :rtype: list of dict
+    """
+    refs = []
+    for root, dirs, files in os.walk(pkidir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.startswith('.'):
+                continue
+            try:
+                kind = pkiutils.file_kind(path)
+            except IOError:
+                continue
+            if kind not in (pkiutils.CERT, pkiutils.PKCS12):
+                continue
+            refs.append({'path': path, 'kind': kind, 'role': kind,
+                         'passphrases': list(passphrases)
+                         if kind == pkiutils.PKCS12 else []})
+    return refs
+
+
+def _worker_init():
+    """Boot QGIS once for the lifetime of a worker process."""
+    global _WORKER_SESSION  # pylint: disable=W0603
+    if _WORKER_SESSION is None:
+        _WORKER_SESSION = ProvisionSession(
+            configcache=ConfigCache()).start()
+
+
+def _scan_db(job):
+    """Certificate files referenced by one user's auth db, in a worker.
+
+    :param job: (record, outdir)
+    :returns: `user`, `ok` and `error` or `refs`, see config_refs()
+    :rtype: dict
+    """
+    record, outdir = job
+    user = record['user']
+    result = {'user': user, 'ok': False}
+    error = record_error(record, ('user', 'masterpass'))
+    if error:
+        result['error'] = error
+        return result
+    authdbdir = os.path.join(outdir, user)
+    session = _WORKER_SESSION
+    if not session.backend.db_exists(authdbdir):
+        result['error'] = 'No auth db in {0}'.format(authdbdir)
+        return result
+    try:
+        session.switch_db(authdbdir)
+        if not session.authm.setMasterPassword(record['masterpass'], True):
+            result['error'] = 'Failed to verify master password'
+            return result
+        refs = config_refs(load_configs(session))
+    except Exception as e:
+        # e.g. a corrupt auth db: fail this user, not the whole scan
+        result['error'] = str(e) or e.__class__.__name__
+        return result
+    finally:
+        session.authm.clearMasterPassword()
+    for ref in refs:
+        ref['user'] = user
+    result['refs'] = refs
+    result['ok'] = True
+    return result
+
+
+def _parse(job):
+    """Parse one certificate file, in a worker process.
+
+    :param job: (cache key, path, kind, passphrases)
+    :returns: (cache key, info), see parse_file()
+    :rtype: tuple
+    """
+    key, path, kind, passphrases = job
+    return key, parse_file(path, kind, passphrases)
+
+
+def scan(refs, cache, processes=None, days=DAYS, now=None):
+    """Parse the files of refs, cached, and report those expiring soon.
+
+    :param refs: Referenced certificate files, see config_refs() and
+        pki_refs()
+    :type refs: list of dict
+    :type cache: ExpiryCache
+    :param days: Report certificates expiring within days from now
+    :type days: int
+    :param now: Seconds since epoch (default: current time)
+    :type now: float
+    :returns: Refs that expire within days, or could not be read, soonest
+        first, each with `subject`, `not_after`, `days_left` and `error`;
+        and the number of files `parsed`, `cached` and `hashed`
+    :rtype: tuple
+    """
+    now = time.time() if now is None else now
+    # Cache key, or error reading the file, by (path, kind, passphrases)
+    keys = {}
+    errors = {}
+    infos = {}
+    jobs = []
+    cached = 0
+    for ref in refs:
+        target = (ref['path'], ref['kind'], tuple(ref['passphrases']))
+        if target in keys or target in errors:
+            continue
+        try:
+            key = cache_key(cache.digest(ref['path']), ref['kind'],
+                            ref['passphrases'])
+        except (IOError, OSError) as e:
+            errors[target] = 'Could not read {0}: {1}'.format(
+                ref['path'], e.strerror or e)
+            continue
+        keys[target] = key
+        if key in infos:
+            continue
+        infos[key] = cache.get(key)
+        if infos[key] is None:
+            jobs.append((key,) + target)
+        else:
+            cached += 1
+
+    if jobs:
+        pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+        try:
+            for key, info in pool.imap_unordered(_parse, jobs):
+                cache.put(key, info)
+                infos[key] = info
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        cache.conn.commit()
+
+    cutoff = now + days * 86400
+    report = []
+    for ref in refs:
+        target = (ref['path'], ref['kind'], tuple(ref['passphrases']))
+        info = infos[keys[target]] if target in keys else {}
+        row = dict((k, v) for k, v in ref.iteritems() if k != 'passphrases')
+        row['subject'] = info.get('subject')
+        row['not_after'] = info.get('not_after')
+        row['error'] = errors.get(target) or info.get('error')
+        if row['not_after'] is None and not row['error']:
+            row['error'] = 'No certificate read'
+        if row['error'] or row['not_after'] <= cutoff:
+            row['days_left'] = (None if row['not_after'] is None else
+                                int((row['not_after'] - now) // 86400))
+            report.append(row)
+    report.sort(key=lambda r: (r['not_after'] is not None, r['not_after'],
+                               r.get('user'), r['path']))
+    return report, {'parsed': len(jobs), 'cached': cached,
+                    'hashed': cache.hashed}
+
+
+def db_refs(records, outdir, processes=None):
+    """Certificate files referenced by users' auth dbs, across a pool.
+
+    :param records: Records, see manifest.make_record()
+    :type records: iterable of dict
+    :returns: Refs, see config_refs(), and per-user results that failed
+    :rtype: tuple
+    """
+    refs = []
+    failed = []
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(),
+                                initializer=_worker_init)
+    try:
+        jobs = ((record, outdir) for record in records)
+        for result in pool.imap_unordered(_scan_db, jobs):
+            if result['ok']:
+                refs.extend(result['refs'])
+            else:
+                failed.append(result)
+        pool.close()
+    except BaseException:
+        # e.g. ManifestError: otherwise pool.join() would mask it
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return refs, failed
+
+
+def format_row(row):
+    """One report row, as text.
+
+    :rtype: str
+    """
+    where = row['path']
+    if row.get('user'):
+        where = '{0} {1} {2}: {3}'.format(row['user'], row['configid'],
+                                          row['role'], row['path'])
+    if row['error']:
+        return '  FAIL     {0}: {1}'.format(where, row['error'])
+    return '  {0:<7}  {1} {2} ({3})'.format(
+        row['days_left'], time.strftime('%Y-%m-%d',
+                                        time.gmtime(row['not_after'])),
+        where, row['subject'])
+
+
+def scan_main(manifest=None, outdir=None, pkidirs=(), days=DAYS,
+              passphrases=(), cachepath=None, processes=None, source=None,
+              jsonl=False, now=None):
+    """Scan auth dbs and PKI directories, and print the expiring certs.
+
+    :returns: Number of certificates expiring, or unreadable
+    :rtype: int
+    """
+    if manifest and not outdir:
+        raise ScanError('A manifest needs --out-dir, of its users\' auth dbs')
+    if not manifest and not pkidirs:
+        raise ScanError('Nothing to scan: give a manifest or --pki-dir')
+    refs = []
+    failed = []
+    if manifest:
+        records = iter_manifest(manifest)
+        if source is not None:
+            records = fill_passwords(records, source)
+        refs, failed = db_refs(records, outdir, processes)
+    for pkidir in pkidirs:
+        refs.extend(pki_refs(pkidir, passphrases))
+
+    cache = ExpiryCache(cachepath or
+                        os.path.join(outdir or pkidirs[0], CACHENAME))
+    try:
+        report, stats = scan(refs, cache, processes, days, now)
+    finally:
+        cache.close()
+
+    for result in failed:
+        if jsonl:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print '  FAIL     {user}: {error}'.format(**result)
+    for row in report:
+        print json.dumps(row, sort_keys=True) if jsonl else format_row(row)
+    if not jsonl:
+        print 'Expiring within {0} days, or unreadable: {1} of {2} ' \
+              'certificates ({3} files parsed, {4} cached)'.format(
+                  days, len(report), len(refs), stats['parsed'],
+                  stats['cached'])
+    return len(report) + len(failed)
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Report certificates expiring soon, referenced by users\' '
+                    'auth dbs or in PKI directories, re-parsing only files '
+                    'that changed since the last scan.'
+    )
+    parser.add_argument(
+        '-m', '--manifest', dest='manifest', metavar='manifest-path',
+        help='CSV or JSON lines manifest of users (user,masterpass) whose '
+             'auth dbs to scan, or - for stdin'
+    )
+    parser.add_argument(
+        '-o', '--out-dir', dest='outdir', metavar='directory-path',
+        help='Directory with a subdirectory of auth db per user'
+    )
+    parser.add_argument(
+        '-d', '--pki-dir', dest='pkidirs', metavar='directory-path',
+        action='append', default=[],
+        help='PKI directory to scan (repeatable)'
+    )
+    parser.add_argument(
+        '-n', '--days', dest='days', metavar='days', type=int, default=DAYS,
+        help='Report certificates expiring within days (default: {0})'
+             .format(DAYS)
+    )
+    parser.add_argument(
+        '-p', '--passphrase', dest='passphrases', metavar='passphrase',
+        action='append', default=[],
+        help='Candidate passphrase for bundles in PKI directories '
+             '(repeatable)'
+    )
+    parser.add_argument(
+        '-c', '--cache', dest='cachepath', metavar='cache-path',
+        help='Cache of parsed certificates (default: {0} in output, or '
+             'first PKI, directory)'.format(CACHENAME)
+    )
+    parser.add_argument(
+        '-s', '--masterpass-source', dest='source', metavar='uri',
+        help='Source of master passwords missing in manifest: file:path, '
+             'env:VAR or ldap://host/base-dn'
+    )
+    parser.add_argument(
+        '-j', '--processes', dest='processes', metavar='count', type=int,
+        help='Worker processes (default: number of CPU cores)'
+    )
+    parser.add_argument(
+        '--json', dest='jsonl', action='store_true',
+        help='Print each expiring certificate as a JSON line'
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    try:
+        src = source_from_uri(args.source) if args.source else None
+        expiring = scan_main(
+            args.manifest,
+            os.path.realpath(args.outdir) if args.outdir else None,
+            [os.path.realpath(d) for d in args.pkidirs], args.days,
+            args.passphrases, args.cachepath, args.processes, src,
+            args.jsonl)
+    except (ScanError, ManifestError, PasswordError, sqlite3.Error) as e:
+        print e
+        sys.exit(1)
+    sys.exit(1 if expiring else 0)
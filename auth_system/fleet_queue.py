@@ -0,0 +1,742 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fleet provisioning across several nodes, through a shared directory queue.
+
+A coordinator splits a manifest of users (see manifest.py) into batches, in a
+queue directory on a filesystem shared by every node (e.g. NFS), and workers
+on any number of nodes claim and provision them, each user exactly as
+populate_qgis_creds.py --batch does::
+
+  queuedir/
+    queue.json               run options: out dir, PKI dir, spec, ...
+    pending/batch-000001     users of a batch not yet claimed, as JSON lines
+    claimed/<worker>/...     batches being provisioned, by worker
+    done/batch-000001        per-user results of a batch, as JSON lines
+    workers/<worker>.json    heartbeat of each worker
+    enqueued                 number of batches, once all were queued
+    finished                 written once every batch is done; workers exit
+
+- a worker claims a batch by renaming it from pending/ into its own claimed/
+  directory; a rename is atomic, so of workers racing for one batch, only one
+  succeeds, and the others move on to the next
+- each worker rewrites its heartbeat every --heartbeat seconds, from a
+  thread, while it provisions
+- a finished batch's results are written to done/ (to a temporary file, then
+  renamed), before its claim is removed
+- the coordinator reports results as batches are done, and returns the
+  claimed batches of a worker whose heartbeat is older than --timeout
+  seconds (a dead node, or killed process) to pending/, for others to claim
+
+A batch is thus provisioned at least once; a worker that was presumed dead,
+but finishes, provisions its users again, which the planner makes a no-op,
+and a Scheduler keeps two jobs off one auth db at once (see scheduler.py).
+Heartbeats are compared with the coordinator's clock, so nodes' clocks need to
+agree to well within --timeout.
+
+`local` runs a coordinator and --processes workers on one machine, through the
+same queue, as the nodes would. The queue holds master passwords found in the
+manifest, in files readable only by their owner; leave them out of it, and
+give workers --masterpass-source, to keep them off the shared filesystem.
+
+Workers require the same environment variables as populate_qgis_creds.py.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/24'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import errno
+import json
+import multiprocessing
+import socket
+import threading
+import time
+
+import connections
+import scheduler
+from manifest import (
+    DEFAULT_PASSPHRASE,
+    ManifestError,
+    iter_manifest,
+    manifest_passphrases
+)
+from passwords import PasswordError, fill_passwords, source_from_uri
+from pki_index import PkiIndex, index_path
+from populate_qgis_creds import (
+    BatchReport,
+    batch_provision,
+    batch_worker_init
+)
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+WORKERS = 'workers'
+CONFIG = 'queue.json'
+ENQUEUED = 'enqueued'
+FINISHED = 'finished'
+
+# Users per batch
+BATCH_SIZE = 50
+
+# Seconds between a worker's heartbeats, and since its last one that it is
+# presumed dead
+HEARTBEAT = 10.0
+TIMEOUT = 60.0
+
+# Seconds between checks of the queue, by idle workers and the coordinator
+POLL = 1.0
+
+
+class QueueError(Exception):
+    """Raised when a queue directory can not be used."""
+    pass
+
+
+def worker_id():
+    """ID of this worker process, unique across the nodes.
+
+    :rtype: str
+    """
+    return '{0}-{1}'.format(socket.gethostname(), os.getpid())
+
+
+def _listdir(path):
+    try:
+        return sorted(n for n in os.listdir(path) if not n.startswith('.'))
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+
+class FileQueue(object):
+    """Queue of batches of users, in a directory shared by several nodes."""
+
+    def __init__(self, queuedir, clock=time.time):
+        """Constructor.
+
+        :param queuedir: Queue directory, see create()
+        :type queuedir: str
+        :param clock: Time of heartbeats, and to compare them with
+        """
+        self.queuedir = queuedir
+        self._clock = clock
+
+    def _path(self, *parts):
+        return os.path.join(self.queuedir, *parts)
+
+    def create(self, config):
+        """Create the queue's directories, readable only by their owner.
+
+        :param config: Options of the run, see config()
+        :type config: dict
+        """
+        for sub in (PENDING, CLAIMED, DONE, WORKERS):
+            if not os.path.isdir(self._path(sub)):
+                os.makedirs(self._path(sub), 0700)
+        self._write(self._path(CONFIG), json.dumps(config, sort_keys=True))
+
+    def config(self):
+        """Options of the run: `outdir`, `pkidir`, `pkiindex` (the path of
+        the index of pkidir, or None), `specpath`, `checkfirst`,
+        `allow_expired` and `lockretries`.
+
+        :rtype: dict
+        :raises QueueError: if the queue was not created
+        """
+        try:
+            with open(self._path(CONFIG), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            raise QueueError('Not a queue directory: {0} ({1})'.format(
+                self.queuedir, e))
+
+    def _write(self, path, data):
+        """Write a file whole, or not at all, as seen by other nodes."""
+        head, name = os.path.split(path)
+        tmp = os.path.join(head, '.{0}.tmp-{1}'.format(name, worker_id()))
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+
+    @staticmethod
+    def _lines(items):
+        return ''.join(json.dumps(i, sort_keys=True) + '\n' for i in items)
+
+    @staticmethod
+    def _read_lines(path):
+        with open(path, 'rb') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def put(self, num, records):
+        """Queue a batch of records.
+
+        :param num: Number of the batch, unique in the queue
+        :type num: int
+        :type records: list of dict
+        :returns: Name of the batch
+        :rtype: str
+        """
+        name = 'batch-{0:06d}'.format(num)
+        self._write(self._path(PENDING, name), self._lines(records))
+        return name
+
+    def enqueue(self, records, size=BATCH_SIZE):
+        """Queue records in batches, then mark the queue as complete.
+
+        :type records: iterable of dict
+        :returns: Number of batches
+        :rtype: int
+        """
+        batch = []
+        num = 0
+        for record in records:
+            batch.append(record)
+            if len(batch) >= size:
+                num += 1
+                self.put(num, batch)
+                batch = []
+        if batch:
+            num += 1
+            self.put(num, batch)
+        self._write(self._path(ENQUEUED), str(num))
+        return num
+
+    def batches(self):
+        """Number of batches, or None if they are still being queued.
+
+        :rtype: int
+        """
+        try:
+            with open(self._path(ENQUEUED), 'rb') as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def pending(self):
+        return _listdir(self._path(PENDING))
+
+    def claim(self, worker):
+        """Claim the first pending batch that no other worker claims first.
+
+        :returns: Name and records of the batch, or None if none is pending
+        :rtype: tuple
+        """
+        claimdir = self._path(CLAIMED, worker)
+        if not os.path.isdir(claimdir):
+            os.makedirs(claimdir, 0700)
+        for name in self.pending():
+            try:
+                os.rename(self._path(PENDING, name),
+                          os.path.join(claimdir, name))
+            except OSError:
+                # Claimed by another worker since it was listed
+                continue
+            return name, self._read_lines(os.path.join(claimdir, name))
+        return None
+
+    def claims(self):
+        """Batches claimed, by worker.
+
+        :rtype: dict
+        """
+        return dict((worker, _listdir(self._path(CLAIMED, worker)))
+                    for worker in _listdir(self._path(CLAIMED)))
+
+    def _unclaim(self, worker, name, requeue):
+        try:
+            if requeue:
+                os.rename(self._path(CLAIMED, worker, name),
+                          self._path(PENDING, name))
+            else:
+                os.remove(self._path(CLAIMED, worker, name))
+        except OSError as e:
+            # Reclaimed, or finished, meanwhile
+            if e.errno != errno.ENOENT:
+                raise
+
+    def complete(self, worker, name, results):
+        """Write the results of a claimed batch, then drop the claim.
+
+        :type results: list of dict
+        """
+        self._write(self._path(DONE, name), self._lines(results))
+        self._unclaim(worker, name, False)
+
+    def release(self, worker, name):
+        """Return an unfinished batch to the queue, e.g. when interrupted."""
+        self._unclaim(worker, name, True)
+
+    def heartbeat(self, worker, **state):
+        """Record that a worker is alive, with its state, e.g. its batch."""
+        state.update(worker=worker, time=self._clock())
+        self._write(self._path(WORKERS, worker + '.json'),
+                    json.dumps(state, sort_keys=True))
+
+    def leave(self, worker):
+        """Drop a worker's heartbeat, once it exits cleanly."""
+        try:
+            os.remove(self._path(WORKERS, worker + '.json'))
+        except OSError:
+            pass
+
+    def workers(self):
+        """Last heartbeat of each worker.
+
+        :rtype: dict
+        """
+        beats = {}
+        for name in _listdir(self._path(WORKERS)):
+            try:
+                with open(self._path(WORKERS, name), 'rb') as f:
+                    beat = json.load(f)
+            except (IOError, ValueError):
+                continue
+            beats[beat.get('worker', name[:-len('.json')])] = beat
+        return beats
+
+    def reclaim(self, timeout=TIMEOUT):
+        """Return the claimed batches of dead workers to the queue.
+
+        A worker is presumed dead once its last heartbeat is older than
+        timeout, or gone. Claims of batches already done are just dropped.
+
+        :returns: (worker, batch) of each batch returned to the queue
+        :rtype: list of tuple
+        """
+        beats = self.workers()
+        now = self._clock()
+        done = set(self.done())
+        reclaimed = []
+        for worker, names in sorted(self.claims().iteritems()):
+            beat = beats.get(worker)
+            dead = beat is None or now - beat.get('time', 0) > timeout
+            for name in names:
+                if name in done:
+                    self._unclaim(worker, name, False)
+                elif dead:
+                    self._unclaim(worker, name, True)
+                    reclaimed.append((worker, name))
+        return reclaimed
+
+    def done(self):
+        return _listdir(self._path(DONE))
+
+    def results(self, name):
+        """Per-user results of a done batch.
+
+        :rtype: list of dict
+        """
+        return self._read_lines(self._path(DONE, name))
+
+    def finish(self):
+        """Mark every batch as done, so workers exit."""
+        self._write(self._path(FINISHED), '')
+
+    def finished(self):
+        return os.path.exists(self._path(FINISHED))
+
+
+class Heartbeat(threading.Thread):
+    """Thread that rewrites a worker's heartbeat, with its state."""
+
+    def __init__(self, queue, worker, interval=HEARTBEAT):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.worker = worker
+        self.interval = interval
+        self.state = {'batch': None, 'batches': 0, 'users': 0}
+        self._done = threading.Event()
+
+    def beat(self):
+        self.queue.heartbeat(self.worker, **dict(self.state))
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            try:
+                self.beat()
+            except (IOError, OSError):
+                # e.g. the shared filesystem is briefly unavailable
+                continue
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def run_worker(queue, worker=None, source=None, interval=POLL,
+               heartbeat=HEARTBEAT):
+    """Claim and provision batches, until the queue is finished.
+
+    Users are provisioned as by populate_qgis_creds.batch_provision(), in a
+    process set up by populate_qgis_creds.batch_worker_init().
+
+    :type queue: FileQueue
+    :param worker: ID of the worker (default: worker_id())
+    :param source: Source of master passwords missing in batches
+    :type source: passwords.PasswordSource
+    :returns: Number of batches and users provisioned, and of users that
+        failed, as (batches, users, failed)
+    :rtype: tuple
+    """
+    worker = worker or worker_id()
+    config = queue.config()
+    options = {'checkfirst': config.get('checkfirst', False),
+               'allow_expired': config.get('allow_expired', False)}
+    beat = Heartbeat(queue, worker, heartbeat)
+    beat.beat()
+    beat.start()
+    failed = 0
+    name = None
+    try:
+        while not queue.finished():
+            claimed = queue.claim(worker)
+            if claimed is None:
+                time.sleep(interval)
+                continue
+            name, records = claimed
+            beat.state['batch'] = name
+            if source is not None:
+                records = list(fill_passwords(records, source, len(records)))
+            results = []
+            for record in records:
+                try:
+                    result = batch_provision(
+                        (record, config['outdir'], options))
+                except Exception as e:
+                    # Fail this user, not the batch, nor this worker
+                    result = {'user': record.get('user'), 'ok': False,
+                              'error': str(e) or e.__class__.__name__}
+                if not result['ok']:
+                    failed += 1
+                results.append(result)
+                beat.state['users'] += 1
+            queue.complete(worker, name, results)
+            name = beat.state['batch'] = None
+            beat.state['batches'] += 1
+    finally:
+        if name is not None:
+            queue.release(worker, name)
+        beat.stop()
+        queue.leave(worker)
+    return beat.state['batches'], beat.state['users'], failed
+
+
+def coordinate(queue, report, timeout=TIMEOUT, interval=POLL, alive=None):
+    """Report results as batches are done, reclaiming those of dead workers,
+    until every batch is done, then finish the queue.
+
+    :type queue: FileQueue
+    :type report: BatchReport
+    :param alive: Whether any worker is still running, e.g. of the local
+        worker processes; workers only exit once the queue is finished, so if
+        none is, the batches left would never be done (default: workers may
+        join at any time, as on other nodes)
+    :type alive: callable
+    :returns: Number of users that failed
+    :rtype: int
+    :raises QueueError: if alive, and no worker is left before every batch
+        is done
+    """
+    reported = set()
+    while True:
+        # Before the done batches are read, so none is missed
+        running = alive is None or alive()
+        for worker, name in queue.reclaim(timeout):
+            report.note('Reclaimed {0} from {1}'.format(name, worker))
+        for name in queue.done():
+            if name not in reported:
+                reported.add(name)
+                for result in queue.results(name):
+                    report.result(result)
+        total = queue.batches()
+        if total is not None and len(reported) >= total:
+            break
+        if not running:
+            raise QueueError('No workers left, with {0} of {1} batches '
+                             'done'.format(len(reported), total))
+        time.sleep(interval)
+    queue.finish()
+    return report.finish()
+
+
+def start_main(manifest, queuedir, outdir, pkidir='',
+               specpath=connections.DEFAULT_SPEC, pkiindex=False,
+               checkfirst=False, allow_expired=False,
+               lockretries=scheduler.RETRIES, size=BATCH_SIZE, report=None):
+    """Create a queue, and queue the users of a manifest, in batches.
+
+    :returns: The queue, and its number of batches, as (queue, batches)
+    :rtype: tuple
+    :raises QueueError: if queuedir already holds a queue
+    """
+    report = report or BatchReport()
+    queue = FileQueue(queuedir)
+    if os.path.exists(os.path.join(queuedir, CONFIG)):
+        raise QueueError('Queue already exists: {0}'.format(queuedir))
+    # fail early on a bad spec, rather than in every worker
+    connections.compile_spec(connections.load_spec(specpath))
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    indexpath = None
+    if pkiindex:
+        # In the shared outdir, for the workers on every node
+        indexpath = index_path(pkidir, outdir)
+        index = PkiIndex(pkidir, indexpath, manifest_passphrases(
+            manifest, [DEFAULT_PASSPHRASE]))
+        try:
+            report.note('PKI index: {0}'.format(index.update()))
+        finally:
+            index.close()
+    queue.create({'outdir': outdir, 'pkidir': pkidir, 'pkiindex': indexpath,
+                  'specpath': os.path.realpath(specpath),
+                  'checkfirst': checkfirst, 'allow_expired': allow_expired,
+                  'lockretries': lockretries})
+    batches = queue.enqueue(iter_manifest(manifest, pkidir), size)
+    report.note('Queued {0} batches of up to {1} users in {2}'.format(
+        batches, size, queuedir))
+    return queue, batches
+
+
+def _worker_process(queuedir, sourceuri=None, interval=POLL,
+                    heartbeat=HEARTBEAT):
+    """Boot QGIS, and work on a queue, as one worker process."""
+    queue = FileQueue(queuedir)
+    config = queue.config()
+    batch_worker_init(config['specpath'],
+                      ((config['pkidir'], config['pkiindex'])
+                       if config['pkiindex'] else None),
+                      lockretries=config['lockretries'])
+    source = source_from_uri(sourceuri) if sourceuri else None
+    try:
+        run_worker(queue, source=source, interval=interval,
+                   heartbeat=heartbeat)
+    except KeyboardInterrupt:
+        pass
+
+
+def start_workers(queuedir, processes=None, sourceuri=None, interval=POLL,
+                  heartbeat=HEARTBEAT):
+    """Start worker processes on a queue.
+
+    :param sourceuri: URI of the source of master passwords missing in the
+        queue, opened in each worker, see passwords.source_from_uri()
+    :type sourceuri: str
+    :rtype: list of multiprocessing.Process
+    """
+    procs = []
+    for _ in range(processes or multiprocessing.cpu_count()):
+        proc = multiprocessing.Process(
+            target=_worker_process,
+            args=(queuedir, sourceuri, interval, heartbeat))
+        proc.start()
+        procs.append(proc)
+    return procs
+
+
+def local_main(manifest, queuedir, outdir, processes=None, sourceuri=None,
+               timeout=TIMEOUT, interval=POLL, heartbeat=HEARTBEAT,
+               report=None, **options):
+    """Provision a manifest through a queue, with workers on this machine.
+
+    The same as a coordinator, and worker processes on each node, would.
+
+    :param options: Passed to start_main()
+    :returns: Number of users that failed
+    :rtype: int
+    :raises QueueError: if every worker process exits before the queue is
+        done
+    """
+    report = report or BatchReport()
+    queue, _ = start_main(manifest, queuedir, outdir, report=report,
+                          **options)
+    procs = start_workers(queuedir, processes, sourceuri, interval,
+                          heartbeat)
+    try:
+        # e.g. QGIS failed to boot, or the password source to be read
+        return coordinate(queue, report, timeout, interval,
+                          lambda: any(proc.is_alive() for proc in procs))
+    except BaseException:
+        for proc in procs:
+            proc.terminate()
+        raise
+    finally:
+        for proc in procs:
+            proc.join()
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Provision a manifest of users across several nodes, '
+                    'through a queue directory that they share.'
+    )
+    sub = parser.add_subparsers(dest='mode')
+
+    def add_queue(p):
+        p.add_argument(
+            '-q', '--queue-dir', dest='queuedir', metavar='directory-path',
+            required=True,
+            help='Queue directory, on a filesystem shared by every node'
+        )
+
+    def add_start(p):
+        p.add_argument(
+            'manifest', metavar='manifest-path',
+            help='CSV or JSON lines manifest of users (user[,masterpass]'
+                 '[,pkidir]), or - for stdin'
+        )
+        p.add_argument(
+            '-o', '--out-dir', dest='outdir', metavar='directory-path',
+            required=True,
+            help='Output directory, with a subdirectory per user, at the '
+                 'same path on every node'
+        )
+        p.add_argument(
+            '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
+            default='',
+            help='PKI components directory of users without one in the '
+                 'manifest'
+        )
+        p.add_argument(
+            '-x', '--pki-index', dest='pkiindex', action='store_true',
+            help='Look up users\' PKI components in an index of the PKI '
+                 'directory, updating it first'
+        )
+        p.add_argument(
+            '-c', '--connections', dest='specpath', metavar='spec-path',
+            default=connections.DEFAULT_SPEC,
+            help='JSON or YAML spec of OWS connections (default: '
+                 'connections.json)'
+        )
+        p.add_argument(
+            '-p', '--preflight', dest='preflight', action='store_true',
+            help='Validate each user\'s PKI components first'
+        )
+        p.add_argument(
+            '-e', '--allow-expired', dest='allowexpired',
+            action='store_true',
+            help='Do not fail pre-flight for expired certificates'
+        )
+        p.add_argument(
+            '-b', '--batch-size', dest='size', metavar='count', type=int,
+            default=BATCH_SIZE,
+            help='Users per batch (default: {0})'.format(BATCH_SIZE)
+        )
+        p.add_argument(
+            '--lock-retries', dest='lockretries', metavar='count', type=int,
+            default=scheduler.RETRIES,
+            help='Retries of a user whose auth db is locked (default: {0})'
+                 .format(scheduler.RETRIES)
+        )
+
+    def add_coordinate(p):
+        p.add_argument(
+            '-t', '--timeout', dest='timeout', metavar='seconds',
+            type=float, default=TIMEOUT,
+            help='Seconds since a worker\'s last heartbeat that it is '
+                 'presumed dead, and its batches reclaimed (default: {0})'
+                 .format(TIMEOUT)
+        )
+        p.add_argument(
+            '-r', '--results', dest='results', action='store_true',
+            help='Write per-user results to stdout as JSON lines'
+        )
+
+    def add_work(p):
+        p.add_argument(
+            '-j', '--processes', dest='processes', metavar='count',
+            type=int,
+            help='Worker processes (default: number of CPU cores)'
+        )
+        p.add_argument(
+            '-s', '--masterpass-source', dest='source', metavar='uri',
+            help='Source of master passwords missing in the queue: '
+                 'file:path, env:VAR or ldap://host/base-dn'
+        )
+        p.add_argument(
+            '--heartbeat', dest='heartbeat', metavar='seconds', type=float,
+            default=HEARTBEAT,
+            help='Seconds between heartbeats (default: {0})'.format(
+                HEARTBEAT)
+        )
+
+    coord = sub.add_parser(
+        'coordinator', help='Queue a manifest, then report results as '
+                            'workers provision it')
+    add_queue(coord)
+    add_start(coord)
+    add_coordinate(coord)
+
+    work = sub.add_parser(
+        'worker', help='Provision batches from a queue, until it is '
+                       'finished')
+    add_queue(work)
+    add_work(work)
+
+    local = sub.add_parser(
+        'local', help='Run a coordinator and workers on this machine')
+    add_queue(local)
+    add_start(local)
+    add_coordinate(local)
+    add_work(local)
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    qdir = os.path.realpath(args.queuedir)
+    try:
+        if args.mode == 'worker':
+            FileQueue(qdir).config()
+            if args.source:
+                # fail early on a bad URI, rather than in every worker
+                source_from_uri(args.source)
+            workers = start_workers(qdir, args.processes, args.source,
+                                    heartbeat=args.heartbeat)
+            try:
+                for w in workers:
+                    w.join()
+            except KeyboardInterrupt:
+                for w in workers:
+                    w.join()
+            sys.exit(0)
+
+        opts = dict(pkidir=os.path.realpath(args.pkidir)
+                    if args.pkidir else '',
+                    specpath=args.specpath, pkiindex=args.pkiindex,
+                    checkfirst=args.preflight,
+                    allow_expired=args.allowexpired,
+                    lockretries=args.lockretries, size=args.size)
+        rep = BatchReport(jsonl=args.results)
+        if args.mode == 'coordinator':
+            q, _ = start_main(args.manifest, qdir,
+                              os.path.realpath(args.outdir), report=rep,
+                              **opts)
+            failures = coordinate(q, rep, args.timeout)
+        else:
+            if args.source:
+                source_from_uri(args.source)
+            failures = local_main(args.manifest, qdir,
+                                  os.path.realpath(args.outdir),
+                                  args.processes, args.source,
+                                  args.timeout, heartbeat=args.heartbeat,
+                                  report=rep, **opts)
+    except (connections.SpecError, ManifestError, PasswordError,
+            QueueError, IOError, OSError) as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Append-only journal of the users a batch run has finished.
+
+Each user's result is appended as a JSON line, with the ID of their auth
+config, and a hash of their output (qgis-auth.db and QGIS2.ini), as it
+arrives::
+
+  {"user": "rod", "ok": true, "configid": "0k1a2b3", "action": "stored",
+   "hash": "9f86d0...", "time": 1419379200.0}
+  {"user": "jane", "ok": false, "error": "Failed to verify ...", ...}
+
+Lines are synced to disk in batches, every SYNC_EVERY results or SYNC_SECONDS
+seconds, whichever comes first, and when the journal is closed, so a run that
+dies loses at most the last unsynced batch, rather than everything.
+
+A run resumed from the journal reads it once, and then skips each user whose
+last result was a success with one set lookup, so a restart only costs the
+remaining work; users that failed are tried again. A line torn by a crash is
+dropped, and the journal is cut back to its last whole line before appending.
+
+Does not require QGIS.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/26'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import hashlib
+import json
+import time
+
+from backends import AUTHDBNAME, SETTINGSNAME
+
+JOURNALNAME = '.provision-journal.jsonl'
+
+# Results between syncs to disk, and most seconds between them
+SYNC_EVERY = 100
+SYNC_SECONDS = 5.0
+
+# Result keys that are journaled
+ENTRY_FIELDS = ('user', 'ok', 'configid', 'action', 'hash', 'error')
+
+
+def output_hash(authdbdir):
+    """SHA-256 of a user's output files, or None if there are none.
+
+    :param authdbdir: Directory of the user's qgis-auth.db and QGIS2.ini
+    :type authdbdir: str
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    found = False
+    for name in (AUTHDBNAME, SETTINGSNAME):
+        try:
+            f = open(os.path.join(authdbdir, name), 'rb')
+        except IOError:
+            continue
+        found = True
+        with f:
+            digest.update(name + '\0')
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+    return digest.hexdigest() if found else None
+
+
+class Journal(object):
+    """Append-only JSON lines journal of users' results, synced in batches."""
+
+    def __init__(self, path, resume=False, sync_every=SYNC_EVERY,
+                 sync_seconds=SYNC_SECONDS, clock=time.time):
+        """Constructor.
+
+        :param path: Journal file, created if needed
+        :type path: str
+        :param resume: Keep, and skip the users done in, an existing journal;
+            otherwise it is started anew
+        :type resume: bool
+        :param sync_every: Results between syncs to disk
+        :type sync_every: int
+        :param sync_seconds: Most seconds between syncs to disk
+        :type sync_seconds: float
+        """
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self._clock = clock
+        # Last successful entry, by user whose last result was a success
+        self.done = {}
+        self.syncs = 0
+        self._unsynced = 0
+        self._synced_at = clock()
+        if resume and os.path.exists(path):
+            self._f = open(path, 'r+b')
+            self._load()
+        else:
+            self._f = open(path, 'wb')
+
+    def _load(self):
+        end = 0
+        for line in iter(self._f.readline, ''):
+            if not line.endswith('\n'):
+                break  # torn last line of a run that died
+            end += len(line)
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('ok'):
+                self.done[entry['user']] = entry
+            else:
+                self.done.pop(entry.get('user'), None)
+        self._f.seek(end)
+        self._f.truncate()
+
+    def __len__(self):
+        return len(self.done)
+
+    def is_done(self, user):
+        """Whether a user's last result was a success.
+
+        :rtype: bool
+        """
+        return user in self.done
+
+    def record(self, result):
+        """Append a user's result, syncing if a batch is due.
+
+        :param result: Per-user result, with `user` and `ok`, see
+            populate_qgis_creds.batch_provision()
+        :type result: dict
+        """
+        entry = dict((k, result[k]) for k in ENTRY_FIELDS if k in result)
+        entry['time'] = self._clock()
+        self._f.write(json.dumps(entry, sort_keys=True) + '\n')
+        if entry['ok']:
+            self.done[entry['user']] = entry
+        else:
+            self.done.pop(entry['user'], None)
+        self._unsynced += 1
+        if (self._unsynced >= self.sync_every or
+                entry['time'] - self._synced_at >= self.sync_seconds):
+            self.sync()
+
+    def sync(self):
+        """Write the journaled results through to disk."""
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.syncs += 1
+        self._unsynced = 0
+        self._synced_at = self._clock()
+
+    def close(self):
+        if not self._f.closed:
+            self.sync()
+            self._f.close()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Manifests of users to provision in batch.
+
+A manifest is a CSV file, with a header row naming the columns, or a JSON
+lines file, with one object per user, of the same keys:
+
+- user: QGIS user's name (required)
+- masterpass: user's master password (required)
+- pkidir: user's PKI components directory (default: --pki-dir)
+- passphrase: passphrase of user's PKI bundle or key (default: 'password', as
+  for the sample data)
+- newpass: user's new master password, for rotate_masterpass.py (optional)
+
+Manifests are read as a stream, one record at a time, from a file or, given
+'-', from stdin, so a whole directory export never needs to fit in memory::
+
+  ldap-export --csv | populate_qgis_creds.py --batch - --results
+
+Does not require QGIS.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/05'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import csv
+import itertools
+import json
+
+DEFAULT_PASSPHRASE = 'password'
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+
+# Manifest path standing for stdin
+STDIN = '-'
+
+# Fields of a manifest row, each a string if given
+FIELDS = ('user', 'masterpass', 'pkidir', 'passphrase', 'newpass')
+
+
+class ManifestError(Exception):
+    """Raised when a manifest line can not be parsed."""
+    pass
+
+
+def make_record(row, pkidir='', line=None):
+    """Normalize a manifest row to a provisioning record.
+
+    :param row: Manifest row, by column name
+    :type row: dict
+    :param pkidir: Fallback PKI components directory for rows without one
+    :type pkidir: str
+    :param line: Line number of the row, for error messages
+    :type line: int
+    :returns: `user`, `masterpass`, `pkidir`, `passphrase` and `newpass`
+    :rtype: dict
+    :raises ManifestError: if a field is not a string, e.g. a JSON number
+    """
+    for key in FIELDS:
+        value = row.get(key)
+        if value is not None and not isinstance(value, basestring):
+            raise ManifestError('{0} field {1} is not a string: {2!r}'.format(
+                'Manifest row' if line is None else
+                'Manifest line {0}'.format(line), key, value))
+    passphrase = row.get('passphrase')
+    return {
+        'user': (row.get('user') or '').strip(),
+        'masterpass': row.get('masterpass') or '',
+        'pkidir': (row.get('pkidir') or '').strip() or pkidir,
+        'passphrase': DEFAULT_PASSPHRASE if passphrase is None else passphrase,
+        'newpass': row.get('newpass') or '',
+    }
+
+
+def user_error(user):
+    """Why a user name can not name their output directory, or None if it can.
+
+    Users are provisioned to a subdirectory of the output directory, named
+    for them, so a name that is a path, e.g. `../x` or `/etc/x`, would write
+    outside of it.
+
+    :rtype: str
+    """
+    seps = [s for s in (os.sep, os.altsep) if s]
+    if (os.path.isabs(user) or any(s in user for s in seps) or
+            '..' in user or user == os.curdir):
+        return 'Bad user name in manifest: {0!r}'.format(user)
+    return None
+
+
+def record_error(record, required=('user', 'masterpass', 'pkidir')):
+    """Why a record can not be provisioned, or None if it can.
+
+    :param required: Fields the record must have
+    :type required: tuple of str
+    :rtype: str
+    """
+    missing = [k for k in required if not record[k]]
+    if missing:
+        return 'Missing {0} in manifest'.format(', '.join(missing))
+    if record['user']:
+        return user_error(record['user'])
+    return None
+
+
+def manifest_format(manifest, first=''):
+    """Format of a manifest, by file extension, or else by its first line.
+
+    :param manifest: Path to manifest, or STDIN
+    :type manifest: str
+    :param first: First non-blank line of the manifest, if known
+    :type first: str
+    :returns: CSV or JSONL
+    :rtype: str
+    """
+    ext = os.path.splitext(manifest)[1].lower()
+    if ext in ('.jsonl', '.ndjson', '.json'):
+        return JSONL
+    if ext == '.csv':
+        return CSV
+    return JSONL if first.lstrip().startswith('{') else CSV
+
+
+def _jsonl_rows(lines, start=1):
+    for num, line in enumerate(lines, start):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise ManifestError('Bad JSON on manifest line {0}: {1}'.format(
+                num, e))
+        if not isinstance(row, dict):
+            raise ManifestError('Manifest line {0} is not an object'.format(
+                num))
+        yield num, row
+
+
+def parse_manifest(lines, fmt=CSV, pkidir='', start=1):
+    """Records of a manifest's lines, parsed as they are iterated.
+
+    :param lines: Manifest lines, e.g. an open file
+    :type lines: iterable of str
+    :param fmt: CSV or JSONL
+    :type fmt: str
+    :param pkidir: Fallback PKI components directory for rows without one
+    :type pkidir: str
+    :param start: Line number of the first line, for error messages
+    :type start: int
+    :rtype: generator of dict
+    """
+    if fmt == JSONL:
+        for num, row in _jsonl_rows(lines, start):
+            yield make_record(row, pkidir, num)
+    else:
+        for row in csv.DictReader(lines):
+            yield make_record(row, pkidir)
+
+
+def _stream(f, manifest, pkidir, fmt):
+    try:
+        # readline(), unlike file iteration, does not read ahead, so records
+        # from a pipe are yielded as soon as their line arrives
+        lines = iter(f.readline, '')
+        skipped = 0
+        first = ''
+        for first in lines:
+            if first.strip():
+                break
+            skipped += 1
+        if fmt is None:
+            fmt = manifest_format(manifest, first)
+        lines = itertools.chain([first], lines)
+        for record in parse_manifest(lines, fmt, pkidir, skipped + 1):
+            yield record
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def iter_manifest(manifest, pkidir='', fmt=None):
+    """Stream users to provision from a CSV or JSON lines manifest.
+
+    Only the current line is held in memory, so a manifest may be any size,
+    or a pipe that is still being written. The manifest is opened at once,
+    so a missing file fails here, rather than on the first record.
+
+    :param manifest: Path to manifest, or STDIN to read from stdin
+    :type manifest: str
+    :param pkidir: Fallback PKI components directory for rows without one
+    :type pkidir: str
+    :param fmt: CSV or JSONL (default: guessed, see manifest_format())
+    :type fmt: str
+    :returns: Records, parsed as they are iterated
+    :rtype: generator of dict
+    :raises IOError: if the manifest can not be opened
+    :raises ManifestError: on a line that can not be parsed, when iterated
+    """
+    f = sys.stdin if manifest == STDIN else open(manifest, 'rb')
+    return _stream(f, manifest, pkidir, fmt)
+
+
+def manifest_passphrases(manifest, extra=()):
+    """Distinct PKI passphrases of a manifest's users, e.g. as the candidate
+    passphrases of a pki_index.PkiIndex.
+
+    The manifest is streamed, so only the distinct passphrases are held in
+    memory. A manifest on stdin can not be read twice, so is not read.
+
+    :param manifest: Path to CSV or JSON lines manifest, or STDIN
+    :type manifest: str
+    :param extra: Passphrases to add, e.g. of --pki-passphrase
+    :type extra: iterable of str
+    :rtype: list of str
+    :raises ManifestError: on a manifest line that can not be parsed
+    """
+    found = set(p for p in extra if p)
+    if manifest != STDIN:
+        found.update(r['passphrase'] for r in iter_manifest(manifest)
+                     if r['passphrase'])
+    return sorted(found)
+
+
+def read_manifest(manifest, pkidir=''):
+    """Read all users to provision from a manifest, see iter_manifest().
+
+    :param manifest: Path to CSV or JSON lines manifest
+    :type manifest: str
+    :param pkidir: Fallback PKI components directory for rows without one
+    :type pkidir: str
+    :rtype: list of dict
+    """
+    return list(iter_manifest(manifest, pkidir))
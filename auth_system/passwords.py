@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""Sources of users' QGIS master passwords.
+
+A source looks up the master passwords of many users at once, with
+lookup(users), or of one, with get(user). Sources are made from a URI, as
+given to `populate_qgis_creds.py --masterpass-source`:
+
+- file:path: a file of `user:password` lines; blank lines and lines starting
+  with '#' are skipped. Re-read when it changes.
+- env:VAR: the environment variable VAR, the same password for every user,
+  or, if VAR contains `{user}`, e.g. `env:MASTERPASS_{user}`, one per user.
+- ldap://host[:port]/base-dn[?user-attr,password-attr]: an LDAP directory
+  (requires python-ldap). Users are searched for under base-dn by user-attr
+  (default: uid), and their password read from password-attr (default:
+  qgisMasterPassword). A bind DN and password, if needed, are read from the
+  MASTERPASS_BIND_DN and MASTERPASS_BIND_PW environment variables.
+
+A directory source keeps a small pool of bound connections, looks users up
+BATCH_SIZE at a time, with one OR-ed search filter, rather than one round trip
+per user, and caches what it found (or did not) for CACHE_TTL seconds.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/15'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import Queue
+import contextlib
+import threading
+import time
+import urllib
+import urlparse
+
+try:
+    import ldap
+except ImportError:
+    ldap = None
+
+# Users per directory search
+BATCH_SIZE = 500
+
+# Directory connections kept open
+POOL_SIZE = 4
+
+# Seconds a directory lookup is cached
+CACHE_TTL = 60
+
+BIND_DN_VAR = 'MASTERPASS_BIND_DN'
+BIND_PW_VAR = 'MASTERPASS_BIND_PW'
+
+# As ldap.SCOPE_SUBTREE, for connections without python-ldap
+SCOPE_SUBTREE = 2
+
+
+class PasswordError(Exception):
+    """Raised when a password source can not be read or reached."""
+    pass
+
+
+class PasswordSource(object):
+    """Source of master passwords, by user name."""
+
+    def lookup(self, users):
+        """Master passwords of users.
+
+        :param users: User names
+        :type users: iterable of str
+        :returns: Password of each user that was found, by user name
+        :rtype: dict
+        :raises PasswordError: if the source can not be read
+        """
+        raise NotImplementedError
+
+    def get(self, user):
+        """Master password of one user, or None if not found.
+
+        :rtype: str
+        """
+        return self.lookup([user]).get(user)
+
+    def close(self):
+        pass
+
+
+class FilePasswordSource(PasswordSource):
+    """Passwords from a file of `user:password` lines."""
+
+    def __init__(self, path):
+        self.path = path
+        self._passwords = {}
+        self._mtime = None
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            passwords = {}
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    line = line.rstrip('\r\n')
+                    if not line.strip() or line.startswith('#'):
+                        continue
+                    user, sep, password = line.partition(':')
+                    if sep:
+                        passwords[user.strip()] = password
+        except (IOError, OSError) as e:
+            raise PasswordError('Could not read passwords {0}: {1}'.format(
+                self.path, e))
+        self._passwords, self._mtime = passwords, mtime
+
+    def lookup(self, users):
+        self._load()
+        return dict((u, self._passwords[u]) for u in users
+                    if u in self._passwords)
+
+
+class EnvPasswordSource(PasswordSource):
+    """Passwords from environment variables."""
+
+    def __init__(self, var):
+        """Constructor.
+
+        :param var: Variable name; `{user}` in it is replaced by the user
+        :type var: str
+        """
+        self.var = var
+
+    def lookup(self, users):
+        found = {}
+        for user in users:
+            password = os.environ.get(self.var.replace('{user}', user))
+            if password:
+                found[user] = password
+        return found
+
+
+class ConnectionPool(object):
+    """Pool of at most size connections, opened as they are needed."""
+
+    def __init__(self, connect, size=POOL_SIZE):
+        """Constructor.
+
+        :param connect: Opens and binds a new connection
+        :type connect: callable
+        """
+        self._connect = connect
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.Semaphore(size)
+        self.opened = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, waiting for one if all are in use.
+
+        A connection that raises is closed rather than returned to the pool.
+        """
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                conn = self._connect()
+                self.opened += 1
+            try:
+                yield conn
+            except Exception:
+                _unbind(conn)
+                raise
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                _unbind(self._idle.get_nowait())
+            except Queue.Empty:
+                return
+
+
+def _unbind(conn):
+    try:
+        conn.unbind_s()
+    except Exception:  # pylint: disable=W0703
+        pass  # already broken, and being dropped
+
+
+def escape_filter(value):
+    """Escape a value for an LDAP search filter (RFC 4515).
+
+    :rtype: str
+    """
+    for char in '\\*()\0':
+        value = value.replace(char, '\\{0:02x}'.format(ord(char)))
+    return value
+
+
+class DirectoryPasswordSource(PasswordSource):
+    """Passwords from an LDAP directory, looked up in batches."""
+
+    def __init__(self, uri, base, user_attr='uid',
+                 password_attr='qgisMasterPassword', bind_dn='',
+                 bind_pw='', batch_size=BATCH_SIZE, pool_size=POOL_SIZE,
+                 ttl=CACHE_TTL, connect=None):
+        """Constructor.
+
+        :param uri: Directory server, e.g. ldap://ldap.example.com
+        :type uri: str
+        :param base: DN to search for users under
+        :type base: str
+        :param batch_size: Users per search
+        :type batch_size: int
+        :param ttl: Seconds to cache looked up users for
+        :type ttl: float
+        :param connect: Opens a bound connection with the python-ldap
+            search_s() and unbind_s() methods (default: python-ldap's)
+        :type connect: callable
+        """
+        self.uri = uri
+        self.base = base
+        self.user_attr = user_attr
+        self.password_attr = password_attr
+        self.bind_dn = bind_dn
+        self.bind_pw = bind_pw
+        self.batch_size = batch_size
+        self.ttl = ttl
+        if connect is None:
+            if ldap is None:
+                raise PasswordError(
+                    'python-ldap is required to read passwords from {0}'
+                    .format(uri))
+            connect = self._ldap_connect
+        self.errors = (ldap.LDAPError,) if ldap is not None else ()
+        self.pool = ConnectionPool(connect, pool_size)
+        self.searches = 0
+        # user: (expiry time, password or None if not found)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _ldap_connect(self):
+        conn = ldap.initialize(self.uri)
+        conn.simple_bind_s(self.bind_dn, self.bind_pw)
+        return conn
+
+    def _search(self, users):
+        filt = '(|{0})'.format(''.join(
+            '({0}={1})'.format(self.user_attr, escape_filter(u))
+            for u in users))
+        try:
+            with self.pool.connection() as conn:
+                entries = conn.search_s(self.base, SCOPE_SUBTREE, filt,
+                                        [self.user_attr, self.password_attr])
+        except self.errors as e:
+            raise PasswordError('Directory search of {0} failed: {1}'.format(
+                self.uri, e))
+        with self._lock:
+            self.searches += 1
+        found = {}
+        wanted = set(users)
+        for _, attrs in entries:
+            names = attrs.get(self.user_attr) or []
+            passwords = attrs.get(self.password_attr) or []
+            if names and passwords and names[0] in wanted:
+                found[names[0]] = passwords[0]
+        return found
+
+    def lookup(self, users):
+        now = time.time()
+        found = {}
+        missing = []
+        with self._lock:
+            for user in set(users):
+                cached = self._cache.get(user)
+                if cached is not None and cached[0] > now:
+                    if cached[1] is not None:
+                        found[user] = cached[1]
+                else:
+                    missing.append(user)
+
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            result = self._search(batch)
+            expiry = time.time() + self.ttl
+            with self._lock:
+                for user in batch:
+                    self._cache[user] = (expiry, result.get(user))
+            found.update(result)
+        return found
+
+    def close(self):
+        self.pool.close()
+
+
+def source_from_uri(uri, **kwargs):
+    """Password source for a URI, see the module docstring for its forms.
+
+    :param kwargs: Extra arguments of a directory source, e.g. batch_size
+    :rtype: PasswordSource
+    :raises PasswordError: if the URI is not understood
+    """
+    scheme, _, rest = uri.partition(':')
+    if scheme == 'file' and rest:
+        return FilePasswordSource(os.path.expanduser(rest))
+    if scheme == 'env' and rest:
+        return EnvPasswordSource(rest)
+    if scheme in ('ldap', 'ldaps'):
+        parts = urlparse.urlsplit(uri)
+        attrs = [a for a in parts.query.split('?')[0].split(',') if a]
+        if attrs:
+            kwargs.setdefault('user_attr', attrs[0])
+        if len(attrs) > 1:
+            kwargs.setdefault('password_attr', attrs[1])
+        kwargs.setdefault('bind_dn', os.environ.get(BIND_DN_VAR, ''))
+        kwargs.setdefault('bind_pw', os.environ.get(BIND_PW_VAR, ''))
+        return DirectoryPasswordSource(
+            '{0}://{1}'.format(parts.scheme, parts.netloc),
+            urllib.unquote(parts.path.lstrip('/')), **kwargs)
+    raise PasswordError('Unknown password source: {0}'.format(uri))
+
+
+def fill_passwords(records, source, batch_size=BATCH_SIZE, key='masterpass'):
+    """Fill in the master passwords of manifest records without one.
+
+    Records are read batch_size at a time, and their users looked up with
+    one lookup() per batch, so a streamed manifest stays streamed.
+
+    :param records: Records, see manifest.make_record()
+    :type records: iterable of dict
+    :param source: Source to look up missing passwords in
+    :type source: PasswordSource
+    :param key: Record key of the password, e.g. `newpass`
+    :type key: str
+    :rtype: generator of dict
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            for filled in _fill_batch(batch, source, key):
+                yield filled
+            batch = []
+    for filled in _fill_batch(batch, source, key):
+        yield filled
+
+
+def _fill_batch(batch, source, key):
+    users = [r['user'] for r in batch if r['user'] and not r[key]]
+    found = source.lookup(users) if users else {}
+    for record in batch:
+        if not record[key] and record['user'] in found:
+            record[key] = found[record['user']]
+    return batch
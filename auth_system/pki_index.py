@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Indexed scanner of a PKI components directory.
+
+Walks a PKI directory once, parsing PEM and DER certificates and keys, and
+PKCS#12 bundles, for subject, issuer, serial, fingerprint, expiry and public
+key. Results are kept in an SQLite index keyed by path, size and mtime, so
+later scans only re-parse files that were added or changed, and a scan can
+be limited to the files known to have changed (e.g. by watch_pki.py). A user's
+credentials (bundle, or cert and matching key, and issuer) are then looked up
+in memory, rather than guessed from file names and parsed one by one.
+
+The index is kept in the output directory of a run, or else in CACHEDIR, and
+not in the PKI directory, which may be a read-only share.
+
+Encrypted keys and PKCS#12 bundles can only be fully parsed with their
+passphrase; pass candidates with --passphrase. Files that could not be parsed
+are indexed with their error, and only re-parsed once they change, or, for
+encrypted ones, once the candidate passphrases do.
+
+Does not require QGIS; see pkiutils.py for the `openssl` requirement.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/04'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import errno
+import hashlib
+import json
+import sqlite3
+import stat
+
+import pkiutils
+
+# Index file name, for the hash of the PKI directory's path
+INDEXNAME = '.pki-index-{0}.db'
+
+# Default directory of index files, rather than the PKI directory, which may
+# be a read-only share
+CACHEDIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), 'qgis-auth-system')
+
+_COLUMNS = ('path', 'size', 'mtime', 'kind', 'subject', 'issuer', 'serial',
+            'fingerprint', 'not_after', 'pubkey_id', 'key_pubkey_id',
+            'encrypted', 'error')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pki_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    kind TEXT,
+    subject TEXT,
+    issuer TEXT,
+    serial TEXT,
+    fingerprint TEXT,
+    not_after INTEGER,
+    pubkey_id TEXT,
+    key_pubkey_id TEXT,
+    encrypted INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+)'''
+
+_META_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pki_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)'''
+
+
+def parse_file(path, kind, passphrases=()):
+    """Parse one PKI component file into an index entry.
+
+    :param kind: pkiutils.CERT, pkiutils.KEY or pkiutils.PKCS12
+    :param passphrases: Candidate passphrases for keys and bundles
+    :returns: Entry, without `path`, `size` and `mtime`
+    :rtype: dict
+    """
+    entry = {'kind': kind, 'encrypted': 0}
+    try:
+        if kind == pkiutils.CERT:
+            entry.update(pkiutils.cert_info(path, der=pkiutils.is_der(path)))
+            return entry
+
+        der = kind == pkiutils.KEY and pkiutils.is_der(path)
+        if kind == pkiutils.KEY and not der:
+            entry['encrypted'] = int(pkiutils.key_encrypted(path))
+        if kind == pkiutils.PKCS12:
+            entry['encrypted'] = 1
+        candidates = [''] + list(passphrases) if entry['encrypted'] else ['']
+
+        error = None
+        for passphrase in candidates:
+            try:
+                if kind == pkiutils.KEY:
+                    entry.update(pkiutils.key_info(path, passphrase, der=der))
+                else:
+                    info = pkiutils.pkcs12_info(path, passphrase)
+                    del info['cert_pem']
+                    entry.update(info)
+                return entry
+            except pkiutils.PkiError as e:
+                error = e
+        raise error
+    except (pkiutils.PkiError, IOError) as e:
+        entry['error'] = str(e)
+    return entry
+
+
+def index_path(pkidir, directory=None):
+    """Index file of a PKI directory, named for its path.
+
+    :param directory: Directory to keep the index in, e.g. the output
+        directory of a run (default: CACHEDIR)
+    :type directory: str
+    :rtype: str
+    """
+    digest = hashlib.sha1(os.path.realpath(pkidir)).hexdigest()[:16]
+    return os.path.join(directory or CACHEDIR, INDEXNAME.format(digest))
+
+
+def user_credentials(user, pkidir, pkiindex=None):
+    """Paths of a user's PKI components.
+
+    Looked up in pkiindex, if given and it is the index of pkidir; otherwise
+    (e.g. for a user with their own pkidir in the manifest) guessed from the
+    file naming of the sample data: user.p12, user_cert.pem, user_key.pem and
+    ca.pem.
+
+    :param pkiindex: Up-to-date index of a PKI components directory
+    :type pkiindex: PkiIndex
+    :returns: Paths of `bundle`, `cert`, `key` and `issuer`, and
+        `issuer_self_signed`
+    :rtype: dict
+    """
+    if (pkiindex is not None and
+            os.path.realpath(pkidir) == pkiindex.pkidir):
+        return pkiindex.credentials(user)
+    return {
+        'bundle': os.path.join(pkidir, '{0}.p12'.format(user)),
+        'cert': os.path.join(pkidir, '{0}_cert.pem'.format(user)),
+        'key': os.path.join(pkidir, '{0}_key.pem'.format(user)),
+        'issuer': os.path.join(pkidir, 'ca.pem'),
+        'issuer_self_signed': True,
+    }
+
+
+class PkiIndex(object):
+    """Persistent, mtime-keyed index of the PKI components in a directory."""
+
+    def __init__(self, pkidir, indexpath=None, passphrases=()):
+        """Constructor.
+
+        :param pkidir: PKI components directory to index
+        :type pkidir: str
+        :param indexpath: SQLite index file, created with its directory if
+            needed (default: see index_path())
+        :type indexpath: str
+        :param passphrases: Candidate passphrases for keys and bundles
+        :type passphrases: list of str
+        """
+        self.pkidir = os.path.realpath(pkidir)
+        self.indexpath = indexpath or index_path(self.pkidir)
+        self.passphrases = list(passphrases)
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.indexpath)))
+        except OSError as e:
+            # Made by an earlier run, or a concurrent one
+            if e.errno != errno.EEXIST:
+                raise
+        self.conn = sqlite3.connect(self.indexpath)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(_SCHEMA)
+        self.conn.execute(_META_SCHEMA)
+        self._entries = None
+        self._lookups = None
+
+    def close(self):
+        self.conn.close()
+
+    def _stamp(self):
+        """Hash of the candidate passphrases, so they are not stored as is."""
+        return hashlib.sha256('\0'.join(sorted(set(self.passphrases)))) \
+            .hexdigest()
+
+    def _retry(self):
+        """Paths of encrypted files that failed to parse with other candidate
+        passphrases than the current ones."""
+        row = self.conn.execute(
+            "SELECT value FROM pki_meta WHERE key = 'passphrases'").fetchone()
+        if row is not None and row[0] == self._stamp():
+            return set()
+        return set(row[0] for row in self.conn.execute(
+            'SELECT path FROM pki_files '
+            'WHERE error IS NOT NULL AND encrypted = 1'))
+
+    def _walk(self, top=None):
+        """Yield (path, stat) of candidate PKI files under top (default:
+        pkidir)."""
+        indexpath = os.path.realpath(self.indexpath)
+        for root, dirs, files in os.walk(top or self.pkidir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                path = os.path.join(root, name)
+                if name.startswith('.') or path == indexpath:
+                    continue
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    continue
+
+    def _stat(self, paths):
+        """Yield (path, stat) of the candidate PKI files among paths.
+
+        A path ending with os.sep stands for every file under it. Files
+        outside of pkidir, or hidden in it, are not candidates.
+        """
+        indexpath = os.path.realpath(self.indexpath)
+        for path in paths:
+            rel = os.path.relpath(path, self.pkidir)
+            if path == indexpath or rel != os.curdir and any(
+                    p.startswith('.') for p in rel.split(os.sep)):
+                continue
+            if path.endswith(os.sep):
+                for found in self._walk(path):
+                    yield found
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                yield path, st
+
+    def update(self, paths=None):
+        """Scan pkidir, re-parsing only new or changed files.
+
+        Encrypted files that failed to parse are re-parsed too, if the
+        candidate passphrases changed since the last update.
+
+        :param paths: Only re-check these paths, e.g. those a watcher of
+            pkidir reported changed; a path ending with os.sep stands for
+            every file under it (default: all of pkidir)
+        :type paths: iterable of str
+        :returns: Number of files `parsed`, `unchanged` and `removed`
+        :rtype: dict
+        """
+        known = dict(
+            (row['path'], (row['size'], row['mtime'])) for row in
+            self.conn.execute('SELECT path, size, mtime FROM pki_files'))
+        retry = self._retry()
+        if paths is None:
+            found = self._walk()
+            files, dirs = None, ()
+        else:
+            paths = list(paths)
+            found = self._stat(paths + sorted(retry.difference(paths)))
+            files = set(p for p in paths if not p.endswith(os.sep))
+            dirs = tuple(p for p in paths if p.endswith(os.sep))
+        changed = []
+        seen = set()
+        for path, st in found:
+            seen.add(path)
+            if (path not in retry and
+                    known.get(path) == (st.st_size, st.st_mtime)):
+                continue
+            kind = pkiutils.file_kind(path)
+            if kind is None:
+                continue
+            entry = dict.fromkeys(_COLUMNS)
+            entry.update(parse_file(path, kind, self.passphrases))
+            entry.update(path=path, size=st.st_size, mtime=st.st_mtime)
+            changed.append(entry)
+
+        removed = [path for path in known if path not in seen and (
+            files is None or path in files or path.startswith(dirs))]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO pki_files ({0}) VALUES ({1})'.format(
+                    ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))),
+                [tuple(e[c] for c in _COLUMNS) for e in changed])
+            self.conn.executemany('DELETE FROM pki_files WHERE path = ?',
+                                  [(path,) for path in removed])
+            self.conn.execute(
+                'INSERT OR REPLACE INTO pki_meta (key, value) '
+                "VALUES ('passphrases', ?)", (self._stamp(),))
+        self._entries = None
+        self._lookups = None
+        return {'parsed': len(changed),
+                'unchanged': len(seen) - len(changed),
+                'removed': len(removed)}
+
+    def entries(self):
+        """All indexed entries, loaded once and kept in memory.
+
+        :rtype: list of dict
+        """
+        if self._entries is None:
+            self._entries = [dict(row) for row in
+                             self.conn.execute('SELECT * FROM pki_files')]
+            self._lookups = None
+        return self._entries
+
+    def _lookup(self):
+        """In-memory lookups of entries, built once per loaded index.
+
+        :returns: Dicts of (kind, name) and (kind, subject CN) to entries, and
+            of key pubkey_id and certificate subject to entries
+        :rtype: tuple
+        """
+        if self._entries is not None and self._lookups is not None:
+            return self._lookups
+
+        bystem, bycn, bypubkey, bysubject = {}, {}, {}, {}
+        # PEM before DER, as QGIS expects PEM for cert, key and issuer paths
+        entries = sorted(self.entries(),
+                         key=lambda e: (not e['path'].endswith('.pem'),
+                                        e['path']))
+        for e in entries:
+            kind = e['kind']
+            stem = os.path.splitext(os.path.basename(e['path']))[0]
+            bystem.setdefault((kind, stem), []).append(e)
+            if e['subject']:
+                bysubject.setdefault(e['subject'], []).append(e)
+                if e['subject'] != e['issuer']:
+                    cn = pkiutils.subject_cn(e['subject'])
+                    bycn.setdefault((kind, cn), []).append(e)
+            if kind == pkiutils.KEY and e['pubkey_id']:
+                bypubkey.setdefault(e['pubkey_id'], []).append(e)
+        self._lookups = (bystem, bycn, bypubkey, bysubject)
+        return self._lookups
+
+    def credentials(self, user):
+        """Look up a user's PKI components in the index.
+
+        A user's bundle or certificate is the one named for the user (e.g.
+        user.p12, user_cert.pem), else the one with the user as subject CN.
+        The key is the one matching the certificate's public key, else the one
+        named user_key; the issuer is the certificate of the issuer subject.
+
+        :returns: Paths of `bundle`, `cert`, `key` and `issuer`, each None if
+            not found, and `issuer_self_signed`
+        :rtype: dict
+        """
+        bystem, bycn, bypubkey, bysubject = self._lookup()
+
+        def first(*candidates):
+            for found in candidates:
+                if found:
+                    return found[0]
+            return None
+
+        bundle = first(bystem.get((pkiutils.PKCS12, user)),
+                       bycn.get((pkiutils.PKCS12, user)))
+        cert = first(bystem.get((pkiutils.CERT, user + '_cert')),
+                     bystem.get((pkiutils.CERT, user)),
+                     bycn.get((pkiutils.CERT, user)))
+        key = first(bypubkey.get(cert['pubkey_id']) if cert else None,
+                    bystem.get((pkiutils.KEY, user + '_key')))
+
+        issuer = None
+        client = bundle if bundle and bundle['issuer'] else cert
+        if client is not None and client['issuer']:
+            issuer = first([e for e in bysubject.get(client['issuer'], [])
+                            if e['kind'] == pkiutils.CERT])
+
+        return {
+            'bundle': bundle['path'] if bundle else None,
+            'cert': cert['path'] if cert else None,
+            'key': key['path'] if key else None,
+            'issuer': issuer['path'] if issuer else None,
+            'issuer_self_signed': bool(
+                issuer and issuer['subject'] == issuer['issuer']),
+        }
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Index the PKI components in a directory, re-parsing only '
+                    'changed files, and look up users\' credentials.'
+    )
+    parser.add_argument(
+        '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
+        required=True,
+        help='PKI components directory path'
+    )
+    parser.add_argument(
+        '-i', '--index', dest='indexpath', metavar='index-path',
+        help='Index file (default: in {0})'.format(CACHEDIR)
+    )
+    parser.add_argument(
+        '-p', '--passphrase', dest='passphrases', metavar='passphrase',
+        action='append', default=[],
+        help='Candidate passphrase for keys and bundles (repeatable)'
+    )
+    parser.add_argument(
+        '-u', '--user', dest='users', metavar='username', action='append',
+        default=[],
+        help='Print the indexed credentials of user (repeatable)'
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    if not os.path.isdir(args.pkidir):
+        print 'PKI components directory does not exist.'
+        sys.exit(1)
+
+    index = PkiIndex(args.pkidir, args.indexpath, args.passphrases)
+    try:
+        print json.dumps(index.update(), sort_keys=True)
+        for u in args.users:
+            print json.dumps(dict(user=u, **index.credentials(u)),
+                             sort_keys=True)
+    finally:
+        index.close()
+    sys.exit(0)
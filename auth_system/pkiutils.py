@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""PKI component parsing, via the `openssl` command line tool.
+
+Does not require QGIS, so PKI files can be inspected and validated before, or
+without, booting QGIS. The `openssl` executable is found on PATH, unless the
+OPENSSL environment variable points to one (e.g. the one in an OSGeo4W or QGIS
+install). Passphrases are handed to openssl through its environment, not its
+command line.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/04'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import calendar
+import hashlib
+import subprocess
+import tempfile
+import time
+
+OPENSSL = os.environ.get('OPENSSL', 'openssl')
+
+# Kinds of PKI component files
+CERT = 'cert'
+KEY = 'key'
+PKCS12 = 'pkcs12'
+
+PKCS12_EXTS = ('.p12', '.pfx')
+DER_EXTS = ('.der', '.cer', '.crt', '.key')
+PEM_EXTS = ('.pem', '.crt', '.key')
+
+_PASSIN_VAR = 'PKIUTILS_PASSIN'
+
+
+class PkiError(Exception):
+    """Raised when a PKI component can not be read or does not validate."""
+    pass
+
+
+def openssl(args, stdin=None, passphrase=None):
+    """Run openssl, passing any passphrase via the environment.
+
+    :param args: openssl arguments, e.g. ['x509', '-in', path]
+    :type args: list
+    :param stdin: Data to write to openssl's stdin
+    :type stdin: str
+    :param passphrase: Passphrase, for use with '-passin', passin_arg()
+    :type passphrase: str
+    :returns: Exit code, stdout and stderr
+    :rtype: tuple
+    """
+    env = None
+    if passphrase is not None:
+        env = dict(os.environ)
+        env[_PASSIN_VAR] = passphrase
+    try:
+        proc = subprocess.Popen(
+            [OPENSSL] + list(args), env=env, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise PkiError('Could not run {0}: {1}'.format(OPENSSL, e))
+    out, err = proc.communicate(stdin)
+    return proc.returncode, out, err
+
+
+def passin_arg():
+    """openssl -passin source for the passphrase given to openssl()."""
+    return 'env:' + _PASSIN_VAR
+
+
+def _last_error(err):
+    lines = [l for l in err.strip().splitlines() if l.strip()]
+    return lines[-1] if lines else 'unknown openssl error'
+
+
+def pubkey_id(pubkey_pem):
+    """Digest identifying a public key, from its PEM encoding.
+
+    The same for a certificate and its private key, so keys can be matched to
+    certificates without comparing the keys themselves.
+
+    :rtype: str
+    """
+    body = ''.join(l.strip() for l in pubkey_pem.splitlines()
+                   if l.strip() and not l.startswith('-----'))
+    return hashlib.sha1(body).hexdigest()
+
+
+def parse_time(value):
+    """Seconds since epoch of an openssl date, e.g. 'Feb 25 00:00:00 2018 GMT'.
+
+    :rtype: int
+    """
+    return calendar.timegm(time.strptime(' '.join(value.split()),
+                                         '%b %d %H:%M:%S %Y %Z'))
+
+
+def cert_info(path=None, data=None, der=False):
+    """Parse a certificate, from a file or from PEM data.
+
+    :returns: `subject`, `issuer`, `serial`, `fingerprint` (SHA-1),
+        `not_after` (seconds since epoch) and `pubkey_id`
+    :rtype: dict
+    :raises PkiError: if no certificate could be read
+    """
+    args = ['x509', '-noout', '-nameopt', 'RFC2253', '-subject', '-issuer',
+            '-serial', '-fingerprint', '-sha1', '-enddate', '-pubkey']
+    if der:
+        args += ['-inform', 'DER']
+    if path is not None:
+        args += ['-in', path]
+    code, out, err = openssl(args, stdin=data)
+    if code != 0:
+        raise PkiError('Could not read certificate {0}: {1}'.format(
+            path or '', _last_error(err)))
+
+    info = {}
+    pubkey = []
+    for line in out.splitlines():
+        if pubkey or line.startswith('-----BEGIN'):
+            pubkey.append(line)
+            continue
+        name, _, value = line.partition('=')
+        name = name.strip().lower()
+        value = value.strip()
+        if name in ('subject', 'issuer', 'serial'):
+            info[name] = value
+        elif name.endswith('fingerprint'):
+            info['fingerprint'] = value.replace(':', '').lower()
+        elif name == 'notafter':
+            info['not_after'] = parse_time(value)
+    info['pubkey_id'] = pubkey_id('\n'.join(pubkey))
+    return info
+
+
+def read_cert_pem(path):
+    """PEM of a certificate file, converted from DER if need be.
+
+    :rtype: str
+    :raises PkiError: if a DER certificate could not be converted
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if '-----BEGIN' in data:
+        return data
+    code, out, err = openssl(['x509', '-inform', 'DER', '-outform', 'PEM'],
+                             stdin=data)
+    if code != 0:
+        raise PkiError('Could not read certificate {0}: {1}'.format(
+            path, _last_error(err)))
+    return out
+
+
+def subject_cn(subject):
+    """Common name of an RFC 2253 subject, or ''."""
+    for rdn in subject.split(','):
+        name, _, value = rdn.partition('=')
+        if name.strip().upper() == 'CN':
+            return value.strip()
+    return ''
+
+
+def key_info(path, passphrase='', der=False):
+    """Parse a private key file, decrypting it with passphrase if needed.
+
+    :returns: `pubkey_id` of the key
+    :rtype: dict
+    :raises PkiError: if the key can not be read or decrypted
+    """
+    args = ['pkey', '-in', path, '-pubout', '-passin', passin_arg()]
+    if der:
+        args += ['-inform', 'DER']
+    code, out, err = openssl(args, passphrase=passphrase or '')
+    if code != 0:
+        raise PkiError('Could not read key {0}: {1}'.format(
+            path, _last_error(err)))
+    return {'pubkey_id': pubkey_id(out)}
+
+
+def key_encrypted(path):
+    """Whether a PEM private key file is passphrase-protected."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return 'ENCRYPTED' in data
+
+
+def pkcs12_extract(path, passphrase, certs=True):
+    """Extract the client certificate, or key, of a PKCS#12 bundle as PEM.
+
+    :param certs: Extract the client certificate if True, else the key
+    :rtype: str
+    :raises PkiError: if the bundle can not be decrypted with passphrase
+    """
+    args = ['pkcs12', '-in', path, '-passin', passin_arg()]
+    args += ['-nokeys', '-clcerts'] if certs else ['-nocerts', '-nodes']
+    code, out, err = openssl(args, passphrase=passphrase or '')
+    if code != 0:
+        # OpenSSL 3 needs -legacy for bundles with e.g. RC2 encryption
+        code, out, err = openssl(args + ['-legacy'],
+                                 passphrase=passphrase or '')
+    if code != 0:
+        raise PkiError('Could not read PKCS#12 bundle {0}: {1}'.format(
+            path, _last_error(err)))
+    return out
+
+
+def pkcs12_info(path, passphrase):
+    """Parse the client certificate of a PKCS#12 bundle, see cert_info().
+
+    Also includes `key_pubkey_id`, of the bundle's private key, and
+    `cert_pem`, the PEM of its client certificate.
+
+    :rtype: dict
+    :raises PkiError: if the bundle can not be decrypted with passphrase
+    """
+    cert_pem = pkcs12_extract(path, passphrase)
+    info = cert_info(data=cert_pem)
+    info['cert_pem'] = cert_pem
+    code, out, err = openssl(['pkey', '-pubout'],
+                             stdin=pkcs12_extract(path, passphrase,
+                                                  certs=False))
+    if code != 0:
+        raise PkiError('Could not read key of PKCS#12 bundle {0}: {1}'.format(
+            path, _last_error(err)))
+    info['key_pubkey_id'] = pubkey_id(out)
+    return info
+
+
+def verify_chain(cert_pem, issuer_path):
+    """Verify a certificate's signature chain against an issuer file.
+
+    Validity dates are not checked here; compare cert_info()['not_after'].
+    The issuer need not be a self-signed root.
+
+    :param cert_pem: PEM of the certificate to verify
+    :type cert_pem: str
+    :param issuer_path: PEM, or DER, file of issuer certificate(s)
+    :type issuer_path: str
+    :raises PkiError: if the certificate was not issued by the issuer(s)
+    """
+    cafile = None
+    if is_der(issuer_path):
+        # openssl verify only reads PEM issuers
+        cafile = tempfile.NamedTemporaryFile(suffix='.pem')
+        cafile.write(read_cert_pem(issuer_path))
+        cafile.flush()
+    try:
+        code, out, err = openssl(
+            ['verify', '-no_check_time', '-partial_chain', '-CAfile',
+             cafile.name if cafile else issuer_path], stdin=cert_pem)
+    finally:
+        if cafile is not None:
+            cafile.close()
+    if code != 0 or 'OK' not in out:
+        raise PkiError('Certificate not verified against {0}: {1}'.format(
+            issuer_path, _last_error(out + err)))
+
+
+def file_kind(path):
+    """Guess the kind of PKI component a file holds, from extension/content.
+
+    :returns: CERT, KEY, PKCS12, or None if not a PKI component
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in PKCS12_EXTS:
+        return PKCS12
+    if ext not in PEM_EXTS + DER_EXTS:
+        return None
+    with open(path, 'rb') as f:
+        data = f.read(65536)
+    if '-----BEGIN' in data:
+        if 'PRIVATE KEY-----' in data:
+            return KEY
+        if 'CERTIFICATE-----' in data:
+            return CERT
+        return None
+    if ext in DER_EXTS:
+        name = os.path.basename(path)
+        return KEY if ext == '.key' or '_key' in name else CERT
+    return None
+
+
+def is_der(path):
+    """Whether a PKI component file is DER, rather than PEM, encoded."""
+    with open(path, 'rb') as f:
+        return '-----BEGIN' not in f.read(65536)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""Plans of the changes that bring a user's auth db and settings up to date.
+
+A plan is made from the current state, before anything is changed:
+
+- the stored auth configs (configIds(), provider types, and, for those of the
+  desired config's name and type, their decrypted content)
+- the settings keys of the spec's connections (`/Qgis/connections-<kind>/...`
+  and `/Qgis/<KIND>/<name>/...`), and every connection's `/authid` key
+
+and holds only what differs: whether the auth config is stored, updated or
+already unchanged, duplicate configs of the same name and type to remove
+(with any other connections linked to them relinked), and the settings keys to
+write. Applying a plan makes those changes and no others, with one settings
+sync(), or none; a re-run where nothing changed reads, and writes nothing.
+
+Given the connections' LinkIndex (see authlinks.py), only the spec's keys are
+read, and the connections linked to duplicates are found in the index, rather
+than by reading every settings key.
+
+`populate_qgis_creds.py --plan` prints each user's plan before applying it,
+and `--dry-run` prints it without applying it.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/16'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import authstore
+from authlinks import is_link
+from authstore import STORED, UPDATED, UNCHANGED
+from connections import AUTHID
+from settings_writer import normalize
+
+
+def _key(key):
+    # QSettings.allKeys() lists keys without their leading '/'
+    return key.lstrip('/')
+
+
+class Plan(object):
+    """Changes to bring one auth db, and its settings, up to date."""
+
+    def __init__(self, config, action, configid=None, removals=None,
+                 writes=None, unchanged=0):
+        """Constructor.
+
+        :param config: Desired auth config
+        :type config: QgsAuthConfigBase
+        :param action: authstore.STORED, UPDATED or UNCHANGED
+        :type action: str
+        :param configid: ID of the stored config to update or reuse, or None
+            when storing anew
+        :type configid: str
+        :param removals: IDs of duplicate configs to remove
+        :type removals: list of str
+        :param writes: (key, value) settings to write, with AUTHID for the
+            ID of the stored config
+        :type writes: list of tuple
+        :param unchanged: Number of settings already up to date
+        :type unchanged: int
+        """
+        self.config = config
+        self.action = action
+        self.configid = configid
+        self.removals = removals or []
+        self.writes = writes or []
+        self.unchanged = unchanged
+
+    @property
+    def empty(self):
+        """Whether there is nothing to change."""
+        return (self.action == UNCHANGED and not self.removals
+                and not self.writes)
+
+    def describe(self):
+        """Plan as text, one change per line.
+
+        :rtype: list of str
+        """
+        name = self.config.name()
+        if self.action == STORED:
+            lines = ['store config: {0}'.format(name)]
+        elif self.action == UPDATED:
+            lines = ['update config: {0} ({1})'.format(self.configid, name)]
+        else:
+            lines = ['keep config: {0} ({1})'.format(self.configid, name)]
+        lines.extend('remove duplicate config: {0}'.format(configid)
+                     for configid in self.removals)
+        for key, value in self.writes:
+            lines.append('write setting: {0} = {1}'.format(
+                key, (self.configid or '<new config ID>') if value is AUTHID
+                else normalize(value)))
+        lines.append('settings unchanged: {0}'.format(self.unchanged))
+        return lines
+
+
+def read_state(settings, keys, links=True):
+    """Current values of settings keys, and of every connection's /authid.
+
+    :param settings: Settings to read, or None for none yet
+    :type settings: QSettings
+    :param keys: Keys to read, e.g. those of a compiled spec
+    :type keys: iterable of str
+    :param links: Also read every connection's /authid, from all keys
+    :type links: bool
+    :returns: Normalized values of the keys that exist, by key without its
+        leading '/'
+    :rtype: dict
+    """
+    if settings is None:
+        return {}
+    if not links:
+        return dict((_key(key), normalize(settings.value(key)))
+                    for key in keys if settings.contains(key))
+    wanted = set(_key(key) for key in keys)
+    state = {}
+    for key in settings.allKeys():
+        if key in wanted or is_link(key):
+            state[key] = normalize(settings.value(key))
+    return state
+
+
+def plan_user(authm, settings, config, writes, links=None):
+    """Plan the changes that store config and apply a spec's settings.
+
+    :param authm: Auth manager with the master password set, or None for an
+        auth db that does not exist yet
+    :type authm: QgsAuthManager
+    :param settings: Settings alongside the auth db, or None for none yet
+    :type settings: QSettings
+    :param config: Desired auth config
+    :type config: QgsAuthConfigBase
+    :param writes: Compiled writes, see connections.compile_spec()
+    :type writes: list of tuple
+    :param links: Index of the connections linked to each config, to find
+        those of duplicates in (default: read every settings key)
+    :type links: authlinks.LinkIndex
+    :rtype: Plan
+    """
+    if authm is None:
+        action, configid, removals = STORED, None, []
+    else:
+        action, configid, removals = authstore.match_config(authm, config)
+    state = read_state(settings, [key for key, _ in writes],
+                       links=links is None)
+
+    planned = []
+    unchanged = 0
+    speckeys = set()
+    for key, value in writes:
+        speckeys.add(_key(key))
+        current = state.get(_key(key))
+        if value is AUTHID:
+            uptodate = configid is not None and current == normalize(configid)
+        else:
+            uptodate = current is not None and current == normalize(value)
+        if uptodate:
+            unchanged += 1
+        else:
+            planned.append((key, value))
+
+    # Connections outside the spec, linked to a duplicate, follow the config
+    # that is kept
+    if links is not None:
+        linked = set()
+        if settings is not None:
+            for duplicate in removals:
+                linked.update(_key(key)
+                              for key in links.keys(duplicate, settings))
+    else:
+        removed = set(normalize(configid) for configid in removals)
+        linked = set(key for key in state
+                     if is_link(key) and state[key] in removed)
+    for key in sorted(linked - speckeys):
+        planned.append(('/' + key, AUTHID))
+
+    return Plan(config, action, configid, removals, planned, unchanged)
+
+
+def apply_plan(authm, settings, plan, links=None):
+    """Make the changes of a plan, and only those.
+
+    :param authm: Auth manager the plan was made with, master password set
+    :type authm: QgsAuthManager
+    :param settings: Settings the plan was made with
+    :type settings: QSettings
+    :type plan: Plan
+    :param links: Index of linked connections to keep up to date, if any
+    :type links: authlinks.LinkIndex
+    :returns: ID of the stored config
+    :rtype: str
+    :raises authstore.StoreError: if a config can not be stored, updated or
+        removed
+    """
+    configid = authstore.commit_config(authm, plan.config, plan.action,
+                                       plan.configid)
+    for duplicate in plan.removals:
+        if not authm.removeAuthenticationConfig(duplicate):
+            raise authstore.StoreError(
+                'Failed to remove duplicate config {0}'.format(duplicate))
+    for key, value in plan.writes:
+        settings.setValue(key, configid if value is AUTHID else value)
+        if links is not None and value is AUTHID:
+            links.set(key, configid)
+    if plan.writes:
+        settings.sync()
+    return configid
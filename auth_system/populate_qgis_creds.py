@@ -16,6 +16,41 @@ and generate an initial qgis-auth.db file, or use an existing one, for their
 QGIS install, which will be pre-populated with configurations to known network
 resources, using existing PKI credentials, which may be passphrase-protected.
 
+In batch mode (--batch), script will read a CSV or JSON lines manifest of
+users, with columns `user`, `masterpass` and (optionally) `pkidir`, and
+generate a separate qgis-auth.db and QGIS2.ini for each user, under
+--out-dir/<user>/. The users are spread across a pool of worker processes, each
+of which boots QGIS once. The manifest, which may be stdin ('-'), is streamed
+through the pool, and each user's result is reported as it arrives, with
+--results as JSON lines; see manifest.py.
+
+Master passwords not given on the command line, or in the manifest, can be
+looked up with --masterpass-source, in a file, environment variables or an
+LDAP directory, batched for a whole manifest; see passwords.py.
+
+With --trace, the timing of each phase of the run (QGIS startup, auth db init,
+master password, planning, applying the plan) is written to a file, as
+JSON lines or Chrome trace events; see timing.py. With --profile, or the
+POPULATE_PROFILE environment variable, the run is profiled; see profiling.py.
+
+Before anything is changed, the changes needed are planned from the current
+state of the auth db and settings, and only those are made, so re-runs where
+nothing changed write nothing; --plan prints each user's plan, and --dry-run
+prints it without making any change; see planner.py.
+
+Concurrent runs on the same auth db are held apart, one at a time, and a run
+that fails because QGIS, or another run, has the db locked is retried after a
+jittered backoff (--lock-retries); see scheduler.py.
+
+Each batch user's result is appended to a journal in --out-dir, with their
+config ID and a hash of their output, synced to disk in batches; a batch run
+that died, or was interrupted, can be run again with --resume, and skips the
+users already done; see journal.py.
+
+With --check, nothing is provisioned: the arguments, connection spec, manifest
+and users' PKI components are validated, and what would be done is reported,
+without loading QGIS.
+
 By default QGIS works with the OpenSSL key stores. On Windows, you can try using
 the `wincertstore` package to retrieve existing client certs, via OIDs for
 enhanced key usages like CLIENT_AUTH, then export those to PEM or PKCS#12
@@ -36,92 +71,92 @@ __revision__ = '$Format:%H$'
 import os
 import sys
 import argparse
+import json
+import multiprocessing
 import tempfile
+import threading
+import time
 
-from qgis.core import (
-    QgsApplication,
-    QgsAuthType,
-    QgsAuthManager,
-    QgsAuthConfigBasic,
-    QgsAuthConfigPkiPaths,
-    QgsAuthConfigPkiPkcs12
+import authlinks
+import authstore
+import backends
+import connections
+import passwords
+import planner
+import profiling
+import scheduler
+import timing
+from backends import AUTHDBNAME, SETTINGSNAME, QgisBackend
+from configcache import CachingAuthManager
+from journal import JOURNALNAME, Journal, output_hash
+from manifest import (
+    DEFAULT_PASSPHRASE,
+    ManifestError,
+    iter_manifest,
+    make_record,
+    manifest_passphrases,
+    read_manifest,
+    record_error
 )
+from passwords import PasswordError, fill_passwords
+from preflight import check_credentials, format_table, preflight
+from pki_index import PkiIndex, index_path, user_credentials
+from scheduler import LockError, Scheduler
 
-from PyQt4.QtCore import *
-from PyQt4.QtGui import *
+# QGIS (qgis.core and PyQt4) is only imported once a run needs it, by
+# backends.QgisBackend, so --help, --check and bad arguments do not pay for
+# loading its libraries.
 
 HOME = os.path.expanduser('~')
 USER = os.path.split(HOME)[-1]
 PKIDATA = os.path.join(HOME, 'PKI')  # pre-defined default location
 
+# Provisioning session of a batch worker process, booted once per process
+_WORKER_SESSION = None
 
-def main(user='', masterpass='', pkidir=''):
-    if not user or not pkidir:
-        print 'Missing parameters for user or pkidir'
-        print '  user: {0}'.format(user)
-        print '  pkidir: {0}'.format(pkidir)
-        sys.exit(1)
-
-    # Get user's pre-defined QGIS master password.
-    # This can be done in a variety of ways, depending upon user auth
-    # systems (queried from LDAP, etc.), using a variety of Python packages.
-    # As an example, we could hard-code define it as a standard password that
-    # must be changed later by user, OR if we know the user's defined password.
-    #masterpass = some_user_query_function(user)
-
-    if not masterpass:
-        print 'Master password must be defined'
-        sys.exit(1)
-
-    print 'Setting authentication config using:'
-    print '  user: {0}'.format(user)
-    print '  master pass: {0}'.format(masterpass)
-    print '  pkidir: {0}'.format(pkidir)
-
-    # instantiate QGIS
-    qgsapp = QgsApplication(sys.argv, True)
+# Lock-aware scheduler of a batch worker process's jobs
+_WORKER_SCHEDULER = None
 
-    # These are for referencing the correct QSettings for the QGIS app
-    QCoreApplication.setOrganizationName('QGIS')
-    QCoreApplication.setOrganizationDomain('qgis.org')
-    QCoreApplication.setApplicationName('QGIS2')
+# Manifest records read ahead of the batch workers, per worker process
+WINDOW_PER_PROCESS = 4
 
-    # Initialize QGIS
-    qgsapp.initQgis()
-    print qgsapp.showSettings()
+# Batch results between --results progress lines
+PROGRESS_EVERY = 100
 
-    # Initialize the auth system
-    # noinspection PyArgumentList
-    authm = QgsAuthManager.instance()
-    authm.init()
-    # This will use the standard qgis-auth.db location, but the rest of this
-    # script will not work if qgis-auth.db already exists and you do NOT know
-    # the user's chosen master password already stored in it.
 
-    # If you want to generate individual qgis-auth.db for a list of users, just
-    # do:
-    #   authdbdir = tempfile.mkdtemp()
-    #   authm.init(authdbdir)
-    # Note that the saved paths to PKI components in the db will need to be the
-    # same absolute paths as when the auth db is copied to the user's machine.
-    # This means paths with the current user's name in them will not work when
-    # copied to a different user (unless names are the same).
+class PopulateError(Exception):
+    """Raised when a user's auth config or settings could not be populated."""
+    pass
 
-    print authm.authenticationDbPath()
 
-    # Define pool of users and loop through them, or use the current user.
-    #users = ["user"]
-    #for user in users:
+def unlock(authm, user, masterpass):
+    """Set, and verify, the master password of the current auth db.
 
+    :raises PopulateError: if the master password can not be verified
+    """
     # Set master password for QGIS and (optionally) store it in qgis-auth.db.
     # This also verifies the set password against by comparing password
     # against its derived hash stored in auth db.
-    if not authm.setMasterPassword(masterpass, True):
-        print 'Failed to verify or store/verify password'
-        sys.exit(1)
+    with timing.phase('master_password', user=user):
+        verified = authm.setMasterPassword(masterpass, True)
+    if not verified:
+        raise PopulateError('Failed to verify or store/verify password')
+
+
+def build_config(user, pkidir, creds=None, passphrase=DEFAULT_PASSPHRASE,
+                 configcls=None):
+    """The user's auth config, as it should be stored.
 
-    # Now that we have a master password set/stored, we can use it to
-    # encrypt and store authentication configurations.
+    :param creds: User's PKI component paths (default: guessed from pkidir),
+        see user_credentials()
+    :type creds: dict
+    :param passphrase: Passphrase of user's PKI bundle
+    :type passphrase: str
+    :param configcls: PKCS#12 config class of the auth manager's backend
+        (default: QgsAuthConfigPkiPkcs12)
+    :rtype: QgsAuthConfigPkiPkcs12
+    :raises PopulateError: if the user's PKI components are not found
+    """
     # There are 3 configurations that can be stored (as of Nov 2014), and
     # examples of their initialization are in the unit tests for
     # QGIS-with-PKI source tree (test_qgsauthsystem_api-sample.py).
@@ -135,6 +170,8 @@ def main(user='', masterpass='', pkidir=''):
 
     # NOTE: PKI file components need to *already* exist on the filesystem in a
     # location that doesn't change, as their paths are stored in the auth db.
+    if creds is None:
+        creds = user_credentials(user, pkidir)
 
     # # Basic configuration
     # configname = 'My Basic Config'
@@ -152,102 +189,741 @@ def main(user='', masterpass='', pkidir=''):
     # config = QgsAuthConfigPkiPaths()
     # config.setName(configname)
     # config.setUri('https://localhost:8443')
-    # config.setCertId(os.path.join(pkidir, '{0}_cert.pem'.format(user)))
-    # config.setKeyId(os.path.join(pkidir, '{0}_key.pem'.format(user)))
+    # config.setCertId(creds['cert'])
+    # config.setKeyId(creds['key'])
     # config.setKeyPassphrase('')  # will need queried and set per user
-    # config.setIssuerId(os.path.join(pkidir, 'ca.pem'))
-    # config.setIssuerSelfSigned(True)
+    # config.setIssuerId(creds['issuer'])
+    # config.setIssuerSelfSigned(creds['issuer_self_signed'])
 
     # ^^  OR  vv
 
     # PKI-PKCS#12 (*.p12-based) configuration
+    if not creds['bundle'] or not creds['issuer']:
+        raise PopulateError('No PKCS#12 bundle or issuer found for {0}'
+                            .format(user))
     configname = 'My PKI PKCS#12 Config'
-    config = QgsAuthConfigPkiPkcs12()
+    config = (configcls or
+              QgisBackend().config_class(backends.PKI_PKCS12))()
     config.setName(configname)
     config.setUri('https://localhost:8443')
-    config.setBundlePath(os.path.join(pkidir, '{0}.p12'.format(user)))
-    config.setBundlePassphrase('password')  # will need queried and set per user
-    config.setIssuerPath(os.path.join(pkidir, 'ca.pem'))
-    config.setIssuerSelfSigned(True)
-
-    # Securely store the config in database (encrypted with master password)
-    res = authm.storeAuthenticationConfig(config)
-    if not res[0]:
-        print 'Failed to store {0} config'.format(configname)
+    config.setBundlePath(creds['bundle'])
+    config.setBundlePassphrase(passphrase)  # may be queried and set per user
+    config.setIssuerPath(creds['issuer'])
+    config.setIssuerSelfSigned(creds['issuer_self_signed'])
+    return config
+
+
+class ProvisionSession(object):
+    """Long-lived QGIS instance that provisions many per-user auth dbs.
+
+    QGIS is booted once, then the auth manager is switched between target
+    database directories, clearing master password state in between::
+
+      with ProvisionSession() as session:
+          for user, masterpass, pkidir in users:
+              session.provision(user, masterpass, pkidir,
+                                os.path.join(outdir, user))
+    """
+
+    def __init__(self, qgsapp=None, specpath=connections.DEFAULT_SPEC,
+                 pkiindex=None, backend=None, configcache=None):
+        """Constructor.
+
+        :param qgsapp: Already initialized QGIS app to reuse, if any
+        :type qgsapp: QgsApplication
+        :param specpath: Connection spec to define for each user
+        :type specpath: str
+        :param pkiindex: Index to look up users' PKI components in, instead
+            of guessing their file names
+        :type pkiindex: PkiIndex
+        :param backend: Auth and settings backend (default: QgisBackend, of
+            qgsapp), see backends.py
+        :param configcache: Cache to read fully loaded configs through, for
+            sessions that load the same configs repeatedly (default: none)
+        :type configcache: configcache.ConfigCache
+        """
+        self.backend = backend or QgisBackend(qgsapp)
+        self.pkiindex = pkiindex
+        self.configcache = configcache
+        # Compile once; the same writes are applied for every user
+        self.writes = connections.compile_spec(connections.load_spec(specpath))
+        self.authm = None
+        """:type : QgsAuthManager"""
+        self.authdbdir = None
+        # Linked connections of the current settings, see authlinks.py
+        self.links = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        """Start the backend (e.g. boot QGIS), and get its auth manager."""
+        self.backend.start()
+        if self.authm is None:
+            self.authm = self.backend.auth_manager()
+            if self.configcache is not None:
+                self.authm = CachingAuthManager(self.authm, self.configcache)
+        return self
+
+    def switch_db(self, authdbdir):
+        """Point the auth manager at the qgis-auth.db in another directory.
+
+        :param authdbdir: Directory for qgis-auth.db, created if needed
+        :type authdbdir: str
+        """
+        if not os.path.exists(authdbdir):
+            os.makedirs(authdbdir)
+        # Forget the previous db's master password before switching
+        self.authm.clearMasterPassword()
+        with timing.phase('auth_init'):
+            self.authm.init(authdbdir)
+        self.authdbdir = authdbdir
+        self.links = None
+
+    def settings_path(self):
+        """Path of the INI settings that live alongside the current auth db.
+
+        :rtype: str
+        """
+        return os.path.join(self.authdbdir, SETTINGSNAME)
+
+    def settings(self):
+        """INI settings that live alongside the current auth db.
+
+        :rtype: QSettings
+        """
+        return self.backend.settings(self.settings_path())
+
+    def load_links(self):
+        """Index of the connections linked to each config, in settings().
+
+        Reused from its saved copy while the settings file is unchanged.
+
+        :rtype: authlinks.LinkIndex
+        """
+        if self.links is None:
+            self.links = authlinks.load_index(self.settings(),
+                                              self.settings_path())
+        return self.links
+
+    def plan(self, user, masterpass, pkidir, authdbdir,
+             passphrase=DEFAULT_PASSPHRASE):
+        """Plan the changes to the auth db and settings in authdbdir.
+
+        An auth db that does not exist yet is not created, but planned from
+        empty. Otherwise, the master password is left set, for provision().
+
+        :rtype: planner.Plan
+        :raises PopulateError: if the user's PKI components are not found,
+            or the master password can not be verified
+        """
+        config = build_config(
+            user, pkidir, user_credentials(user, pkidir, self.pkiindex),
+            passphrase, self.backend.config_class(backends.PKI_PKCS12))
+        if not self.backend.db_exists(authdbdir):
+            self.authdbdir = None
+            return planner.plan_user(None, None, config, self.writes)
+
+        self.switch_db(authdbdir)
+        unlock(self.authm, user, masterpass)
+        with timing.phase('plan', user=user):
+            return planner.plan_user(self.authm, self.settings(), config,
+                                     self.writes, self.load_links())
+
+    def provision(self, user, masterpass, pkidir, authdbdir,
+                  passphrase=DEFAULT_PASSPHRASE, dryrun=False,
+                  describe=False):
+        """Populate the auth db and settings in authdbdir for one user.
+
+        The changes needed are planned first, see plan(), and only those are
+        made.
+
+        :param dryrun: Only plan the changes, without making them
+        :type dryrun: bool
+        :param describe: Also return the plan as text lines, as `plan`
+        :type describe: bool
+        :returns: Auth config `configid` (None if it is yet to be stored)
+            and store `action`, the number of settings keys `written` and
+            `skipped`, and of duplicate configs `removed`
+        :rtype: dict
+        :raises PopulateError: if the user could not be provisioned
+        """
+        try:
+            plan = self.plan(user, masterpass, pkidir, authdbdir, passphrase)
+            configid = plan.configid
+            if not dryrun:
+                if self.authdbdir != authdbdir:
+                    # A new auth db, created only now
+                    self.switch_db(authdbdir)
+                    unlock(self.authm, user, masterpass)
+                with timing.phase('apply', user=user):
+                    links = self.load_links()
+                    configid = planner.apply_plan(self.authm, self.settings(),
+                                                  plan, links)
+                    if plan.writes:
+                        authlinks.save_index(links, self.settings_path())
+        except authstore.StoreError as e:
+            raise PopulateError(str(e))
+        finally:
+            self.authm.clearMasterPassword()
+        result = {'configid': configid, 'action': plan.action,
+                  'written': len(plan.writes), 'skipped': plan.unchanged,
+                  'removed': len(plan.removals)}
+        if describe:
+            result['plan'] = plan.describe()
+        return result
+
+    def close(self):
+        """Clear master password state and shut down QGIS."""
+        if self.authm is not None:
+            self.authm.clearMasterPassword()
+            self.authm = None
+        self.backend.close()
+
+
+def main(user='', masterpass='', pkidir='',
+         specpath=connections.DEFAULT_SPEC, pkiindex=False,
+         passphrase=DEFAULT_PASSPHRASE, source=None, dryrun=False,
+         lockretries=scheduler.RETRIES, describe=False):
+    if not user or not pkidir:
+        print 'Missing parameters for user or pkidir'
+        print '  user: {0}'.format(user)
+        print '  pkidir: {0}'.format(pkidir)
         sys.exit(1)
 
-    # The auth config has been given a unique ID from the auth system when it
-    # was stored; retrieve it, so it can be linked to a custom server config.
-    configid = config.id()
+    # Get user's pre-defined QGIS master password.
+    # This can be done in a variety of ways, depending upon user auth
+    # systems (queried from LDAP, etc.); see passwords.py for the sources.
+    # As an example, we could hard-code define it as a standard password that
+    # must be changed later by user, OR if we know the user's defined password.
+    if not masterpass and source is not None:
+        try:
+            masterpass = source.get(user)
+        except PasswordError as e:
+            print e
+            sys.exit(1)
+
+    if not masterpass:
+        print 'Master password must be defined'
+        sys.exit(1)
+
+    try:
+        writes = connections.compile_spec(connections.load_spec(specpath))
+    except connections.SpecError as e:
+        print e
+        sys.exit(1)
+
+    print 'Setting authentication config using:'
+    print '  user: {0}'.format(user)
+    print '  master pass: {0}'.format(masterpass)
+    print '  pkidir: {0}'.format(pkidir)
+
+    creds = None
+    if pkiindex:
+        # Look up the user's PKI components in an index of pkidir, which only
+        # re-parses files changed since the last run
+        index = PkiIndex(pkidir, passphrases=[passphrase])
+        try:
+            print '  pki index: {0}'.format(index.update())
+            creds = index.credentials(user)
+        finally:
+            index.close()
+
+    # instantiate QGIS
+    backend = QgisBackend().start()
+    print backend.qgsapp.showSettings()
+
+    # Initialize the auth system
+    authm = backend.auth_manager()
+    with timing.phase('auth_init'):
+        authm.init()
+    # This will use the standard qgis-auth.db location, but the rest of this
+    # script will not work if qgis-auth.db already exists and you do NOT know
+    # the user's chosen master password already stored in it.
+
+    # If you want to generate individual qgis-auth.db for a list of users, use
+    # the --batch mode, which does:
+    #   authdbdir = os.path.join(outdir, user)
+    #   authm.init(authdbdir)
+    # Note that the saved paths to PKI components in the db will need to be the
+    # same absolute paths as when the auth db is copied to the user's machine.
+    # This means paths with the current user's name in them will not work when
+    # copied to a different user (unless names are the same).
 
-    # If the user does not have the OWS connection(s) that this auth config is
-    # meant to connect to, define now.
-    # NOTE: this assumes the individual connections do not already exist. If the
-    # connection settings do exist, this will OVERWRITE them.
+    print authm.authenticationDbPath()
 
-    settings = QSettings()  # get application's settings object
+    settings = backend.settings()  # get application's settings object
 
     print 'settings.fileName(): {0}'.format(settings.fileName())
     print 'settings.organizationName(): {0}'.format(settings.organizationName())
     print 'settings.applicationName(): {0}'.format(settings.applicationName())
 
-    # WMS
-    connkind = 'WMS'
-    connname = 'My {0} SSL Server'.format(connkind)
-    credskey = '/Qgis/{0}/{1}'.format(connkind, connname)
-    connkey = '/Qgis/connections-{0}/{1}'.format(connkind.lower(), connname)
-
-    settings.setValue(credskey + '/authid', configid)  # link to auth config
-    settings.setValue(credskey + '/username', '')  # deprecated; use auth config
-    settings.setValue(credskey + '/password', '')  # deprecated; use auth config
-
-    settings.setValue(connkey + '/url', 'https://localhost:8443/geoserver/wms')
-
-    # Optional settings for WMS (these are the defaults)
-    # dpiMode: 0=Off, 1=QGIS, 2=UMN, 4=GeoServer, 7=All (default)
-    settings.setValue(connkey + '/dpiMode', 7)
-    settings.setValue(connkey + '/ignoreAxisOrientation', False)
-    settings.setValue(connkey + '/ignoreGetFeatureInfoURI', False)
-    settings.setValue(connkey + '/ignoreGetMapURI', False)
-    settings.setValue(connkey + '/invertAxisOrientation', False)
-    settings.setValue(connkey + '/referer', '')
-    settings.setValue(connkey + '/smoothPixmapTransform', False)
-
-    # WCS
-    connkind = 'WCS'
-    connname = 'My {0} SSL Server'.format(connkind)
-    credskey = '/Qgis/{0}/{1}'.format(connkind, connname)
-    connkey = '/Qgis/connections-{0}/{1}'.format(connkind.lower(), connname)
-
-    settings.setValue(credskey + '/authid', configid)  # link to auth config
-    settings.setValue(credskey + '/username', '')  # deprecated; use auth config
-    settings.setValue(credskey + '/password', '')  # deprecated; use auth config
-
-    settings.setValue(connkey + '/url', 'https://localhost:8443/geoserver/wcs')
-
-    # Optional settings for WCS (these are the defaults)
-    # dpiMode: 0=Off, 1=QGIS, 2=UMN, 4=GeoServer, 7=All (default)
-    settings.setValue(connkey + '/dpiMode', 7)
-    settings.setValue(connkey + '/ignoreAxisOrientation', False)
-    settings.setValue(connkey + '/ignoreGetMapURI', False)
-    settings.setValue(connkey + '/invertAxisOrientation', False)
-    settings.setValue(connkey + '/referer', '')
-    settings.setValue(connkey + '/smoothPixmapTransform', False)
-
-    # WFS
-    connkind = 'WFS'
-    connname = 'My {0} SSL Server'.format(connkind)
-    credskey = '/Qgis/{0}/{1}'.format(connkind, connname)
-    connkey = '/Qgis/connections-{0}/{1}'.format(connkind.lower(), connname)
-
-    settings.setValue(credskey + '/authid', configid)  # link to auth config
-    settings.setValue(credskey + '/username', '')  # deprecated; use auth config
-    settings.setValue(credskey + '/password', '')  # deprecated; use auth config
-
-    settings.setValue(connkey + '/url', 'https://localhost:8443/geoserver/wfs')
-
-    # Optional settings for WFS (these are the defaults)
-    settings.setValue(connkey + '/referer', '')
+    # A running QGIS may have the auth db locked; wait and retry if so
+    dbpath = authm.authenticationDbPath()
+    sched = Scheduler(retries=lockretries)
+    try:
+        plan, configid = sched.run(
+            os.path.dirname(dbpath), _plan_and_apply, authm, settings,
+            settings.fileName(), user, masterpass, pkidir, creds, passphrase,
+            writes, dryrun, _print_plan if describe or dryrun else None,
+            dbpath=dbpath)
+    except (PopulateError, LockError) as e:
+        print e
+        sys.exit(1)
+    if sched.last['retries']:
+        print 'auth db locked: retried {retries} times, waited ' \
+              '{backoff_wait:.2f} s'.format(**sched.last)
+    if dryrun:
+        print 'dry run: nothing changed'
+        return
+
+    print 'auth config {0}: {1}'.format(configid, plan.action)
+    print 'settings written: {0}, unchanged: {1}'.format(len(plan.writes),
+                                                         plan.unchanged)
+
+
+def _print_plan(plan):
+    print 'plan:'
+    for line in plan.describe():
+        print '  {0}'.format(line)
+
+
+def _plan_and_apply(authm, settings, settingspath, user, masterpass, pkidir,
+                    creds, passphrase, writes, dryrun=False, show=None,
+                    configcls=None):
+    """Plan the changes to provision a user, and apply them unless dryrun.
+
+    :param settingspath: INI file of settings, whose saved index of linked
+        connections is used, as in a batch, see authlinks.load_index()
+    :type settingspath: str
+    :param show: Called with the plan, before it is applied
+    :type show: callable
+    :param configcls: PKCS#12 config class, see build_config()
+
+    :returns: Plan, and the ID of the stored config (None for a dry run), as
+        (plan, configid)
+    :rtype: tuple
+    :raises PopulateError: if the user could not be provisioned
+    """
+    try:
+        unlock(authm, user, masterpass)
+        config = build_config(user, pkidir, creds, passphrase, configcls)
+        # Read the current configs and settings, and plan only the changes;
+        # links are reused from the saved index while settings are unchanged,
+        # rather than read from every settings key
+        links = authlinks.load_index(settings, settingspath)
+        with timing.phase('plan', user=user):
+            plan = planner.plan_user(authm, settings, config, writes, links)
+        if show is not None:
+            show(plan)
+        if dryrun:
+            return plan, None
+        with timing.phase('apply', user=user):
+            configid = planner.apply_plan(authm, settings, plan, links)
+            if plan.writes:
+                authlinks.save_index(links, settingspath)
+        return plan, configid
+    except authstore.StoreError as e:
+        raise PopulateError(str(e))
+    finally:
+        authm.clearMasterPassword()
+
+
+def batch_worker_init(specpath, index=None, trace=(None, timing.JSONL),
+                      profile=None, lockretries=scheduler.RETRIES):
+    """Boot QGIS once for the lifetime of a batch worker process.
+
+    :param index: PKI directory, and path of its (already updated) index, to
+        look up users' PKI components in, as (pkidir, indexpath)
+    :type index: tuple
+    :param trace: Trace file and format of the parent process, to append this
+        worker's phases to, see timing.trace_config()
+    :type trace: tuple
+    :param profile: Profiler output prefix of the parent process, to profile
+        this worker to, see profiling.start_worker()
+    :type profile: str
+    :param lockretries: Retries of a user whose auth db is locked
+    :type lockretries: int
+    """
+    global _WORKER_SESSION, _WORKER_SCHEDULER  # pylint: disable=W0603
+    if profile:
+        profiling.start_worker(profile)
+    if trace[0] and not timing.TRACER.enabled:
+        timing.start(trace[0], trace[1], truncate=False)
+    if _WORKER_SESSION is None:
+        # Only read: the parent updated it, with the candidate passphrases
+        pkiindex = PkiIndex(*index) if index else None
+        _WORKER_SESSION = ProvisionSession(specpath=specpath,
+                                           pkiindex=pkiindex).start()
+    _WORKER_SCHEDULER = Scheduler(retries=lockretries)
+
+
+def batch_provision(job):
+    """Provision one user's auth db and settings, in a batch worker process.
+
+    :param job: (record, outdir, options), as yielded to the pool; with
+        the `checkfirst` option, the user's PKI components are validated
+        first (see preflight.py, with the `allow_expired` option), and the
+        user is only provisioned if they pass; `dryrun` and `describe` are
+        passed to ProvisionSession.provision()
+    :type job: tuple
+    :returns: Per-user result, with `user`, `ok` and either `error` (and,
+        for a failed pre-flight, its `checks`) or the keys returned by
+        ProvisionSession.provision()
+    :rtype: dict
+    """
+    record, outdir, options = job
+    user = record['user']
+    result = {'user': user, 'ok': False}
+    error = record_error(record)
+    if error:
+        result['error'] = error
+        return result
+
+    if options.get('checkfirst'):
+        with timing.phase('preflight', user=user):
+            checks = check_credentials(
+                user_credentials(user, record['pkidir'],
+                                 _WORKER_SESSION.pkiindex),
+                record['passphrase'], options.get('allow_expired', False))
+        failed = [c for c in checks if not c[1]]
+        if failed:
+            result['error'] = 'Pre-flight {0} failed: {1}'.format(
+                failed[0][0], failed[0][2])
+            result['checks'] = checks
+            return result
+
+    authdbdir = os.path.join(outdir, user)
+    args = (user, record['masterpass'], record['pkidir'], authdbdir,
+            record['passphrase'], options.get('dryrun', False),
+            options.get('describe', False))
+    try:
+        with timing.phase('provision', user=user):
+            if options.get('dryrun') or _WORKER_SCHEDULER is None:
+                result.update(_WORKER_SESSION.provision(*args))
+            else:
+                # One job per auth db at a time, retried if it is locked
+                try:
+                    result.update(_WORKER_SCHEDULER.run(
+                        authdbdir, _WORKER_SESSION.provision, *args,
+                        dbpath=os.path.join(authdbdir, AUTHDBNAME)))
+                finally:
+                    result.update(_WORKER_SCHEDULER.last)
+    except Exception as e:
+        # e.g. a corrupt auth db: fail this user, not the whole batch
+        result['error'] = str(e) or e.__class__.__name__
+        return result
+
+    result['ok'] = True
+    if not options.get('dryrun'):
+        result['hash'] = output_hash(authdbdir)
+    return result
+
+
+_PLAN_VERBS = {authstore.STORED: 'store', authstore.UPDATED: 'update',
+               authstore.UNCHANGED: 'keep'}
+
+
+class BatchReport(object):
+    """Reporter of batch results, written as each user's result arrives.
+
+    As text, one OK/FAIL line per user, then a summary line. As JSON lines
+    (--results), one `result` event per user, a `progress` event every
+    PROGRESS_EVERY users, with the counts and rate so far, and a final
+    `summary` event; other messages then go to stderr, so that stdout can be
+    piped to another program.
+    """
+
+    def __init__(self, out=None, jsonl=False, every=PROGRESS_EVERY,
+                 dryrun=False):
+        self.out = out or sys.stdout
+        self.jsonl = jsonl
+        self.dryrun = dryrun
+        self.every = every
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.lock_wait = 0.0
+        self.started = time.time()
+
+    def _event(self, event, **values):
+        values['event'] = event
+        self.out.write(json.dumps(values, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def _counts(self):
+        elapsed = time.time() - self.started
+        return {'done': self.done, 'ok': self.done - self.failed,
+                'failed': self.failed, 'skipped': self.skipped,
+                'elapsed': round(elapsed, 3),
+                'rate': round(self.done / elapsed, 2) if elapsed else 0.0,
+                'retries': self.retries,
+                'lock_wait': round(self.lock_wait, 3)}
+
+    def note(self, msg):
+        if self.jsonl:
+            sys.stderr.write(msg + '\n')
+        else:
+            self.out.write(msg + '\n')
+            self.out.flush()
+
+    def start(self, manifest, outdir, processes):
+        if self.jsonl:
+            self._event('start', manifest=manifest, outdir=outdir,
+                        processes=processes)
+        else:
+            self.note('{0} users from {1} into {2}, using {3} '
+                      'processes'.format(
+                          'Planning' if self.dryrun else 'Provisioning',
+                          manifest, outdir, processes))
+        self.started = time.time()
+
+    def skip(self, user):  # pylint: disable=W0613
+        """Count a user skipped, as already done in a resumed run."""
+        self.skipped += 1
+
+    def result(self, result):
+        self.done += 1
+        if not result['ok']:
+            self.failed += 1
+        self.retries += result.get('retries', 0)
+        self.lock_wait += (result.get('lock_wait', 0.0) +
+                           result.get('backoff_wait', 0.0))
+        if self.jsonl:
+            self._event('result', **result)
+            if self.done % self.every == 0:
+                self._event('progress', **self._counts())
+        elif result['ok'] and self.dryrun:
+            self.note('  PLAN  {0}: {1} config, remove {removed} duplicates, '
+                      'write {written} settings (unchanged: {skipped})'
+                      .format(result['user'], _PLAN_VERBS[result['action']],
+                              **result))
+        elif result['ok']:
+            self.note('  OK    {user}: {configid} {action} (settings '
+                      'written: {written}, unchanged: {skipped})'
+                      .format(**result))
+        else:
+            self.note('  FAIL  {0}: {1}'.format(result['user'],
+                                               result['error']))
+        if not self.jsonl:
+            for line in result.get('plan') or []:
+                self.note('          {0}'.format(line))
+
+    def finish(self):
+        """Report the summary.
+
+        :returns: Number of users that failed
+        :rtype: int
+        """
+        if self.jsonl:
+            self._event('summary', **self._counts())
+        else:
+            self.note('{0} {1} of {2} users'.format(
+                'Planned' if self.dryrun else 'Provisioned',
+                self.done - self.failed, self.done))
+            if self.skipped:
+                self.note('Skipped {0} users already done'.format(
+                    self.skipped))
+            if self.retries or self.lock_wait >= 0.01:
+                self.note('Waited {0:.2f} s on locked auth dbs, with {1} '
+                          'retries'.format(self.lock_wait, self.retries))
+        return self.failed
+
+
+class JobWindow(object):
+    """Bound on the jobs read ahead of a pool's workers.
+
+    A pool's task thread drains its input as fast as it can, which, for a
+    streamed manifest, would read it all into the pool's queue. Jobs fed
+    through a window wait for a free slot instead, and a slot is freed as
+    each result is consumed.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._slots = threading.Semaphore(size)
+
+    def feed(self, jobs):
+        for job in jobs:
+            self._slots.acquire()
+            yield job
+
+    def done(self):
+        self._slots.release()
+
+    def close(self):
+        # Unblock the task thread, so a terminating pool can join it
+        for _ in range(self.size):
+            self._slots.release()
+
+
+def batch_main(manifest, outdir, pkidir='', processes=None,
+               specpath=connections.DEFAULT_SPEC, pkiindex=False,
+               checkfirst=False, allow_expired=False, report=None,
+               source=None, dryrun=False, describe=False,
+               lockretries=scheduler.RETRIES, journalpath=None,
+               resume=False, passphrases=(DEFAULT_PASSPHRASE,)):
+    """Provision every user in a manifest, across a pool of processes.
+
+    The manifest is streamed (see manifest.iter_manifest()) through the pool,
+    with at most WINDOW_PER_PROCESS records per worker read ahead, so memory
+    use does not grow with the number of users, and results are reported as
+    they arrive. A failure for one user, whatever it raised, is reported and
+    does not stop the batch. With pkiindex, users' PKI components are looked
+    up in an index of pkidir, which is updated once, before any worker
+    starts, trying the manifest's passphrases, and passphrases, on encrypted
+    files. With checkfirst, each user's PKI components are validated first
+    (see preflight.py), and only a user that passes is provisioned. With
+    source, the master passwords missing from the manifest are looked up, a
+    batch of records at a time.
+    Each user's changes are planned first, and only those made; with
+    describe, each result has its plan, and with dryrun, nothing is changed
+    (see ProvisionSession.provision()). A user whose auth db is locked, e.g.
+    by a concurrent run, is retried up to lockretries times, see
+    scheduler.py. Unless dryrun, each result is appended to a journal (see
+    journal.py), and with resume, the users already done in it are skipped.
+
+    :param manifest: Path to CSV or JSON lines manifest, or '-' for stdin
+    :type manifest: str
+    :param report: Reporter of results (default: text, to stdout)
+    :type report: BatchReport
+    :param source: Source of users' master passwords, see passwords.py
+    :type source: passwords.PasswordSource
+    :param journalpath: Journal file (default: JOURNALNAME in outdir)
+    :type journalpath: str
+    :param passphrases: Candidate passphrases of encrypted PKI files, besides
+        the manifest's, for the index of pkidir
+    :type passphrases: list of str
+    :returns: Number of users that failed
+    :rtype: int
+    :raises ManifestError: on a manifest line that can not be parsed
+    :raises PasswordError: if the password source can not be read
+    """
+    report = report or BatchReport()
+    # fail early on a bad spec, rather than in every worker
+    connections.compile_spec(connections.load_spec(specpath))
+    if not os.path.exists(outdir) and not dryrun:
+        os.makedirs(outdir)
+    processes = processes or multiprocessing.cpu_count()
+
+    index = None
+    if pkiindex:
+        # Kept in outdir, as pkidir may be read-only
+        index = (pkidir, index_path(pkidir, None if dryrun else outdir))
+        pki = PkiIndex(*index, passphrases=manifest_passphrases(
+            manifest, passphrases))
+        try:
+            with timing.phase('pki_index'):
+                report.note('PKI index: {0}'.format(pki.update()))
+        finally:
+            pki.close()
+
+    journal = None
+    if not dryrun:
+        journal = Journal(journalpath or os.path.join(outdir, JOURNALNAME),
+                          resume)
+        if len(journal):
+            report.note('Resuming: {0} users already done in {1}'.format(
+                len(journal), journal.path))
+
+    def pending(records):
+        for record in records:
+            if journal is not None and journal.is_done(record['user']):
+                report.skip(record['user'])
+                continue
+            yield record
+
+    report.start(manifest, outdir, processes)
+    window = JobWindow(processes * WINDOW_PER_PROCESS)
+    records = pending(iter_manifest(manifest, pkidir))
+    if source is not None:
+        records = fill_passwords(records, source)
+    options = {'checkfirst': checkfirst, 'allow_expired': allow_expired,
+               'dryrun': dryrun, 'describe': describe}
+    jobs = ((record, outdir, options) for record in records)
+    pool = multiprocessing.Pool(processes, initializer=batch_worker_init,
+                                initargs=(specpath, index,
+                                          timing.trace_config(),
+                                          profiling.active_prefix(),
+                                          lockretries))
+    try:
+        for result in pool.imap_unordered(batch_provision,
+                                          window.feed(jobs)):
+            window.done()
+            if journal is not None:
+                journal.record(result)
+            report.result(result)
+        pool.close()
+    except BaseException:
+        window.close()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if journal is not None:
+            journal.close()
+
+    return report.finish()
+
+
+def check_main(records, outdir=None, specpath=connections.DEFAULT_SPEC,
+               pkidir='', pkiindex=False, processes=None,
+               allow_expired=False, passphrases=()):
+    """Validate a run, and report what it would do, without loading QGIS.
+
+    The connection spec is compiled, and every user's PKI components are
+    validated (see preflight.py), as for a --batch --preflight run.
+
+    :param records: Records of the users to check, see manifest.make_record()
+    :type records: list of dict
+    :param outdir: Batch output directory, or None for a single user's QGIS
+        settings and auth db
+    :type outdir: str
+    :param passphrases: Candidate passphrases of encrypted PKI files, besides
+        the records', for the index of pkidir
+    :type passphrases: list of str
+    :returns: Number of users that would fail
+    :rtype: int
+    :raises connections.SpecError: if the connection spec is bad
+    """
+    spec = connections.load_spec(specpath)
+    writes = connections.compile_spec(spec)
+
+    index = None
+    if pkiindex:
+        index = PkiIndex(pkidir, index_path(pkidir, outdir), sorted(set(
+            [r['passphrase'] for r in records if r['passphrase']] +
+            list(passphrases))))
+    try:
+        if index is not None:
+            with timing.phase('pki_index'):
+                print 'PKI index: {0}'.format(index.update())
+        with timing.phase('preflight', users=len(records)):
+            results = preflight(records, index, processes, allow_expired)
+    finally:
+        if index is not None:
+            index.close()
+
+    print format_table(results)
+    passed = [r for r, res in zip(records, results) if res['ok']]
+    print 'Would provision {0} of {1} users:'.format(len(passed),
+                                                   len(records))
+    for record in passed:
+        if outdir is None:
+            print '  {0}: default QGIS auth db and settings'.format(
+                record['user'])
+        else:
+            print '  {0}: {1}'.format(record['user'],
+                                      os.path.join(outdir, record['user']))
+    print 'Each with 1 auth config, linked to {0} connections ({1} ' \
+          'settings keys): {2}'.format(
+              len(connections.connection_names(spec)), len(writes),
+              ', '.join(connections.connection_names(spec)))
+    return len(records) - len(passed)
 
 
 def arg_parser():
@@ -269,11 +945,109 @@ def arg_parser():
         '-m', '--masterpass', dest='mpass', metavar='master-password',
         help='QGIS user\'s master password'
     )
+    parser.add_argument(
+        '-s', '--masterpass-source', dest='source', metavar='uri',
+        help='Look up master passwords not otherwise given in file:path, '
+             'env:VAR or ldap://host/base-dn (see passwords.py)'
+    )
     parser.add_argument(
         '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
         default=PKIDATA,
         help='User\'s PKI components directory path'
     )
+    parser.add_argument(
+        '-c', '--connections', dest='specpath', metavar='spec-path',
+        default=connections.DEFAULT_SPEC,
+        help='JSON or YAML spec of OWS connections to link to the auth config '
+             '(default: connections.json)'
+    )
+    parser.add_argument(
+        '-x', '--pki-index', dest='pkiindex', action='store_true',
+        help='Look up users\' PKI components in an index of the PKI '
+             'directory, updating it first, instead of guessing file names'
+    )
+    parser.add_argument(
+        '-k', '--pki-passphrase', dest='pkipass', metavar='passphrase',
+        default=DEFAULT_PASSPHRASE,
+        help='Passphrase of user\'s PKI bundle, and with --pki-index, a '
+             'candidate passphrase of encrypted PKI files for all users '
+             '(default: sample data\'s)'
+    )
+    parser.add_argument(
+        '-b', '--batch', dest='manifest', metavar='manifest-path',
+        help='CSV or JSON lines manifest of users (user,masterpass'
+             '[,pkidir]) to generate individual auth dbs and settings for, '
+             'or - to read it from stdin'
+    )
+    parser.add_argument(
+        '-r', '--results', dest='results', action='store_true',
+        help='Batch: write per-user results and progress to stdout as JSON '
+             'lines, as they arrive'
+    )
+    parser.add_argument(
+        '-o', '--out-dir', dest='outdir', metavar='directory-path',
+        help='Batch output directory, with a subdirectory per user '
+             '(default: new temporary directory)'
+    )
+    parser.add_argument(
+        '--journal', dest='journal', metavar='journal-path',
+        help='Batch: journal of users\' results (default: {0} in the output '
+             'directory)'.format(JOURNALNAME)
+    )
+    parser.add_argument(
+        '--resume', dest='resume', action='store_true',
+        help='Batch: skip the users already done in the journal of an '
+             'earlier run, into the same --out-dir'
+    )
+    parser.add_argument(
+        '-p', '--preflight', dest='preflight', action='store_true',
+        help='Batch: validate each user\'s PKI components and passphrase '
+             'first, and only provision the user if they pass'
+    )
+    parser.add_argument(
+        '-e', '--allow-expired', dest='allowexpired', action='store_true',
+        help='Batch or check: do not fail pre-flight for expired '
+             'certificates'
+    )
+    parser.add_argument(
+        '-j', '--processes', dest='processes', metavar='count', type=int,
+        help='Batch worker processes (default: number of CPU cores)'
+    )
+    parser.add_argument(
+        '-P', '--plan', dest='plan', action='store_true',
+        help='Print each user\'s plan, of the changes to their auth db and '
+             'settings, before making them'
+    )
+    parser.add_argument(
+        '--dry-run', dest='dryrun', action='store_true',
+        help='Print each user\'s plan, with QGIS, without making any change'
+    )
+    parser.add_argument(
+        '--lock-retries', dest='lockretries', metavar='count', type=int,
+        default=scheduler.RETRIES,
+        help='Retries of a user whose auth db is locked by QGIS or another '
+             'run (default: {0})'.format(scheduler.RETRIES)
+    )
+    parser.add_argument(
+        '-n', '--check', dest='check', action='store_true',
+        help='Only validate the arguments, spec, manifest and users\' PKI '
+             'components, and report what would be done, without QGIS'
+    )
+    parser.add_argument(
+        '--profile', dest='profile', metavar='output-prefix',
+        help='Profile the run, writing output-prefix.pstats and (on POSIX) '
+             'output-prefix.folded collapsed stacks, for flame graphs'
+    )
+    parser.add_argument(
+        '-t', '--trace', dest='trace', metavar='trace-path',
+        help='Write the timing of each phase of the run to file'
+    )
+    parser.add_argument(
+        '--trace-format', dest='traceformat', choices=timing.FORMATS,
+        default=timing.JSONL,
+        help='Trace file format: JSON lines, or Chrome trace events '
+             '(default: jsonl)'
+    )
     return parser
 
 if __name__ == '__main__':
@@ -284,11 +1058,78 @@ if __name__ == '__main__':
         print 'PKI components directory not defined.'
         sys.exit(1)
 
+    if args.trace:
+        timing.start(args.trace, args.traceformat)
+    if args.profile:
+        profiling.start(args.profile)
+    else:
+        profiling.start_from_env()
+
     pkid = os.path.realpath(args.pkidir)
+    pwsource = None
+    if args.source:
+        try:
+            pwsource = passwords.source_from_uri(args.source)
+        except PasswordError as e:
+            print e
+            sys.exit(1)
+
+    if args.check:
+        try:
+            if args.manifest:
+                recs = read_manifest(args.manifest, pkid)
+            else:
+                recs = [make_record({'user': args.user,
+                                     'masterpass': args.mpass,
+                                     'passphrase': args.pkipass}, pkid)]
+            if pwsource is not None:
+                recs = list(fill_passwords(recs, pwsource))
+            failures = check_main(
+                recs, os.path.realpath(args.outdir) if args.outdir else (
+                    '<new temporary directory>' if args.manifest else None),
+                specpath=args.specpath, pkidir=pkid, pkiindex=args.pkiindex,
+                processes=args.processes, allow_expired=args.allowexpired,
+                passphrases=[args.pkipass])
+        except (connections.SpecError, ManifestError, PasswordError,
+                IOError) as e:
+            print e
+            sys.exit(1)
+        sys.exit(1 if failures else 0)
+
+    if args.manifest:
+        if args.resume and not (args.outdir or args.journal):
+            print >> sys.stderr, '--resume needs the --out-dir of the run ' \
+                                 'to resume'
+            sys.exit(1)
+        outd = args.outdir or tempfile.mkdtemp(prefix='qgis-auth-')
+        try:
+            failures = batch_main(args.manifest, os.path.realpath(outd),
+                                  pkidir=pkid, processes=args.processes,
+                                  specpath=args.specpath,
+                                  pkiindex=args.pkiindex,
+                                  checkfirst=args.preflight,
+                                  allow_expired=args.allowexpired,
+                                  report=BatchReport(jsonl=args.results,
+                                                     dryrun=args.dryrun),
+                                  source=pwsource, dryrun=args.dryrun,
+                                  describe=args.plan or args.dryrun,
+                                  lockretries=args.lockretries,
+                                  journalpath=args.journal,
+                                  resume=args.resume,
+                                  passphrases=[args.pkipass])
+        except (connections.SpecError, ManifestError, PasswordError,
+                IOError) as e:
+            print >> sys.stderr, e
+            sys.exit(1)
+        sys.exit(1 if failures else 0)
+
     if not os.path.isabs(pkid) or not os.path.exists(pkid):
         print 'PKI components directory not resolved to existing absolute path.'
         sys.exit(1)
 
-    main(user=args.user, masterpass=args.mpass, pkidir=pkid)
+    main(user=args.user, masterpass=args.mpass, pkidir=pkid,
+         specpath=args.specpath, pkiindex=args.pkiindex,
+         passphrase=args.pkipass, source=pwsource, dryrun=args.dryrun,
+         lockretries=args.lockretries, describe=args.plan)
 
     sys.exit(0)
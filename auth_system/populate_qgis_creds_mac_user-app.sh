@@ -32,4 +32,6 @@ export PYTHONPATH=${BQGIS}/Resources/python:/Library/Python/2.7/site-packages:$P
 #export OSG_LIBRARY_PATH=/usr/local/lib/osgPlugins-3.2.0
 
 ### Then, Run Script via QGIs Launch ###
+# Script imports its sibling modules, e.g. connections.py
+export PYTHONPATH=${SCRIPT_DIR}:$PYTHONPATH
 ${QGIS_PREFIX_PATH}/QGIS --code ${SCRIPT_DIR}/populate_qgis_creds_user.py
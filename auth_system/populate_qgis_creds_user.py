@@ -17,6 +17,11 @@ existing one, for their QGIS install, which will be pre-populated with
 configurations to known network resources, using existing PKI credentials, which
 may be passphrase-protected.
 
+To time the phases of a run, set the POPULATE_TRACE environment variable to a
+trace file path (and, optionally, POPULATE_TRACE_FORMAT to jsonl or chrome);
+see timing.py. To profile a run, set POPULATE_PROFILE to an output prefix; see
+profiling.py.
+
 Some comments and syntax in this document are instructions to the PyCharm
 Python IDE, e.g. # noinspection PyTypeChecker OR variable type definitions.
 
@@ -31,7 +36,11 @@ __copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = '$Format:%H$'
 
-import sys
+
+import connections
+import profiling
+import timing
+from backends import QgisBackend
 
 from qgis.core import *
 from qgis.gui import *
@@ -52,8 +61,10 @@ def msgbox(msg, kind='warn'):
         QMessageBox.information(None, SCRIPT_TITLE, msg)
 
 
-def main():
+def main(backend=None):
 
+    if backend is None:
+        backend = QgisBackend()
     qgsapp = None
     """:type : QgsApplication"""
     mw = None
@@ -65,19 +76,17 @@ def main():
         mw.raise_()
         mw.activateWindow()
     else:
-        # Instantiate standalone QGIS (no desktop GUI)
-        qgsapp = QgsApplication(sys.argv, True)
-
-        # These are for referencing the correct QSettings for the QGIS app
-        # noinspection PyTypeChecker,PyArgumentList,PyCallByClass
-        QCoreApplication.setOrganizationName('QGIS')
-        # noinspection PyTypeChecker,PyArgumentList,PyCallByClass
-        QCoreApplication.setOrganizationDomain('qgis.org')
-        # noinspection PyTypeChecker,PyArgumentList,PyCallByClass
-        QCoreApplication.setApplicationName('QGIS2')
-
-        # Initialize QGIS
-        qgsapp.initQgis()
+        # Instantiate and initialize standalone QGIS (no desktop GUI), with
+        # the organization and app names of the QGIS app's QSettings
+        qgsapp = backend.start().qgsapp
+
+    # The connections, and their optional settings, are defined in a spec file
+    try:
+        spec = connections.load_spec(connections.DEFAULT_SPEC)
+        writes = connections.compile_spec(spec)
+    except connections.SpecError as e:
+        msgbox("{0}\n\nCanceling script.".format(e))
+        return
 
     dlg = QgsDialog(mw)
     """:type: QgsDialog"""
@@ -106,8 +115,7 @@ def main():
         return
 
     # Initialize the auth system
-    # noinspection PyArgumentList
-    authm = QgsAuthManager.instance()
+    authm = backend.auth_manager()
 
     # noinspection PyUnusedLocal
     creds = None
@@ -117,12 +125,16 @@ def main():
         # noinspection PyUnusedLocal
         creds = QgsCredentialDialog()
         # Set up the authentication system
-        authm.init()
+        with timing.phase('auth_init'):
+            authm.init()
 
     # Ask user for authentication master password and store it in qgis-auth.db.
     # This also verifies the set password by comparing password against its
     # derived hash stored in auth db.
-    if not authm.setMasterPassword(True):
+    # Timed phases that wait on the user are marked interactive.
+    with timing.phase('master_password', interactive=True):
+        verified = authm.setMasterPassword(True)
+    if not verified:
         msgbox("Master password is not defined or does not match existing. "
                "Canceling script.")
         return
@@ -135,7 +147,9 @@ def main():
 
     # Get the user's defined authentication config
     aw = QgsAuthConfigWidget(mw)
-    if not aw.exec_():
+    with timing.phase('store_config', interactive=True):
+        accepted = aw.exec_()
+    if not accepted:
         msgbox("No configuration defined. Canceling script.")
         return
 
@@ -151,7 +165,7 @@ def main():
     # NOTE: this assumes the individual connections do not already exist. If the
     # connection settings do exist, this will OVERWRITE them.
 
-    settings = QSettings()  # get application's settings object
+    settings = backend.settings()  # get application's settings object
 
     qDebug('settings.fileName(): {0}'.format(settings.fileName()))
     qDebug('settings.organizationName(): {0}'
@@ -159,74 +173,24 @@ def main():
     qDebug('settings.applicationName(): {0}'
            .format(settings.applicationName()))
 
-    connections = []
-
-    # WMS
-    connkind = 'WMS'
-    connname = 'My {0} SSL Server'.format(connkind)
-    connections.append(connname)
-    credskey = '/Qgis/{0}/{1}'.format(connkind, connname)
-    connkey = '/Qgis/connections-{0}/{1}'.format(connkind.lower(), connname)
-
-    settings.setValue(credskey + '/authid', configid)  # link to auth config
-    settings.setValue(credskey + '/username', '')  # deprecated; use auth config
-    settings.setValue(credskey + '/password', '')  # deprecated; use auth config
-
-    settings.setValue(connkey + '/url', 'https://localhost:8443/geoserver/wms')
-
-    # Optional settings for WMS (these are the defaults)
-    # dpiMode: 0=Off, 1=QGIS, 2=UMN, 4=GeoServer, 7=All (default)
-    settings.setValue(connkey + '/dpiMode', 7)
-    settings.setValue(connkey + '/ignoreAxisOrientation', False)
-    settings.setValue(connkey + '/ignoreGetFeatureInfoURI', False)
-    settings.setValue(connkey + '/ignoreGetMapURI', False)
-    settings.setValue(connkey + '/invertAxisOrientation', False)
-    settings.setValue(connkey + '/referer', '')
-    settings.setValue(connkey + '/smoothPixmapTransform', False)
-
-    # WCS
-    connkind = 'WCS'
-    connname = 'My {0} SSL Server'.format(connkind)
-    connections.append(connname)
-    credskey = '/Qgis/{0}/{1}'.format(connkind, connname)
-    connkey = '/Qgis/connections-{0}/{1}'.format(connkind.lower(), connname)
-
-    settings.setValue(credskey + '/authid', configid)  # link to auth config
-    settings.setValue(credskey + '/username', '')  # deprecated; use auth config
-    settings.setValue(credskey + '/password', '')  # deprecated; use auth config
-
-    settings.setValue(connkey + '/url', 'https://localhost:8443/geoserver/wcs')
-
-    # Optional settings for WCS (these are the defaults)
-    # dpiMode: 0=Off, 1=QGIS, 2=UMN, 4=GeoServer, 7=All (default)
-    settings.setValue(connkey + '/dpiMode', 7)
-    settings.setValue(connkey + '/ignoreAxisOrientation', False)
-    settings.setValue(connkey + '/ignoreGetMapURI', False)
-    settings.setValue(connkey + '/invertAxisOrientation', False)
-    settings.setValue(connkey + '/referer', '')
-    settings.setValue(connkey + '/smoothPixmapTransform', False)
-
-    # WFS
-    connkind = 'WFS'
-    connname = 'My {0} SSL Server'.format(connkind)
-    connections.append(connname)
-    credskey = '/Qgis/{0}/{1}'.format(connkind, connname)
-    connkey = '/Qgis/connections-{0}/{1}'.format(connkind.lower(), connname)
-
-    settings.setValue(credskey + '/authid', configid)  # link to auth config
-    settings.setValue(credskey + '/username', '')  # deprecated; use auth config
-    settings.setValue(credskey + '/password', '')  # deprecated; use auth config
-
-    settings.setValue(connkey + '/url', 'https://localhost:8443/geoserver/wfs')
-
-    # Optional settings for WFS (these are the defaults)
-    settings.setValue(connkey + '/referer', '')
+    with timing.phase('settings', keys=len(writes)):
+        connections.apply_writes(settings, writes, configid)
 
     msgbox("The authentication configuration was saved and has been assigned "
            "to the following server configurations:\n\n{0}"
-           .format("\n".join(connections)),
+           .format("\n".join(connections.connection_names(spec))),
            kind='info')
 
 
 if __name__ == '__main__':
-    main()
+    # Phases are timed to the file named by POPULATE_TRACE, and the run is
+    # profiled to the prefix named by POPULATE_PROFILE, if set
+    timing.start_from_env()
+    profiler = profiling.start_from_env()
+    try:
+        main()
+    finally:
+        timing.stop()
+        # Within a running QGIS, write output now, not when QGIS exits
+        if profiler is not None:
+            profiler.stop()
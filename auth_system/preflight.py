@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Pre-flight validation of users' PKI components, before any QGIS work.
+
+For each user, in a pool of worker processes, the PKCS#12 bundle (or, if there
+is none, the PEM cert and key pair) is:
+
+- decrypted with the user's passphrase
+- checked that its private key matches its certificate
+- verified against the issuer file
+- checked that its certificate has not expired
+
+A wrong passphrase or mismatched pair then shows up in seconds, as a row of
+the pass/fail table, rather than as a failed storeAuthenticationConfig() after
+QGIS has booted. `populate_qgis_creds.py --preflight` runs this before a
+batch, and only provisions the users that passed.
+
+Does not require QGIS; see pkiutils.py for the `openssl` requirement.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/05'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import multiprocessing
+import time
+
+import pkiutils
+from manifest import ManifestError, read_manifest, record_error
+from pki_index import PkiIndex, user_credentials
+
+# Checks, in the order they are run and tabulated
+CHECKS = ('found', 'decrypt', 'keymatch', 'chain', 'expiry')
+
+
+def check_credentials(creds, passphrase, allow_expired=False, now=None):
+    """Validate a user's PKI components, stopping at the first failed check.
+
+    :param creds: Paths of the user's components, see user_credentials()
+    :type creds: dict
+    :param passphrase: Passphrase of the bundle, or key
+    :type passphrase: str
+    :param allow_expired: Pass the expiry check for expired certificates
+    :type allow_expired: bool
+    :returns: (check, passed, detail) for each check that was run
+    :rtype: list of tuple
+    """
+    results = []
+
+    def run(check, func):
+        try:
+            detail = func()
+        except (pkiutils.PkiError, IOError, OSError) as e:
+            results.append((check, False, str(e)))
+            return False
+        results.append((check, True, detail or ''))
+        return True
+
+    bundle = creds.get('bundle')
+    if bundle and not os.path.exists(bundle):
+        bundle = None
+    issuer = creds.get('issuer')
+
+    def found():
+        missing = []
+        if not bundle and not (creds.get('cert') and creds.get('key')):
+            missing.append('PKCS#12 bundle, or cert and key')
+        for path in ([] if bundle else [creds['cert'], creds['key']]) + \
+                [issuer]:
+            if not path or not os.path.exists(path):
+                missing.append(path or 'issuer')
+        if missing:
+            raise pkiutils.PkiError('Not found: {0}'.format(
+                ', '.join(missing)))
+        return bundle or creds['cert']
+
+    info = {}
+
+    def decrypt():
+        if bundle:
+            info.update(pkiutils.pkcs12_info(bundle, passphrase))
+            info['key_id'] = info['key_pubkey_id']
+        else:
+            info['cert_pem'] = pkiutils.read_cert_pem(creds['cert'])
+            info.update(pkiutils.cert_info(
+                creds['cert'], der=pkiutils.is_der(creds['cert'])))
+            info['key_id'] = pkiutils.key_info(
+                creds['key'], passphrase,
+                der=pkiutils.is_der(creds['key']))['pubkey_id']
+        return info['subject']
+
+    def keymatch():
+        if info['key_id'] != info['pubkey_id']:
+            raise pkiutils.PkiError('Private key does not match certificate')
+
+    def chain():
+        pkiutils.verify_chain(info['cert_pem'], issuer)
+        return info['issuer']
+
+    def expiry():
+        expires = time.strftime('%Y-%m-%d', time.gmtime(info['not_after']))
+        if info['not_after'] < (now or time.time()):
+            if not allow_expired:
+                raise pkiutils.PkiError('Expired {0}'.format(expires))
+            return 'expired {0} (allowed)'.format(expires)
+        return 'expires {0}'.format(expires)
+
+    for check, func in zip(CHECKS, (found, decrypt, keymatch, chain, expiry)):
+        if not run(check, func):
+            break
+    return results
+
+
+def _preflight_user(job):
+    """Validate one user's components, in a pre-flight worker process.
+
+    :param job: (record, creds, allow_expired)
+    :type job: tuple
+    :returns: `user`, `ok`, and `checks` as from check_credentials()
+    :rtype: dict
+    """
+    record, creds, allow_expired = job
+    error = record_error(record)
+    if error:
+        return {'user': record['user'], 'ok': False,
+                'checks': [('found', False, error)]}
+    checks = check_credentials(creds, record['passphrase'], allow_expired)
+    return {'user': record['user'],
+            'ok': len(checks) == len(CHECKS) and all(c[1] for c in checks),
+            'checks': checks}
+
+
+def preflight(records, pkiindex=None, processes=None, allow_expired=False):
+    """Validate the PKI components of every record, in a process pool.
+
+    :param records: Records, as read by manifest.read_manifest()
+    :type records: list of dict
+    :param pkiindex: Up-to-date index to look up users' components in
+    :type pkiindex: PkiIndex
+    :returns: Per-user results, in record order, see _preflight_user()
+    :rtype: list of dict
+    """
+    jobs = [(r, user_credentials(r['user'], r['pkidir'], pkiindex),
+             allow_expired) for r in records]
+    if not jobs:
+        return []
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_preflight_user, jobs,
+                           chunksize=max(1, len(jobs) // (4 * processes)))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def format_table(results):
+    """Pass/fail table of pre-flight results, one row per user.
+
+    :rtype: str
+    """
+    width = max([len('user')] + [len(r['user']) for r in results])
+    lines = ['{0:<{1}}  {2}  {3}'.format(
+        'user', width, '  '.join('{0:<8}'.format(c) for c in CHECKS),
+        'detail')]
+    for r in results:
+        status = dict((c[0], 'pass' if c[1] else 'FAIL') for c in r['checks'])
+        failed = [c for c in r['checks'] if not c[1]]
+        lines.append('{0:<{1}}  {2}  {3}'.format(
+            r['user'], width,
+            '  '.join('{0:<8}'.format(status.get(c, '-')) for c in CHECKS),
+            failed[0][2] if failed else ''))
+    return '\n'.join(lines)
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Validate users\' PKI bundles or cert/key pairs, and '
+                    'their passphrases, before provisioning with QGIS.'
+    )
+    parser.add_argument(
+        'manifest', metavar='manifest-path',
+        help='CSV manifest of users (user,masterpass[,pkidir,passphrase])'
+    )
+    parser.add_argument(
+        '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
+        default='',
+        help='PKI components directory for users without one in manifest'
+    )
+    parser.add_argument(
+        '-x', '--pki-index', dest='pkiindex', action='store_true',
+        help='Look up users\' PKI components in an index of the PKI directory'
+    )
+    parser.add_argument(
+        '-j', '--processes', dest='processes', metavar='count', type=int,
+        help='Worker processes (default: number of CPU cores)'
+    )
+    parser.add_argument(
+        '-e', '--allow-expired', dest='allowexpired', action='store_true',
+        help='Do not fail users with expired certificates'
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    pkid = os.path.realpath(args.pkidir) if args.pkidir else ''
+
+    index = None
+    try:
+        recs = read_manifest(args.manifest, pkid)
+        if args.pkiindex:
+            index = PkiIndex(pkid, passphrases=sorted(
+                set(r['passphrase'] for r in recs if r['passphrase'])))
+            index.update()
+        res = preflight(recs, index, args.processes, args.allowexpired)
+    except (ManifestError, IOError) as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    finally:
+        if index is not None:
+            index.close()
+
+    print format_table(res)
+    failures = len([r for r in res if not r['ok']])
+    print 'Passed {0} of {1} users'.format(len(res) - failures, len(res))
+    sys.exit(1 if failures else 0)
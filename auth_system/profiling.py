@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Profiler mode for provisioning runs.
+
+A Profiler records a whole run, including the Python-side calls into the QGIS
+auth API, and writes, for an output prefix:
+
+- prefix.pstats: cProfile statistics, for `python -m pstats`, snakeviz, etc.
+- prefix.folded: collapsed stacks, one `frame;frame;frame weight` line per
+  stack, for flamegraph.pl or speedscope. Stacks are sampled every few
+  milliseconds of CPU time, on POSIX only; weights are microseconds, so time
+  spent inside a QGIS call is counted against the Python frame making it.
+
+Profiling is started by `populate_qgis_creds.py --profile prefix`, or, without
+changing any command line, by setting the POPULATE_PROFILE environment
+variable to an output prefix, for both populate scripts and the plugin's
+run(). Batch worker processes each write their own prefix.<pid> files.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/12'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import atexit
+import cProfile
+import functools
+import multiprocessing.util
+import signal
+import threading
+import time
+
+PROFILE_VAR = 'POPULATE_PROFILE'
+
+# Seconds of CPU time between stack samples
+SAMPLE_INTERVAL = 0.005
+
+# Profiler of the current process, started by start()
+_ACTIVE = None
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{0} ({1}:{2})'.format(code.co_name,
+                                  os.path.basename(code.co_filename),
+                                  code.co_firstlineno)
+
+
+class Profiler(object):
+    """cProfile, and stack sampling, of the current process."""
+
+    def __init__(self, prefix, interval=SAMPLE_INTERVAL):
+        """Constructor.
+
+        :param prefix: Output path prefix, for .pstats and .folded files
+        :type prefix: str
+        :param interval: Seconds of CPU time between stack samples
+        :type interval: float
+        """
+        self.prefix = prefix
+        self.interval = interval
+        self.stacks = {}
+        self._profile = None
+        self._last = None
+        self._sampling = False
+        self._handler = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self):
+        # Stack sampling needs POSIX interval timers, and the main thread
+        self._sampling = (hasattr(signal, 'setitimer') and
+                          isinstance(threading.current_thread(),
+                                     threading._MainThread))
+        if self._sampling:
+            self._last = time.time()
+            self._handler = signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        return self
+
+    def _sample(self, signum, frame):
+        now = time.time()
+        weight = int((now - self._last) * 1e6)
+        self._last = now
+        names = []
+        while frame is not None:
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + weight
+
+    def discard(self):
+        """Stop profiling, without writing any output."""
+        if not self.running:
+            return
+        self._profile.disable()
+        self._profile = None
+        if self._sampling:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._handler or signal.SIG_DFL)
+
+    def stop(self):
+        """Stop profiling, and write the output files.
+
+        :returns: Paths of the files written
+        :rtype: list of str
+        """
+        if not self.running:
+            return []
+        profile = self._profile
+        self.discard()
+
+        paths = [self.prefix + '.pstats']
+        profile.dump_stats(paths[0])
+        if self._sampling:
+            paths.append(self.prefix + '.folded')
+            with open(paths[1], 'wb') as f:
+                for stack in sorted(self.stacks):
+                    f.write('{0} {1}\n'.format(stack, self.stacks[stack]))
+        return paths
+
+
+def start(prefix):
+    """Profile the rest of the current process, writing output at exit.
+
+    :rtype: Profiler
+    """
+    global _ACTIVE  # pylint: disable=W0603
+    _ACTIVE = Profiler(prefix).start()
+    atexit.register(_ACTIVE.stop)
+    return _ACTIVE
+
+
+def start_worker(prefix):
+    """Profile a pool worker process, writing prefix.<pid> files at exit.
+
+    Pool workers exit without running atexit handlers, so output is written by
+    a multiprocessing finalizer instead. A profiler inherited from the parent
+    process, on fork, is discarded.
+
+    :rtype: Profiler
+    """
+    global _ACTIVE  # pylint: disable=W0603
+    if _ACTIVE is not None:
+        _ACTIVE.discard()
+    _ACTIVE = Profiler('{0}.{1}'.format(prefix, os.getpid())).start()
+    multiprocessing.util.Finalize(_ACTIVE, _ACTIVE.stop, exitpriority=10)
+    return _ACTIVE
+
+
+def active_prefix():
+    """Output prefix of the current process's profiler, or None.
+
+    :rtype: str
+    """
+    return _ACTIVE.prefix if _ACTIVE is not None and _ACTIVE.running else None
+
+
+def start_from_env():
+    """Profile the current process if POPULATE_PROFILE is set, see start().
+
+    :rtype: Profiler
+    """
+    prefix = os.environ.get(PROFILE_VAR)
+    if not prefix:
+        return None
+    return start(prefix)
+
+
+def profiled(func):
+    """Decorate func to be profiled, per call, if POPULATE_PROFILE is set.
+
+    Each call writes POPULATE_PROFILE.<timestamp> files, so repeated runs,
+    e.g. of a plugin's action, do not overwrite each other.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        prefix = os.environ.get(PROFILE_VAR)
+        if not prefix:
+            return func(*args, **kwargs)
+        profiler = Profiler('{0}.{1}'.format(
+            prefix, time.strftime('%Y%m%d-%H%M%S'))).start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.stop()
+    return wrapper
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fleet-wide rotation of users' QGIS master passwords.
+
+Reads a manifest of users (see manifest.py) with their current (`masterpass`)
+and new (`newpass`) master passwords, either of which may instead be looked up
+with --masterpass-source or --newpass-source (see passwords.py), and rotates
+the master password of each user's --out-dir/<user>/qgis-auth.db:
+
+1. the current master password is verified; if only the new one verifies,
+   the db was already rotated, and is left as it is
+2. the auth db is copied, alongside it, to qgis-auth.db.rotate-<stamp>
+3. resetMasterPassword() re-encrypts every config with the new password
+4. the result is verified: the master password is cleared and set again with
+   setMasterPassword(new, True), and every config must fully load
+5. if any step fails, the db is restored from its copy
+
+Users are spread across a pool of worker processes, each booting QGIS once,
+and each db is rotated through a Scheduler (see scheduler.py), so a db locked
+by QGIS, or another run, is retried rather than failed.
+
+Each finished user is appended to a checkpoint file in --out-dir, and synced
+to disk, as their result arrives, with a stamp of the new master password
+they were rotated to; a run that was interrupted can be started again with
+the same arguments, and will skip users already rotated (or found rotated)
+to the same new password. A later rotation, to other passwords, skips
+nobody. --restart ignores, and replaces, the checkpoint.
+
+Requires the same environment variables as populate_qgis_creds.py.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/18'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import hashlib
+import hmac
+import json
+import multiprocessing
+import time
+
+import connections
+import scheduler
+from auth_template import load_configs
+from manifest import ManifestError, iter_manifest, record_error
+from passwords import PasswordError, fill_passwords, source_from_uri
+from populate_qgis_creds import AUTHDBNAME, PopulateError, ProvisionSession
+from scheduler import LockError, Scheduler
+
+CHECKPOINT = '.rotate-checkpoint.jsonl'
+
+# Outcomes of a user's rotation
+ROTATED = 'rotated'
+ALREADY = 'already'
+
+# Rotation session and scheduler of a worker process, made once per process
+_WORKER_SESSION = None
+_WORKER_SCHEDULER = None
+
+
+class RotateError(Exception):
+    """Raised when a user's master password could not be rotated."""
+    pass
+
+
+def backup_path(authdbdir, stamp):
+    """Path of the copy of an auth db made before rotating it.
+
+    :param stamp: Stamp of the rotation run, e.g. 20141218T120000
+    :type stamp: str
+    :rtype: str
+    """
+    return os.path.join(authdbdir, '{0}.rotate-{1}'.format(AUTHDBNAME, stamp))
+
+
+def rotate_error(record):
+    """Why a record can not be rotated, or None if it can.
+
+    :rtype: str
+    """
+    return record_error(record, ('user', 'masterpass', 'newpass'))
+
+
+def _verify(session, masterpass, expected):
+    """Set masterpass anew, and check the expected configs fully load."""
+    authm = session.authm
+    authm.clearMasterPassword()
+    if not authm.setMasterPassword(masterpass, True):
+        raise RotateError('Failed to verify new master password')
+    try:
+        configs = load_configs(session)
+    except PopulateError as e:
+        raise RotateError(str(e))
+    if sorted(configs) != expected:
+        raise RotateError('Configs changed while rotating: {0} != {1}'.format(
+            sorted(configs), expected))
+
+
+def rotate_db(session, authdbdir, masterpass, newpass, stamp):
+    """Rotate the master password of the auth db in authdbdir.
+
+    :type session: ProvisionSession
+    :param stamp: Stamp of the rotation run, for the backup's name
+    :type stamp: str
+    :returns: `action` (ROTATED or ALREADY), number of `configs` and, if
+        rotated, `backup` path
+    :rtype: dict
+    :raises RotateError: if the db is missing, neither password verifies, or
+        the rotation failed (and the db was restored from its backup)
+    """
+    backend = session.backend
+    if not backend.db_exists(authdbdir):
+        raise RotateError('No auth db in {0}'.format(authdbdir))
+    session.switch_db(authdbdir)
+    authm = session.authm
+    try:
+        if not authm.setMasterPassword(masterpass, True):
+            authm.clearMasterPassword()
+            if not authm.setMasterPassword(newpass, True):
+                raise RotateError('Failed to verify current master password')
+            return {'action': ALREADY, 'configs': len(authm.configIds())}
+
+        try:
+            expected = sorted(load_configs(session))
+        except PopulateError as e:
+            raise RotateError(str(e))
+        backup = backup_path(authdbdir, stamp)
+        backend.backup_db(authdbdir, backup)
+        try:
+            # Re-encrypts every config with the new master password
+            if not authm.resetMasterPassword(newpass, True):
+                raise RotateError('Failed to reset master password')
+            _verify(session, newpass, expected)
+        except RotateError as e:
+            authm.clearMasterPassword()
+            backend.restore_db(authdbdir, backup)
+            # Re-read the restored db
+            session.switch_db(authdbdir)
+            if session.configcache is not None:
+                # Restored behind the cache's back
+                session.configcache.invalidate(authm.authenticationDbPath())
+            raise RotateError('{0}; restored from {1}'.format(e, backup))
+    finally:
+        authm.clearMasterPassword()
+    return {'action': ROTATED, 'configs': len(expected), 'backup': backup}
+
+
+class Checkpoint(object):
+    """Append-only JSON lines record of the users a run has finished.
+
+    Only the parent process writes it, one line per result, synced to disk
+    before the next, so an interrupted run loses at most the users in flight.
+    Each result has the `target` stamp of the user's new master password,
+    keyed with a random salt on the checkpoint's first line, so a user is
+    only done for a rotation to the same password, and the password can not
+    be recovered from the file.
+    """
+
+    def __init__(self, path, restart=False):
+        """Constructor.
+
+        :param path: Checkpoint file, created if needed
+        :type path: str
+        :param restart: Forget the users in an existing checkpoint
+        :type restart: bool
+        """
+        self.path = path
+        # Target stamp, by user whose last result was a success
+        self.done = {}
+        self.salt = None
+        if not restart and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self._load(f)
+        if self.salt is None:
+            self.salt = os.urandom(16).encode('hex')
+            self._f = open(path, 'wb')
+            self._write({'salt': self.salt})
+        else:
+            self._f = open(path, 'ab')
+
+    def _load(self, f):
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # torn last line of an interrupted run
+            if self.salt is None:
+                # Without a salt, e.g. of an older run, start anew
+                self.salt = entry.get('salt')
+                if self.salt is None:
+                    return
+            elif entry.get('ok'):
+                self.done[entry['user']] = entry.get('target')
+            else:
+                self.done.pop(entry.get('user'), None)
+
+    def _write(self, entry):
+        self._f.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def target(self, newpass):
+        """Stamp of a new master password, in this checkpoint.
+
+        :rtype: str
+        """
+        if isinstance(newpass, unicode):
+            newpass = newpass.encode('utf-8')
+        return hmac.new(str(self.salt), newpass, hashlib.sha256).hexdigest()
+
+    def is_done(self, record):
+        """Whether a user was rotated to the record's new master password.
+
+        :type record: dict
+        :rtype: bool
+        """
+        target = self.done.get(record['user'])
+        return target is not None and target == self.target(
+            record['newpass'])
+
+    def record(self, result):
+        """Append a user's result; a successful user is done.
+
+        :param result: Result of _rotate_user(), with the `target` stamp
+        :type result: dict
+        """
+        self._write(result)
+        if result['ok']:
+            self.done[result['user']] = result.get('target')
+        else:
+            self.done.pop(result['user'], None)
+
+    def close(self):
+        self._f.close()
+
+
+def _worker_init(specpath, lockretries=scheduler.RETRIES):
+    """Boot QGIS once for the lifetime of a worker process."""
+    global _WORKER_SESSION, _WORKER_SCHEDULER  # pylint: disable=W0603
+    if _WORKER_SESSION is None:
+        _WORKER_SESSION = ProvisionSession(specpath=specpath).start()
+    _WORKER_SCHEDULER = Scheduler(retries=lockretries)
+
+
+def _rotate_user(job):
+    """Rotate one user's master password, in a worker process.
+
+    :param job: (record, outdir, stamp), with the record's `target`, see
+        Checkpoint.target()
+    :returns: `user`, `ok`, `target` and `error`, or the keys returned by
+        rotate_db()
+    :rtype: dict
+    """
+    record, outdir, stamp = job
+    user = record['user']
+    result = {'user': user, 'ok': False, 'target': record.get('target')}
+    error = rotate_error(record)
+    if error:
+        result['error'] = error
+        return result
+
+    authdbdir = os.path.join(outdir, user)
+    try:
+        result.update(_WORKER_SCHEDULER.run(
+            authdbdir, rotate_db, _WORKER_SESSION, authdbdir,
+            record['masterpass'], record['newpass'], stamp,
+            dbpath=os.path.join(authdbdir, AUTHDBNAME)))
+    except (RotateError, LockError, IOError, OSError) as e:
+        result['error'] = str(e)
+        return result
+    finally:
+        result['retries'] = _WORKER_SCHEDULER.last.get('retries', 0)
+    result['ok'] = True
+    return result
+
+
+def rotate_main(manifest, outdir, processes=None,
+                specpath=connections.DEFAULT_SPEC, source=None,
+                newsource=None, restart=False, lockretries=scheduler.RETRIES):
+    """Rotate the master password of every user in a manifest.
+
+    :param source: Source of current master passwords missing in manifest
+    :type source: passwords.PasswordSource
+    :param newsource: Source of new master passwords missing in manifest
+    :type newsource: passwords.PasswordSource
+    :param restart: Ignore the checkpoint of an earlier run
+    :type restart: bool
+    :returns: Number of users that failed
+    :rtype: int
+    """
+    if not os.path.isdir(outdir):
+        raise RotateError('No such output directory: {0}'.format(outdir))
+    checkpoint = Checkpoint(os.path.join(outdir, CHECKPOINT), restart)
+    stamp = time.strftime('%Y%m%dT%H%M%S')
+    records = iter_manifest(manifest)
+    if source is not None:
+        records = fill_passwords(records, source)
+    if newsource is not None:
+        records = fill_passwords(records, newsource, key='newpass')
+
+    counts = {'skipped': 0, ROTATED: 0, ALREADY: 0, 'failed': 0}
+
+    def pending():
+        for record in records:
+            if record['newpass']:
+                if checkpoint.is_done(record):
+                    counts['skipped'] += 1
+                    continue
+                record['target'] = checkpoint.target(record['newpass'])
+            yield record, outdir, stamp
+
+    processes = processes or multiprocessing.cpu_count()
+    print 'Rotating master passwords of users from {0} in {1}, using {2} ' \
+          'processes'.format(manifest, outdir, processes)
+    pool = multiprocessing.Pool(processes, initializer=_worker_init,
+                                initargs=(specpath, lockretries))
+    try:
+        for result in pool.imap_unordered(_rotate_user, pending()):
+            checkpoint.record(result)
+            if result['ok']:
+                counts[result['action']] += 1
+                if result['action'] == ALREADY:
+                    print '  SKIP  {user}: already rotated'.format(**result)
+                else:
+                    print '  OK    {user}: {configs} configs re-encrypted, ' \
+                          'backup {backup}'.format(**result)
+            else:
+                counts['failed'] += 1
+                print '  FAIL  {user}: {error}'.format(**result)
+        pool.close()
+    except BaseException:
+        # e.g. ManifestError: otherwise pool.join() would mask it
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        checkpoint.close()
+
+    print 'Rotated {0}, already rotated {1}, failed {2}, skipped {3} ' \
+          '(checkpoint)'.format(counts[ROTATED], counts[ALREADY],
+                                counts['failed'], counts['skipped'])
+    return counts['failed']
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Rotate the QGIS master password of each user\'s '
+                    'qgis-auth.db under an output directory, keeping a '
+                    'backup of each, and resuming from a checkpoint.'
+    )
+    parser.add_argument(
+        'manifest', metavar='manifest-path',
+        help='CSV or JSON lines manifest of users '
+             '(user,masterpass,newpass), or - for stdin'
+    )
+    parser.add_argument(
+        '-o', '--out-dir', dest='outdir', metavar='directory-path',
+        required=True,
+        help='Directory with a subdirectory of auth db per user'
+    )
+    parser.add_argument(
+        '-s', '--masterpass-source', dest='source', metavar='uri',
+        help='Source of current master passwords missing in manifest: '
+             'file:path, env:VAR or ldap://host/base-dn'
+    )
+    parser.add_argument(
+        '-n', '--newpass-source', dest='newsource', metavar='uri',
+        help='Source of new master passwords missing in manifest, as for '
+             '--masterpass-source'
+    )
+    parser.add_argument(
+        '-j', '--processes', dest='processes', metavar='count', type=int,
+        help='Worker processes (default: number of CPU cores)'
+    )
+    parser.add_argument(
+        '--restart', dest='restart', action='store_true',
+        help='Ignore the checkpoint of an earlier run, and rotate every user'
+    )
+    parser.add_argument(
+        '--lock-retries', dest='lockretries', metavar='count', type=int,
+        default=scheduler.RETRIES,
+        help='Retries of a user whose auth db is locked (default: {0})'
+             .format(scheduler.RETRIES)
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    try:
+        src = source_from_uri(args.source) if args.source else None
+        newsrc = source_from_uri(args.newsource) if args.newsource else None
+        failures = rotate_main(args.manifest, os.path.realpath(args.outdir),
+                               processes=args.processes, source=src,
+                               newsource=newsrc, restart=args.restart,
+                               lockretries=args.lockretries)
+    except (RotateError, ManifestError, PasswordError, IOError) as e:
+        print e
+        sys.exit(1)
+    sys.exit(1 if failures else 0)
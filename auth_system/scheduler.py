@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Lock-aware scheduling of jobs on users' auth dbs.
+
+Several provisioning runs, or a running QGIS, may use the same qgis-auth.db
+(an SQLite database) at once. A Scheduler runs each job on a target directory:
+
+- holding an exclusive lock file in the directory (on POSIX), so at most one
+  job per target runs at a time, across processes; jobs on other targets are
+  not held up. The lock file is removed as the job ends, so none is left in
+  users' directories, or QGIS's own.
+- retrying a job that failed because the auth db was locked, after a
+  jittered, exponentially growing delay, up to a number of retries
+- recording the time spent waiting for the lock file, and in backoff
+
+The QGIS auth API reports a locked db only as a failed call, so after a job
+fails, its auth db is probed, with a non-waiting write transaction, to tell a
+lock from any other failure.
+
+Does not require QGIS.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/17'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import contextlib
+import errno
+import random
+import sqlite3
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCKNAME = '.provision.lock'
+
+# Retries of a job that failed on a locked db
+RETRIES = 5
+
+# Seconds of the first backoff, and the most of any backoff
+BASE_DELAY = 0.05
+MAX_DELAY = 2.0
+
+# Seconds to wait for a target's lock file
+LOCK_TIMEOUT = 60.0
+
+
+class LockError(Exception):
+    """Raised when a target is locked by another process."""
+    pass
+
+
+def is_lock_error(exc):
+    """Whether an exception is an SQLite lock, or LockError.
+
+    :type exc: Exception
+    :rtype: bool
+    """
+    if isinstance(exc, LockError):
+        return True
+    return (isinstance(exc, sqlite3.OperationalError) and
+            ('locked' in str(exc) or 'busy' in str(exc)))
+
+
+def is_locked(dbpath):
+    """Whether another connection holds a lock on an SQLite database.
+
+    :param dbpath: Path to database; a missing one is not locked
+    :type dbpath: str
+    :rtype: bool
+    """
+    if not os.path.exists(dbpath):
+        return False
+    conn = sqlite3.connect(dbpath, timeout=0)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.rollback()
+    except sqlite3.OperationalError as e:
+        if is_lock_error(e):
+            return True
+        raise
+    finally:
+        conn.close()
+    return False
+
+
+class Scheduler(object):
+    """Runs jobs one per target at a time, retrying those that hit locks."""
+
+    def __init__(self, retries=RETRIES, base_delay=BASE_DELAY,
+                 max_delay=MAX_DELAY, lock_timeout=LOCK_TIMEOUT,
+                 sleep=time.sleep, rand=random.random):
+        """Constructor.
+
+        :param retries: Retries of a job that failed on a lock
+        :type retries: int
+        :param base_delay: Seconds of the first backoff
+        :type base_delay: float
+        :param max_delay: Most seconds of any backoff
+        :type max_delay: float
+        :param lock_timeout: Seconds to wait for a target's lock file,
+            before failing with LockError
+        :type lock_timeout: float
+        """
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock_timeout = lock_timeout
+        self._sleep = sleep
+        self._rand = rand
+        # Totals over all jobs run
+        self.jobs = 0
+        self.retried = 0
+        self.lock_wait = 0.0
+        self.backoff_wait = 0.0
+        # Of the last job run
+        self.last = {}
+
+    def backoff(self, attempt):
+        """Seconds to wait before a retry: 'full jitter' exponential backoff.
+
+        :param attempt: Number of the failed attempt, from 0
+        :type attempt: int
+        :rtype: float
+        """
+        return self._rand() * min(self.max_delay,
+                                  self.base_delay * 2 ** attempt)
+
+    def _acquire(self, path):
+        """Open and lock the lock file at path, waiting for it if taken.
+
+        The holder removes the file before unlocking it, so a lock taken on a
+        file that was since removed, or replaced, is let go and taken anew.
+
+        :returns: Locked file, and seconds waited for it
+        :rtype: tuple
+        :raises LockError: if the lock file is not free within lock_timeout
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                if time.time() - start > self.lock_timeout:
+                    raise LockError('Timed out waiting for {0}'.format(path))
+                self._sleep(max(self.backoff(attempt), 0.001))
+                attempt += 1
+                continue
+            try:
+                if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                    return f, time.time() - start
+            except OSError:
+                pass
+            f.close()
+
+    @contextlib.contextmanager
+    def slot(self, target):
+        """Hold the lock file of a target directory, waiting for it if taken.
+
+        Where there is no fcntl (Windows), jobs are not held apart.
+
+        :raises LockError: if the lock file is not free within lock_timeout
+        """
+        if fcntl is None:
+            yield 0.0
+            return
+        try:
+            os.makedirs(target)
+        except OSError as e:
+            # Made by a concurrent job on the same target
+            if e.errno != errno.EEXIST:
+                raise
+        path = os.path.join(target, LOCKNAME)
+        f, waited = self._acquire(path)
+        try:
+            self.lock_wait += waited
+            yield waited
+        finally:
+            # Removed while still locked, see _acquire()
+            os.remove(path)
+            f.close()
+
+    def run(self, target, func, *args, **kwargs):
+        """Run func(*args, **kwargs) as a job on a target directory.
+
+        A job that raises a lock error (see is_lock_error()), or fails while
+        the target's auth db is locked, is retried after a backoff. The job's
+        `lock_wait`, `backoff_wait` (seconds) and `retries` are then in
+        self.last.
+
+        :param target: Directory of the job's auth db and settings
+        :type target: str
+        :param dbpath: Keyword only: auth db to probe for a lock after a
+            failure (default: none)
+        :returns: What func returns
+        :raises: func's last exception, once out of retries
+        """
+        dbpath = kwargs.pop('dbpath', None)
+        self.jobs += 1
+        self.last = {'lock_wait': 0.0, 'backoff_wait': 0.0, 'retries': 0}
+        attempt = 0
+        while True:
+            with self.slot(target) as waited:
+                self.last['lock_wait'] += waited
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:  # pylint: disable=W0703
+                    locked = is_lock_error(e) or (
+                        dbpath is not None and is_locked(dbpath))
+                    if not locked or attempt >= self.retries:
+                        raise
+            # Back off outside of the slot, so other runs can finish
+            delay = self.backoff(attempt)
+            self._sleep(delay)
+            attempt += 1
+            self.retried += 1
+            self.backoff_wait += delay
+            self.last['retries'] = attempt
+            self.last['backoff_wait'] += delay
+
+    def stats(self):
+        """Totals over all jobs run.
+
+        :rtype: dict
+        """
+        return {'jobs': self.jobs, 'retries': self.retried,
+                'lock_wait': self.lock_wait,
+                'backoff_wait': self.backoff_wait}
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Batched, diff-aware writer for QSettings.
+
+Keys are staged first, then compared against the current values, and only the
+keys that changed are written, followed by a single sync(). Re-running a
+provisioning script against up-to-date settings then does not rewrite the
+user's settings file (e.g. QGIS2.ini on a shared home directory) at all.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/02'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+from collections import OrderedDict
+
+
+def normalize(value):
+    """Settings value as it reads back from an INI file.
+
+    INI-backed QSettings return every value as a string, while native backends
+    (plist, registry) keep their types, so compare values in string form.
+
+    :rtype: unicode
+    """
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+class SettingsWriter(object):
+    """Stages settings and writes only the changed ones, with one sync()."""
+
+    def __init__(self, settings):
+        """Constructor.
+
+        :param settings: Application, or per-user INI, settings object
+        :type settings: QSettings
+        """
+        self.settings = settings
+        self._staged = OrderedDict()
+        self.written = 0
+        self.skipped = 0
+
+    def stage(self, key, value):
+        """Queue value to be written to key on commit()."""
+        self._staged[key] = value
+
+    def changed(self):
+        """Staged (key, value) pairs that differ from the current settings.
+
+        :rtype: list of tuple
+        """
+        changed = []
+        for key, value in self._staged.iteritems():
+            if (not self.settings.contains(key) or
+                    normalize(self.settings.value(key)) != normalize(value)):
+                changed.append((key, value))
+        return changed
+
+    def commit(self):
+        """Write the changed staged keys, then sync once if anything changed.
+
+        :returns: Number of keys written and skipped, as (written, skipped)
+        :rtype: tuple
+        """
+        changed = self.changed()
+        for key, value in changed:
+            self.settings.setValue(key, value)
+        if changed:
+            self.settings.sync()
+
+        written = len(changed)
+        skipped = len(self._staged) - written
+        self.written += written
+        self.skipped += skipped
+        self._staged.clear()
+        return written, skipped
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""Phase timers for provisioning runs.
+
+Phases of a run (QGIS startup, auth db init, master password, config storage,
+settings writes) are timed with::
+
+    with timing.phase('store_config', user=user):
+        ...
+
+and, once tracing is started, written to a trace file as they end, one line
+per phase, in either format:
+
+- jsonl: JSON lines of `phase`, `start` (seconds since epoch), `duration`
+  (seconds), `pid` and any phase arguments
+- chrome: Chrome trace events (complete 'X' events, in microseconds), viewable
+  in chrome://tracing or Perfetto
+
+Lines are appended with single O_APPEND writes, so batch worker processes can
+share one trace file. The closing ']' of the Chrome format is optional, and is
+not written. When tracing is off, phase() returns a shared no-op context, so
+instrumented code pays for little more than the call.
+
+Tracing is started with start(), or from the POPULATE_TRACE (trace file path)
+and POPULATE_TRACE_FORMAT (jsonl or chrome) environment variables with
+start_from_env(), for scripts without a command line.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/11'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import json
+import time
+
+JSONL = 'jsonl'
+CHROME = 'chrome'
+FORMATS = (JSONL, CHROME)
+
+TRACE_VAR = 'POPULATE_TRACE'
+TRACE_FORMAT_VAR = 'POPULATE_TRACE_FORMAT'
+
+
+class _NullPhase(object):
+    """Context of a phase that is not traced."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    """Context of a traced phase, written to its tracer on exit."""
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.time() - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.write(self.name, self.start, duration, self.args)
+        return False
+
+
+class Tracer(object):
+    """Writer of timed phases to a trace file; off until started."""
+
+    def __init__(self):
+        self.path = None
+        self.fmt = JSONL
+        self._fd = None
+
+    @property
+    def enabled(self):
+        return self._fd is not None
+
+    def start(self, path, fmt=JSONL, truncate=True):
+        """Start writing phases to path.
+
+        :param fmt: JSONL or CHROME
+        :param truncate: Start a new trace file, rather than appending to
+            the one started by a parent process
+        """
+        if fmt not in FORMATS:
+            raise ValueError('Unknown trace format: {0}'.format(fmt))
+        self.stop()
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if truncate:
+            flags |= os.O_TRUNC
+        self._fd = os.open(path, flags, 0644)
+        self.path = path
+        self.fmt = fmt
+        if truncate and fmt == CHROME:
+            os.write(self._fd, '[\n')
+
+    def stop(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def phase(self, name, **args):
+        """Context timing a phase, with arguments to record alongside it."""
+        if self._fd is None:
+            return _NULL_PHASE
+        return _Phase(self, name, args)
+
+    def write(self, name, start, duration, args):
+        if self._fd is None:
+            return
+        if self.fmt == CHROME:
+            event = {'name': name, 'cat': 'provision', 'ph': 'X',
+                     'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+                     'pid': os.getpid(), 'tid': os.getpid(), 'args': args}
+            line = json.dumps(event, sort_keys=True) + ',\n'
+        else:
+            record = dict(args)
+            record.update(phase=name, start=start, duration=duration,
+                          pid=os.getpid())
+            line = json.dumps(record, sort_keys=True) + '\n'
+        os.write(self._fd, line)
+
+# Tracer of the current process
+TRACER = Tracer()
+
+
+def start(path, fmt=JSONL, truncate=True):
+    """Start tracing the current process, see Tracer.start()."""
+    TRACER.start(path, fmt, truncate)
+
+
+def start_from_env():
+    """Start tracing if POPULATE_TRACE names a trace file.
+
+    :returns: Whether tracing was started
+    :rtype: bool
+    """
+    path = os.environ.get(TRACE_VAR)
+    if not path:
+        return False
+    start(path, os.environ.get(TRACE_FORMAT_VAR) or JSONL)
+    return True
+
+
+def stop():
+    TRACER.stop()
+
+
+def phase(name, **args):
+    """Time a phase of the current process, see Tracer.phase()."""
+    return TRACER.phase(name, **args)
+
+
+def trace_config():
+    """Trace file and format of the current process, for worker processes.
+
+    :returns: (path, fmt), with path None if not tracing
+    :rtype: tuple
+    """
+    return (TRACER.path if TRACER.enabled else None), TRACER.fmt
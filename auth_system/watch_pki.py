@@ -0,0 +1,671 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Daemon that re-provisions users as their PKI components change.
+
+Certificates in a PKI components directory are renewed continually. Rather
+than re-running populate_qgis_creds.py for every user, this watches the
+--pki-dir tree, with inotify on Linux, or else by polling it every --interval
+seconds, and re-provisions only the users whose components changed:
+
+1. changes are gathered until none arrive for --quiet seconds (or for at most
+   --max-delay seconds), so a burst, e.g. a CA-wide renewal writing many
+   files, is handled once
+2. the users affected are those whose bundle, certificate, key or issuer is
+   among the changed files; with --pki-index, only the changed files are
+   re-parsed, and users whose components now resolve to other files (e.g. a
+   renewed bundle under a new name) are affected too
+3. each affected user is re-provisioned, under --out-dir/<user>/, through the
+   planner, so only their PKI config (and only if it differs) and any stale
+   connection links are written; see ProvisionSession.provision()
+
+A burst thus costs work in proportion to the files, and users, that changed.
+Users are re-provisioned one at a time, in this one process, through a
+Scheduler (see scheduler.py), so a db locked by QGIS is retried. With
+--preflight, a user's changed components are validated first, and their db
+left as it is if they fail, e.g. for a renewal that is not yet complete.
+
+Only files under --pki-dir are watched; hidden files and directories are
+ignored. Users whose own pkidir in the manifest is outside of it are reported
+as failed, and not tracked. Runs until interrupted (Ctrl-C, or SIGTERM).
+
+Requires the same environment variables as populate_qgis_creds.py.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+"""
+__author__ = 'Larry Shaffer'
+__date__ = '2014/12/23'
+__copyright__ = 'Copyright 2014, Boundless Spatial, Inc.'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+import os
+import sys
+import argparse
+import errno
+import select
+import signal
+import struct
+import time
+
+import connections
+import scheduler
+from manifest import ManifestError, iter_manifest, record_error
+from passwords import PasswordError, fill_passwords, source_from_uri
+from pki_index import PkiIndex, index_path, user_credentials
+from populate_qgis_creds import (
+    AUTHDBNAME,
+    BatchReport,
+    ProvisionSession
+)
+from preflight import check_credentials
+from scheduler import Scheduler
+
+try:
+    import ctypes
+    import ctypes.util
+    _LIBC = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _LIBC.inotify_init1  # pylint: disable=W0104
+except (ImportError, OSError, AttributeError):
+    _LIBC = None
+
+# Seconds between scans of a polled tree
+POLL_INTERVAL = 2.0
+
+# Seconds without a change that end a burst, and most seconds a burst is held
+QUIET = 2.0
+MAX_DELAY = 30.0
+
+# Credentials, see pki_index.user_credentials(), that are files
+CRED_FILES = ('bundle', 'cert', 'key', 'issuer')
+
+# inotify(7) event masks
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+_WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE)
+
+_EVENT = struct.Struct('iIII')
+
+
+class WatchError(Exception):
+    """Raised when a tree can not be watched."""
+    pass
+
+
+def _hidden(name):
+    return name.startswith('.')
+
+
+class PollingWatcher(object):
+    """Watcher of a tree, by comparing snapshots of its files' stats."""
+
+    method = 'polling'
+
+    def __init__(self, root, interval=POLL_INTERVAL):
+        """Constructor.
+
+        :param root: Directory to watch
+        :type root: str
+        :param interval: Seconds between scans
+        :type interval: float
+        """
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not _hidden(d)]
+            for name in files:
+                if _hidden(name):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_size, st.st_mtime, st.st_ino)
+        return snapshot
+
+    def poll(self, timeout=None):
+        """Wait for files to change.
+
+        :param timeout: Most seconds to wait (default: until a change)
+        :type timeout: float
+        :returns: Paths of files added, changed or removed; empty if none
+            did within timeout
+        :rtype: set of str
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = set(path for path in
+                          set(snapshot) | set(self._snapshot)
+                          if snapshot.get(path) != self._snapshot.get(path))
+            self._snapshot = snapshot
+            if changed:
+                return changed
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return changed
+            time.sleep(wait)
+
+    def close(self):
+        self._snapshot = {}
+
+
+class InotifyWatcher(object):
+    """Watcher of a tree, with an inotify watch on each of its directories.
+
+    Linux only; see inotify(7).
+    """
+
+    method = 'inotify'
+
+    def __init__(self, root):
+        """Constructor.
+
+        :param root: Directory to watch
+        :type root: str
+        :raises WatchError: if inotify is unavailable, or a directory can not
+            be watched, e.g. past fs.inotify.max_user_watches
+        """
+        if _LIBC is None:
+            raise WatchError('inotify is not available')
+        self.root = root
+        self.fd = _LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError('inotify_init1: {0}'.format(
+                os.strerror(ctypes.get_errno())))
+        # Watched directory, by watch descriptor
+        self._dirs = {}
+        try:
+            self._add_tree(root)
+        except WatchError:
+            self.close()
+            raise
+
+    def _add(self, path):
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = _LIBC.inotify_add_watch(self.fd, path, _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOENT:
+                return
+            raise WatchError('Can not watch {0}: {1}'.format(
+                path, os.strerror(err)))
+        self._dirs[wd] = path
+
+    def _add_tree(self, top):
+        for root, dirs, _ in os.walk(top):
+            dirs[:] = [d for d in dirs if not _hidden(d)]
+            self._add(root)
+
+    def _read(self):
+        """Paths of the events queued, without waiting."""
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, size = _EVENT.unpack_from(buf, offset)
+                start = offset + _EVENT.size
+                name = buf[start:start + size].rstrip('\0')
+                offset = start + size
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost: anything may have changed
+                    changed.add(os.path.join(self.root, ''))
+                    continue
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                parent = self._dirs.get(wd)
+                if parent is None or not name or _hidden(name):
+                    continue
+                path = os.path.join(parent, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # Files may be written before it is watched
+                        self._add_tree(path)
+                    changed.add(os.path.join(path, ''))
+                else:
+                    changed.add(path)
+
+    def poll(self, timeout=None):
+        """Wait for files to change, see PollingWatcher.poll().
+
+        A path ending with os.sep stands for every file under that
+        directory, e.g. one that was moved into or out of the tree.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = None if deadline is None else max(0, deadline - time.time())
+            ready = select.select([self.fd], [], [], wait)[0]
+            changed = self._read() if ready else set()
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self._dirs = {}
+
+
+def make_watcher(root, poll=False, interval=POLL_INTERVAL):
+    """Watcher of a tree, with inotify where available, else polling it.
+
+    :param poll: Poll, even where inotify is available
+    :type poll: bool
+    :rtype: InotifyWatcher or PollingWatcher
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(root)
+        except WatchError:
+            pass
+    return PollingWatcher(root, interval)
+
+
+def debounce(watcher, quiet=QUIET, maxdelay=MAX_DELAY, timeout=None,
+             clock=time.time):
+    """Wait for a burst of changes, and for it to settle.
+
+    :param quiet: Seconds without a change that end the burst
+    :type quiet: float
+    :param maxdelay: Most seconds to gather a burst that does not settle
+    :type maxdelay: float
+    :param timeout: Most seconds to wait for the first change (default:
+        until one)
+    :type timeout: float
+    :returns: Paths changed in the burst, see PollingWatcher.poll()
+    :rtype: set of str
+    """
+    changed = watcher.poll(timeout)
+    if not changed:
+        return changed
+    start = clock()
+    while True:
+        left = maxdelay - (clock() - start)
+        if left <= 0:
+            return changed
+        more = watcher.poll(min(quiet, left))
+        if not more:
+            return changed
+        changed |= more
+
+
+def is_watched(path, root):
+    """Whether a path is the watched root directory, or under it.
+
+    :param path: Real path, see os.path.realpath()
+    :type path: str
+    :param root: Real path of the watched directory
+    :type root: str
+    :rtype: bool
+    """
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+class PkiWatch(object):
+    """Tracks users' PKI component files, and re-provisions those changed."""
+
+    def __init__(self, session, records, outdir, sched=None,
+                 checkfirst=False, allow_expired=False):
+        """Constructor.
+
+        :param session: Started session; with a pkiindex, users' components
+            are looked up in it, and it is updated with each change
+        :type session: ProvisionSession
+        :param records: Records of users to track, without errors, see
+            manifest.record_error()
+        :type records: iterable of dict
+        :param outdir: Directory with a subdirectory per user
+        :type outdir: str
+        :param sched: Scheduler of the users' jobs (default: a new one)
+        :type sched: Scheduler
+        :param checkfirst: Validate a user's components before
+            re-provisioning them, see preflight.check_credentials()
+        :type checkfirst: bool
+        """
+        self.session = session
+        self.outdir = outdir
+        self.scheduler = sched or Scheduler()
+        self.checkfirst = checkfirst
+        self.allow_expired = allow_expired
+        self.records = {}
+        # Credentials, by user, and users, by credential file
+        self.creds = {}
+        self.byfile = {}
+        for record in records:
+            self.records[record['user']] = record
+            self._track(record['user'])
+
+    def __len__(self):
+        return len(self.records)
+
+    def _credentials(self, user):
+        return user_credentials(user, self.records[user]['pkidir'],
+                                self.session.pkiindex)
+
+    def _track(self, user, creds=None):
+        self._untrack(user)
+        creds = creds or self._credentials(user)
+        self.creds[user] = creds
+        for field in CRED_FILES:
+            if creds[field]:
+                self.byfile.setdefault(creds[field], set()).add(user)
+
+    def _untrack(self, user):
+        for field in CRED_FILES:
+            path = self.creds.get(user, {}).get(field)
+            users = self.byfile.get(path)
+            if users is not None:
+                users.discard(user)
+                if not users:
+                    del self.byfile[path]
+        self.creds.pop(user, None)
+
+    def affected(self, paths):
+        """Users affected by changed paths.
+
+        Those with a component among the paths, or, with a PKI index, whose
+        components are looked up in other files since; the index is updated
+        with only the changed paths first. Lookups are in memory, and only
+        redone for every user if a file was parsed, or removed.
+
+        :param paths: Changed paths, see PollingWatcher.poll()
+        :type paths: iterable of str
+        :rtype: set of str
+        """
+        paths = set(paths)
+        users = set()
+        for path in paths:
+            users.update(self.byfile.get(path, ()))
+        dirs = tuple(p for p in paths if p.endswith(os.sep))
+        if dirs:
+            for path, found in self.byfile.iteritems():
+                if path.startswith(dirs):
+                    users.update(found)
+
+        index = self.session.pkiindex
+        if index is not None:
+            counts = index.update(paths)
+            if counts['parsed'] or counts['removed']:
+                for user in self.records:
+                    if user not in users and \
+                            self._credentials(user) != self.creds[user]:
+                        users.add(user)
+        return users
+
+    def reprovision(self, user):
+        """Re-provision one user, from their current PKI components.
+
+        :returns: Per-user result, as of populate_qgis_creds.py --batch
+        :rtype: dict
+        """
+        record = self.records[user]
+        creds = self._credentials(user)
+        self._track(user, creds)
+        result = {'user': user, 'ok': False}
+        if self.checkfirst:
+            checks = check_credentials(creds, record['passphrase'],
+                                       self.allow_expired)
+            failed = [c for c in checks if not c[1]]
+            if failed:
+                result['error'] = 'Pre-flight {0} failed: {1}'.format(
+                    failed[0][0], failed[0][2])
+                result['checks'] = checks
+                return result
+
+        authdbdir = os.path.join(self.outdir, user)
+        try:
+            result.update(self.scheduler.run(
+                authdbdir, self.session.provision, user,
+                record['masterpass'], record['pkidir'], authdbdir,
+                record['passphrase'],
+                dbpath=os.path.join(authdbdir, AUTHDBNAME)))
+        except Exception as e:
+            # e.g. a corrupt auth db: fail this user, not the daemon
+            result['error'] = str(e) or e.__class__.__name__
+            return result
+        finally:
+            result.update(self.scheduler.last)
+        result['ok'] = True
+        return result
+
+    def handle(self, paths, report):
+        """Re-provision the users affected by changed paths.
+
+        :type report: BatchReport
+        :returns: Number of users affected
+        :rtype: int
+        """
+        users = self.affected(paths)
+        report.note('{0} paths changed, {1} users affected'.format(
+            len(paths), len(users)))
+        for user in sorted(users):
+            report.result(self.reprovision(user))
+        return len(users)
+
+    def run(self, watcher, report, quiet=QUIET, maxdelay=MAX_DELAY,
+            bursts=None):
+        """Handle bursts of changes, as each settles, until interrupted.
+
+        :param bursts: Bursts to handle before returning (default: no limit)
+        :type bursts: int
+        """
+        handled = 0
+        while bursts is None or handled < bursts:
+            paths = debounce(watcher, quiet, maxdelay)
+            if paths:
+                self.handle(paths, report)
+                handled += 1
+
+
+def watch_main(manifest, outdir, pkidir, specpath=connections.DEFAULT_SPEC,
+               pkiindex=False, source=None, checkfirst=False,
+               allow_expired=False, catchup=False, poll=False,
+               interval=POLL_INTERVAL, quiet=QUIET, maxdelay=MAX_DELAY,
+               report=None, lockretries=scheduler.RETRIES):
+    """Watch pkidir, and re-provision the users of a manifest it affects.
+
+    Runs until interrupted.
+
+    :param source: Source of master passwords missing in manifest
+    :type source: passwords.PasswordSource
+    :param catchup: Re-provision every user once, before watching
+    :type catchup: bool
+    :param report: Reporter of results (default: text, to stdout)
+    :type report: BatchReport
+    :returns: Number of users that failed
+    :rtype: int
+    """
+    report = report or BatchReport()
+    connections.compile_spec(connections.load_spec(specpath))
+    pkidir = os.path.realpath(pkidir)
+    records = iter_manifest(manifest, pkidir)
+    if source is not None:
+        records = fill_passwords(records, source)
+    tracked = []
+    for record in records:
+        error = record_error(record)
+        if error:
+            report.result({'user': record['user'], 'ok': False,
+                           'error': error})
+            continue
+        record['pkidir'] = os.path.realpath(record['pkidir'])
+        if not is_watched(record['pkidir'], pkidir):
+            # Changes to their components would never be seen
+            report.result({'user': record['user'], 'ok': False,
+                           'error': 'PKI directory {0} is not under the '
+                                    'watched {1}'.format(record['pkidir'],
+                                                         pkidir)})
+            continue
+        tracked.append(record)
+
+    index = None
+    if pkiindex:
+        index = PkiIndex(pkidir, index_path(pkidir, outdir), sorted(
+            set(r['passphrase'] for r in tracked if r['passphrase'])))
+        report.note('PKI index: {0}'.format(index.update()))
+
+    # Watch from before any user is looked up, so no change is missed
+    watcher = make_watcher(pkidir, poll, interval)
+    session = ProvisionSession(specpath=specpath, pkiindex=index)
+    try:
+        session.start()
+        watch = PkiWatch(session, tracked, outdir,
+                         Scheduler(retries=lockretries), checkfirst,
+                         allow_expired)
+        if catchup:
+            for user in sorted(watch.records):
+                report.result(watch.reprovision(user))
+        report.note('Watching {0} ({1}) for {2} users'.format(
+            pkidir, watcher.method, len(watch)))
+        try:
+            watch.run(watcher, report, quiet, maxdelay)
+        except KeyboardInterrupt:
+            pass
+    finally:
+        watcher.close()
+        session.close()
+        if index is not None:
+            index.close()
+    return report.finish()
+
+
+def _terminate(signum, frame):  # pylint: disable=W0613
+    raise KeyboardInterrupt
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Watch a PKI components directory, and re-provision '
+                    'the auth dbs of only the users whose components change.'
+    )
+    parser.add_argument(
+        'manifest', metavar='manifest-path',
+        help='CSV or JSON lines manifest of users (user,masterpass'
+             '[,pkidir])'
+    )
+    parser.add_argument(
+        '-o', '--out-dir', dest='outdir', metavar='directory-path',
+        required=True,
+        help='Directory with a subdirectory of auth db and QGIS2.ini per user'
+    )
+    parser.add_argument(
+        '-d', '--pki-dir', dest='pkidir', metavar='directory-path',
+        required=True,
+        help='PKI components directory to watch'
+    )
+    parser.add_argument(
+        '-x', '--pki-index', dest='pkiindex', action='store_true',
+        help='Look up users\' PKI components in an index of the PKI '
+             'directory, instead of guessing file names'
+    )
+    parser.add_argument(
+        '-c', '--connections', dest='specpath', metavar='spec-path',
+        default=connections.DEFAULT_SPEC,
+        help='JSON or YAML spec of OWS connections to link to the auth config '
+             '(default: connections.json)'
+    )
+    parser.add_argument(
+        '-s', '--masterpass-source', dest='source', metavar='uri',
+        help='Source of master passwords missing in manifest: file:path, '
+             'env:VAR or ldap://host/base-dn'
+    )
+    parser.add_argument(
+        '-p', '--preflight', dest='preflight', action='store_true',
+        help='Validate a user\'s changed PKI components first, and only '
+             're-provision the user if they pass'
+    )
+    parser.add_argument(
+        '-e', '--allow-expired', dest='allowexpired', action='store_true',
+        help='Do not fail pre-flight for expired certificates'
+    )
+    parser.add_argument(
+        '--catch-up', dest='catchup', action='store_true',
+        help='Re-provision every user once, before watching'
+    )
+    parser.add_argument(
+        '--poll', dest='poll', action='store_true',
+        help='Poll the directory, even where inotify is available'
+    )
+    parser.add_argument(
+        '--interval', dest='interval', metavar='seconds', type=float,
+        default=POLL_INTERVAL,
+        help='Seconds between scans, when polling (default: {0})'.format(
+            POLL_INTERVAL)
+    )
+    parser.add_argument(
+        '--quiet', dest='quiet', metavar='seconds', type=float,
+        default=QUIET,
+        help='Seconds without a change that end a burst of changes '
+             '(default: {0})'.format(QUIET)
+    )
+    parser.add_argument(
+        '--max-delay', dest='maxdelay', metavar='seconds', type=float,
+        default=MAX_DELAY,
+        help='Most seconds to hold a burst of changes that does not settle '
+             '(default: {0})'.format(MAX_DELAY)
+    )
+    parser.add_argument(
+        '-r', '--results', dest='results', action='store_true',
+        help='Write per-user results to stdout as JSON lines'
+    )
+    parser.add_argument(
+        '--lock-retries', dest='lockretries', metavar='count', type=int,
+        default=scheduler.RETRIES,
+        help='Retries of a user whose auth db is locked (default: {0})'
+             .format(scheduler.RETRIES)
+    )
+    return parser
+
+if __name__ == '__main__':
+    args = arg_parser().parse_args()
+    pkid = os.path.realpath(args.pkidir)
+    if not os.path.isdir(pkid):
+        print 'PKI components directory does not exist.'
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        src = source_from_uri(args.source) if args.source else None
+        failures = watch_main(args.manifest, os.path.realpath(args.outdir),
+                              pkid, specpath=args.specpath,
+                              pkiindex=args.pkiindex, source=src,
+                              checkfirst=args.preflight,
+                              allow_expired=args.allowexpired,
+                              catchup=args.catchup, poll=args.poll,
+                              interval=args.interval, quiet=args.quiet,
+                              maxdelay=args.maxdelay,
+                              report=BatchReport(jsonl=args.results),
+                              lockretries=args.lockretries)
+    except (connections.SpecError, ManifestError, PasswordError,
+            WatchError, IOError) as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    sys.exit(1 if failures else 0)
@@ -28,6 +28,18 @@ from PyQt4.QtGui import QAction, QIcon
 from populate_credentials_dialog import PopulateCredentialsDialog
 import os.path
 
+# Profiler hook for run(), enabled by the POPULATE_PROFILE environment variable
+try:
+    # Deployed alongside the plugin's modules
+    from profiling import profiled
+except ImportError:
+    # Running from the source tree, or a package made from it
+    import imp
+    profiled = imp.load_source(
+        'populate_credentials_profiling',
+        os.path.join(os.path.dirname(__file__), 'auth_system',
+                     'profiling.py')).profiled
+
 
 class PopulateCredentials:
     """QGIS Plugin Implementation."""
@@ -174,6 +186,7 @@ class PopulateCredentials:
                 action)
             self.iface.removeToolBarIcon(action)
 
+    @profiled
     def run(self):
         """Run method that performs all the real work"""
         # show the dialog
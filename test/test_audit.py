@@ -0,0 +1,119 @@
+# coding=utf-8
+"""Tests for the audit export, against the in-memory backend.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-22'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import audit_export
+from backends import MemoryBackend, PKI_PKCS12
+from manifest import ManifestError, make_record
+from populate_qgis_creds import ProvisionSession
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class AuditTest(unittest.TestCase):
+    """Test audit lines hold each config, its connections, and no secrets."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.session = ProvisionSession(backend=MemoryBackend()).start()
+        res = self.session.provision('rod', 'pass', PKIDATA,
+                                     os.path.join(self.tmpdir, 'rod'))
+        self.configid = res['configid']
+        audit_export._WORKER_SESSION = self.session
+
+    def tearDown(self):
+        audit_export._WORKER_SESSION = None
+        self.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def audit(self, user, masterpass, secrets=False):
+        return audit_export._audit_user(
+            (make_record({'user': user, 'masterpass': masterpass}),
+             self.tmpdir, secrets))
+
+    def test_audit(self):
+        """One line per config, with its linked connections, redacted."""
+        ok, lines = self.audit('rod', 'pass')
+        self.assertTrue(ok)
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(
+            (record['user'], record['configid'], record['type'],
+             record['name']),
+            ('rod', self.configid, PKI_PKCS12, 'My PKI PKCS#12 Config'))
+        self.assertEqual(record['fields']['bundlePassphrase'],
+                         audit_export.REDACTED)
+        self.assertEqual(record['fields']['bundlePath'],
+                         os.path.join(PKIDATA, 'rod.p12'))
+        self.assertEqual(
+            sorted((c['kind'], c['name']) for c in record['connections']),
+            [('WCS', 'My WCS SSL Server'), ('WFS', 'My WFS SSL Server'),
+             ('WMS', 'My WMS SSL Server')])
+        self.assertEqual(
+            [c['url'] for c in record['connections'] if c['kind'] == 'WMS'],
+            ['https://localhost:8443/geoserver/wms'])
+        # The sample bundle's passphrase
+        self.assertNotIn('"password"', lines[0])
+
+        _, lines = self.audit('rod', 'pass', secrets=True)
+        self.assertEqual(
+            json.loads(lines[0])['fields']['bundlePassphrase'], 'password')
+
+    def test_errors(self):
+        """A user that can not be read gets one line, with the error."""
+        ok, lines = self.audit('rod', 'wrong')
+        self.assertFalse(ok)
+        self.assertEqual(json.loads(lines[0]),
+                         {'user': 'rod',
+                          'error': 'Failed to verify master password'})
+        ok, lines = self.audit('jane', 'pass')
+        self.assertFalse(ok)
+        self.assertTrue(json.loads(lines[0])['error'].startswith(
+            'No auth db in'))
+        self.assertFalse(self.audit('jane', '')[0])
+
+    def test_export_errors(self):
+        """A corrupt auth db fails its user; a bad manifest, the export."""
+        def corrupt(authdbdir):
+            raise sqlite3.DatabaseError('file is not a database')
+
+        self.session.switch_db = corrupt
+        manifest = os.path.join(self.tmpdir, 'users.jsonl')
+        with open(manifest, 'wb') as f:
+            f.write('{"user": "rod", "masterpass": "pass"}\n')
+        out = StringIO()
+        self.assertEqual(audit_export.audit_main(manifest, self.tmpdir, out,
+                                                 processes=1), (0, 1))
+        self.assertEqual(json.loads(out.getvalue()),
+                         {'user': 'rod', 'error': 'file is not a database'})
+
+        with open(manifest, 'ab') as f:
+            f.write('{"user": \n')
+        self.assertRaises(ManifestError, audit_export.audit_main, manifest,
+                          self.tmpdir, StringIO(), processes=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# coding=utf-8
+"""Tests for the reverse index of auth configs to linked connections.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-19'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import authlinks
+import authstore
+import connections
+import planner
+import populate_qgis_creds as pqc
+from authlinks import LinkIndex
+from backends import MemoryBackend, MemorySettings, PKI_PKCS12
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class CountingSettings(MemorySettings):
+    """Settings that count full reads of their keys."""
+
+    def __init__(self):
+        MemorySettings.__init__(self)
+        self.scans = 0
+
+    def allKeys(self):
+        self.scans += 1
+        return MemorySettings.allKeys(self)
+
+
+class LinkIndexTest(unittest.TestCase):
+    """Test the index tracks links, and is reused while settings are."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = CountingSettings()
+        for kind, name, configid in (('WMS', 'A', 'cfg1'),
+                                     ('WFS', 'B', 'cfg1'),
+                                     ('WCS', 'C', 'cfg2'),
+                                     ('WMS', 'D', '')):
+            self.settings.setValue(
+                '/Qgis/{0}/{1}/authid'.format(kind, name), configid)
+            self.settings.setValue(
+                '/Qgis/connections-{0}/{1}/url'.format(kind.lower(), name),
+                'https://localhost/' + name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build(self):
+        """Only non-empty /authid keys are indexed, by config."""
+        index = LinkIndex.build(self.settings)
+        self.assertEqual(index.configs(), ['cfg1', 'cfg2'])
+        self.assertEqual(index.keys('cfg1'), ['/Qgis/WFS/B/authid',
+                                              '/Qgis/WMS/A/authid'])
+        self.assertEqual(len(index), 3)
+
+        self.settings.setValue('/Qgis/WFS/B/authid', 'cfg2')
+        self.assertEqual(index.keys('cfg1', self.settings),
+                         ['/Qgis/WMS/A/authid'])
+        self.assertEqual(index.keys('cfg2'), ['/Qgis/WCS/C/authid',
+                                              '/Qgis/WFS/B/authid'])
+        index.refresh(self.settings, ['/Qgis/WMS/A/authid',
+                                      '/Qgis/connections-wms/A/url'])
+        self.assertEqual(index.keys('cfg1'), ['/Qgis/WMS/A/authid'])
+
+    def test_relink_unlink(self):
+        """Relinking and unlinking touch only the config's keys, syncing once.
+        """
+        index = LinkIndex.build(self.settings)
+        self.assertEqual(index.relink(self.settings, 'cfg1', 'cfg3'), 2)
+        self.assertEqual(self.settings.syncs, 1)
+        self.assertEqual(self.settings.value('/Qgis/WFS/B/authid'), 'cfg3')
+        self.assertEqual(index.configs(), ['cfg2', 'cfg3'])
+
+        self.assertEqual(index.unlink(self.settings, 'cfg3'), 2)
+        self.assertEqual(index.unlink(self.settings, 'cfg3'), 0)
+        self.assertEqual(self.settings.syncs, 2)
+        self.assertEqual(self.settings.value('/Qgis/WMS/A/authid'), '')
+        self.assertEqual(index.configs(), ['cfg2'])
+        self.assertEqual(self.settings.scans, 1)
+
+    def test_load_index(self):
+        """A saved index is reused until its settings file changes."""
+        path = os.path.join(self.tmpdir, 'QGIS2.ini')
+        with open(path, 'wb') as f:
+            f.write('[Qgis]\n')
+        index = authlinks.load_index(self.settings, path)
+        self.assertEqual(index.configs(), ['cfg1', 'cfg2'])
+        self.assertTrue(os.path.exists(authlinks.index_path(path)))
+
+        again = authlinks.load_index(self.settings, path)
+        self.assertEqual(again.keys('cfg2'), ['/Qgis/WCS/C/authid'])
+        self.assertEqual(self.settings.scans, 1)
+
+        with open(path, 'ab') as f:
+            f.write('changed=true\n')
+        authlinks.load_index(self.settings, path)
+        self.assertEqual(self.settings.scans, 2)
+
+        # Without a settings file, nothing is saved
+        missing = os.path.join(self.tmpdir, 'none', 'QGIS2.ini')
+        authlinks.load_index(self.settings, missing)
+        self.assertFalse(os.path.exists(authlinks.index_path(missing)))
+
+    def test_plan_with_links(self):
+        """Plans find connections of duplicates in the index, not all keys."""
+        backend = MemoryBackend()
+        session = pqc.ProvisionSession(backend=backend).start()
+        session.switch_db(os.path.join(self.tmpdir, 'rod'))
+        authm = session.authm
+        authm.setMasterPassword('pass', True)
+
+        def config():
+            return pqc.build_config(
+                'rod', PKIDATA, configcls=backend.config_class(PKI_PKCS12))
+        stale = config()
+        stale.setIssuerSelfSigned(False)
+        authm.storeAuthenticationConfig(stale)
+        current = config()
+        authm.storeAuthenticationConfig(current)
+        self.settings.setValue('/Qgis/WFS/Other Server/authid', stale.id())
+
+        index = LinkIndex.build(self.settings)
+        plan = planner.plan_user(
+            authm, self.settings, config(),
+            connections.compile_spec(connections.load_spec()), index)
+        self.assertEqual(self.settings.scans, 1)
+        self.assertEqual(plan.removals, [stale.id()])
+        self.assertIn(('/Qgis/WFS/Other Server/authid', connections.AUTHID),
+                      plan.writes)
+
+        planner.apply_plan(authm, self.settings, plan, index)
+        self.assertEqual(index.configs(),
+                         sorted(['cfg1', 'cfg2', current.id()]))
+        self.assertEqual(len(index.keys(current.id())), 4)
+        session.close()
+
+    def test_single_user(self):
+        """A single user's re-run reads no settings keys but the spec's."""
+        path = os.path.join(self.tmpdir, 'QGIS2.ini')
+        with open(path, 'wb') as f:
+            f.write('[Qgis]\n')
+        backend = MemoryBackend()
+        session = pqc.ProvisionSession(backend=backend).start()
+        session.switch_db(os.path.join(self.tmpdir, 'rod'))
+        writes = connections.compile_spec(connections.load_spec())
+
+        def run():
+            return pqc._plan_and_apply(
+                session.authm, self.settings, path, 'rod', 'pass', PKIDATA,
+                None, 'password', writes,
+                configcls=backend.config_class(PKI_PKCS12))
+
+        plan, configid = run()
+        self.assertEqual(plan.action, authstore.STORED)
+        self.assertEqual(self.settings.scans, 1)
+        plan, again = run()
+        self.assertEqual((again, plan.action, plan.writes),
+                         (configid, authstore.UNCHANGED, []))
+        self.assertEqual(self.settings.scans, 1)
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
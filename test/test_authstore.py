@@ -0,0 +1,92 @@
+# coding=utf-8
+"""Tests for idempotent auth config storage.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-03'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import sys
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import authstore
+from backends import MemoryAuthManager, MemoryConfigPkiPkcs12
+
+
+def pkcs12_config(name, bundle):
+    config = MemoryConfigPkiPkcs12()
+    config.setName(name)
+    config.setUri('https://localhost:8443')
+    config.setBundlePath(bundle)
+    return config
+
+
+class AuthManager(MemoryAuthManager):
+    """In-memory auth manager, counting stores and updates."""
+
+    def __init__(self):
+        MemoryAuthManager.__init__(self)
+        self.init('/tmp/rod')
+        self.setMasterPassword('password', True)
+        self.stores = 0
+        self.updates = 0
+
+    def storeAuthenticationConfig(self, config):
+        self.stores += 1
+        return MemoryAuthManager.storeAuthenticationConfig(self, config)
+
+    def updateAuthenticationConfig(self, config):
+        self.updates += 1
+        return MemoryAuthManager.updateAuthenticationConfig(self, config)
+
+
+class AuthStoreTest(unittest.TestCase):
+    """Test configs are only stored or updated when needed."""
+
+    def test_store_reuse_update(self):
+        """Configs are stored once, then reused or updated in place."""
+        authm = AuthManager()
+        config = pkcs12_config('My Config', '/pki/rod.p12')
+        configid, action = authstore.store_config(authm, config)
+        self.assertEqual(action, authstore.STORED)
+
+        config = pkcs12_config('My Config', '/pki/rod.p12')
+        self.assertEqual(authstore.store_config(authm, config),
+                         (configid, authstore.UNCHANGED))
+        self.assertEqual(config.id(), configid)
+
+        config = pkcs12_config('My Config', '/pki/rod2.p12')
+        self.assertEqual(authstore.store_config(authm, config),
+                         (configid, authstore.UPDATED))
+        stored = authstore.load_config(authm, configid, MemoryConfigPkiPkcs12)
+        self.assertEqual(stored.bundlePath(), '/pki/rod2.p12')
+
+        config = pkcs12_config('Other Config', '/pki/rod.p12')
+        otherid, action = authstore.store_config(authm, config)
+        self.assertEqual(action, authstore.STORED)
+        self.assertNotEqual(otherid, configid)
+        self.assertEqual(len(authm.configIds()), 2)
+        self.assertEqual((authm.stores, authm.updates), (2, 1))
+
+    def test_fingerprint(self):
+        """Fingerprints differ by content, not by ID."""
+        config1 = pkcs12_config('My Config', '/pki/rod.p12')
+        config2 = pkcs12_config('My Config', '/pki/rod.p12')
+        config2.setId('abc1234')
+        self.assertEqual(authstore.fingerprint(config1),
+                         authstore.fingerprint(config2))
+        self.assertNotEqual(
+            authstore.fingerprint(config1),
+            authstore.fingerprint(pkcs12_config('My Config', '/pki/x.p12')))
+
+if __name__ == '__main__':
+    unittest.main()
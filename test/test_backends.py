@@ -0,0 +1,151 @@
+# coding=utf-8
+"""Tests for the auth and settings backends.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-10'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import backends
+
+
+class MemoryBackendTest(unittest.TestCase):
+    """Test the in-memory auth manager follows QgsAuthManager semantics."""
+
+    def setUp(self):
+        self.backend = backends.MemoryBackend().start()
+        self.authm = self.backend.auth_manager()
+        self.authm.init('/tmp/rod')
+
+    def new_config(self, name='My Config'):
+        config = self.backend.config_class(backends.PKI_PKCS12)()
+        config.setName(name)
+        config.setBundlePath('/pki/rod.p12')
+        config.setIssuerSelfSigned(True)
+        return config
+
+    def test_master_password(self):
+        """First master password is stored, later ones are verified."""
+        self.assertFalse(self.authm.storeAuthenticationConfig(
+            self.new_config())[0])
+        self.assertFalse(self.authm.setMasterPassword(True))
+        self.assertTrue(self.authm.setMasterPassword('pass', True))
+        self.authm.clearMasterPassword()
+        self.assertFalse(self.authm.setMasterPassword('wrong', True))
+        self.assertTrue(self.authm.setMasterPassword('pass', True))
+
+        # each db directory has its own master password
+        self.authm.init('/tmp/jane')
+        self.assertTrue(self.authm.setMasterPassword('other', True))
+        self.authm.init('/tmp/rod')
+        self.assertFalse(self.authm.setMasterPassword('other', True))
+
+    def test_store_load_update(self):
+        """Stored configs are listed, loaded and updated by ID."""
+        self.authm.setMasterPassword('pass', True)
+        config = self.new_config()
+        ok, configid = self.authm.storeAuthenticationConfig(config)
+        self.assertTrue(ok)
+        self.assertEqual(config.id(), configid)
+        self.assertEqual(len(configid), 7)
+        self.assertEqual(self.authm.configIds(), [configid])
+        self.assertEqual(self.authm.configProviderType(configid),
+                         backends.PKI_PKCS12)
+        self.assertEqual(self.authm.availableConfigs()[configid].name(),
+                         'My Config')
+
+        loaded = backends.MemoryConfigPkiPkcs12()
+        self.assertTrue(self.authm.loadAuthenticationConfig(
+            configid, loaded, True))
+        self.assertEqual(loaded.values(), config.values())
+        self.assertTrue(loaded.issuerSelfSigned())
+        self.assertFalse(self.authm.loadAuthenticationConfig(
+            configid, backends.MemoryConfigBasic(), True))
+
+        loaded.setBundlePath('/pki/rod2.p12')
+        self.assertTrue(self.authm.updateAuthenticationConfig(loaded))
+        self.authm.clearMasterPassword()
+        self.assertFalse(self.authm.loadAuthenticationConfig(
+            configid, backends.MemoryConfigPkiPkcs12(), True))
+        self.authm.setMasterPassword('pass', True)
+        self.authm.loadAuthenticationConfig(configid, config, True)
+        self.assertEqual(config.bundlePath(), '/pki/rod2.p12')
+
+        self.assertTrue(self.authm.removeAuthenticationConfig(configid))
+        self.assertEqual(self.authm.configIds(), [])
+
+    def test_settings(self):
+        """Settings persist per path, and read back as strings once synced."""
+        settings = self.backend.settings('/tmp/rod/QGIS2.ini')
+        settings.setValue('/Qgis/WMS/x/authid', 'abc1234')
+        settings.setValue('/Qgis/connections-wms/x/dpiMode', 7)
+        settings.sync()
+        settings = self.backend.settings('/tmp/rod/QGIS2.ini')
+        self.assertEqual(settings.value('/Qgis/connections-wms/x/dpiMode'),
+                         '7')
+        self.assertFalse(
+            self.backend.settings('/tmp/jane/QGIS2.ini').contains(
+                '/Qgis/WMS/x/authid'))
+
+
+class DbCopyTest(unittest.TestCase):
+    """Test auth dbs are backed up and restored while open elsewhere."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmpdir, backends.AUTHDBNAME)
+        # Stands for the auth manager's connection, open throughout
+        self.conn = sqlite3.connect(self.dbpath)
+        for sql in backends._SCHEMA:
+            self.conn.execute(sql)
+        self.conn.execute('CREATE INDEX configs_name ON auth_configs (name)')
+        self.conn.execute("INSERT INTO auth_pass VALUES ('s', 'old')")
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_copy_restore(self):
+        """Copies are consistent, and restored as a commit."""
+        backup = os.path.join(self.tmpdir, 'backup.db')
+        backends.QgisBackend().backup_db(self.tmpdir, backup)
+        self.conn.execute("UPDATE auth_pass SET hash = 'new'")
+        self.conn.execute("INSERT INTO auth_configs VALUES "
+                          "('a', 'n', '', 't', 1, 'c')")
+        self.conn.commit()
+
+        backends.QgisBackend().restore_db(self.tmpdir, backup)
+        self.assertEqual(self.conn.execute(
+            'SELECT hash FROM auth_pass').fetchall(), [('old',)])
+        self.assertEqual(self.conn.execute(
+            'SELECT COUNT(*) FROM auth_configs').fetchone()[0], 0)
+
+        # The open connection holds a write lock
+        self.conn.execute("UPDATE auth_pass SET hash = 'locked'")
+        backends.DB_TIMEOUT, timeout = 0.01, backends.DB_TIMEOUT
+        try:
+            self.assertRaises(IOError, backends.restore_copy, self.dbpath,
+                              backup)
+        finally:
+            backends.DB_TIMEOUT = timeout
+        self.conn.rollback()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+# coding=utf-8
+"""Tests for the read cache of decrypted auth configs.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-21'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR, Clock
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import audit_export
+import expiry_scan
+import rotate_masterpass
+from backends import MemoryAuthManager, MemoryBackend, MemoryConfigPkiPkcs12
+from configcache import CachingAuthManager, ConfigCache
+from manifest import make_record
+from populate_qgis_creds import ProvisionSession
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class CountingAuthManager(MemoryAuthManager):
+    """Auth manager that counts full (decrypting) loads."""
+
+    def __init__(self):
+        MemoryAuthManager.__init__(self)
+        self.loads = 0
+
+    def loadAuthenticationConfig(self, configid, config, full=False):
+        if full:
+            self.loads += 1
+        return MemoryAuthManager.loadAuthenticationConfig(
+            self, configid, config, full)
+
+
+def pkcs12_config(path='/pki/rod.p12'):
+    config = MemoryConfigPkiPkcs12()
+    config.setName('My PKI PKCS#12 Config')
+    config.setBundlePath(path)
+    config.setBundlePassphrase('password')
+    return config
+
+
+class ConfigCacheTest(unittest.TestCase):
+    """Test eviction, expiry and invalidation of cached configs."""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ConfigCache(maxsize=2, ttl=60, clock=self.clock)
+        self.authm = CountingAuthManager()
+        self.authm.init('/srv/rod')
+        self.authm.setMasterPassword('pass', True)
+        self.cached = CachingAuthManager(self.authm, self.cache)
+
+    def load(self, configid):
+        config = MemoryConfigPkiPkcs12()
+        self.assertTrue(
+            self.cached.loadAuthenticationConfig(configid, config, True))
+        return config
+
+    def store(self, path='/pki/rod.p12'):
+        config = pkcs12_config(path)
+        self.assertTrue(self.cached.storeAuthenticationConfig(config)[0])
+        return config.id()
+
+    def test_lru(self):
+        """The least recently used config is evicted."""
+        for key in ('a', 'b'):
+            self.cache.put('db', key, pkcs12_config())
+        self.assertIsNotNone(self.cache.get('db', 'a'))
+        self.cache.put('db', 'c', pkcs12_config())
+        self.assertIsNone(self.cache.get('db', 'b'))
+        self.assertIsNotNone(self.cache.get('db', 'a'))
+        self.assertEqual(self.cache.stats(), {'hits': 2, 'misses': 1,
+                                              'evictions': 1, 'size': 2})
+
+    def test_read_through(self):
+        """Repeated loads decrypt once, until the TTL runs out."""
+        configid = self.store()
+        first = self.load(configid)
+        first.setBundlePath('/changed')
+        again = self.load(configid)
+        self.assertEqual(self.authm.loads, 1)
+        self.assertEqual((again.id(), again.bundlePath(),
+                          again.bundlePassphrase()),
+                         (configid, '/pki/rod.p12', 'password'))
+
+        self.clock.now += 61
+        self.load(configid)
+        self.assertEqual(self.authm.loads, 2)
+
+        # Only while the master password is set
+        self.cached.clearMasterPassword()
+        self.assertFalse(self.cached.loadAuthenticationConfig(
+            configid, MemoryConfigPkiPkcs12(), True))
+
+    def test_invalidate(self):
+        """Changes through the wrapper invalidate what they change."""
+        configid = self.store()
+        other = self.store('/pki/other.p12')
+        config = self.load(configid)
+        self.load(other)
+
+        config.setBundlePath('/pki/renewed.p12')
+        self.assertTrue(self.cached.updateAuthenticationConfig(config))
+        self.assertEqual(self.load(configid).bundlePath(), '/pki/renewed.p12')
+        self.assertEqual(self.authm.loads, 3)
+
+        self.assertTrue(self.cached.resetMasterPassword('new', True))
+        self.assertEqual(len(self.cache), 0)
+
+        self.load(other)
+        self.assertTrue(self.cached.removeAuthenticationConfig(other))
+        self.assertFalse(self.cached.loadAuthenticationConfig(
+            other, MemoryConfigPkiPkcs12(), True))
+
+        # Keyed by auth db
+        self.cached.init('/srv/jane')
+        self.cached.setMasterPassword('pass', True)
+        self.assertFalse(self.cached.loadAuthenticationConfig(
+            configid, MemoryConfigPkiPkcs12(), True))
+
+    def test_session(self):
+        """A session with a cache re-plans without decrypting again."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = ConfigCache()
+            session = ProvisionSession(backend=MemoryBackend(),
+                                       configcache=cache).start()
+            authdbdir = os.path.join(tmpdir, 'rod')
+            for _ in range(3):
+                session.provision('rod', 'pass', PKIDATA, authdbdir)
+            # Stored, then loaded to compare, then served from the cache
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            session.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_load_configs(self):
+        """Audits and scans of a db decrypt it once, until it is re-keyed."""
+        tmpdir = tempfile.mkdtemp()
+        backend = MemoryBackend()
+        backend.authm = self.authm
+        session = ProvisionSession(backend=backend,
+                                   configcache=ConfigCache()).start()
+        expiry_scan._WORKER_SESSION = session
+        try:
+            authdbdir = os.path.join(tmpdir, 'rod')
+            session.provision('rod', 'pass', PKIDATA, authdbdir)
+            loads = self.authm.loads
+            audit_export.audit_user(session, authdbdir, 'pass')
+            res = expiry_scan._scan_db(
+                (make_record({'user': 'rod', 'masterpass': 'pass'}), tmpdir))
+            self.assertTrue(res['ok'], res.get('error'))
+            self.assertEqual(self.authm.loads, loads + 1)
+
+            # Verified by decrypting with the new password, not the cache
+            rotate_masterpass.rotate_db(session, authdbdir, 'pass', 'new',
+                                        'stamp')
+            self.assertEqual(self.authm.loads, loads + 2)
+            audit_export.audit_user(session, authdbdir, 'new')
+            self.assertEqual(self.authm.loads, loads + 2)
+        finally:
+            expiry_scan._WORKER_SESSION = None
+            session.close()
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# coding=utf-8
+"""Tests for the declarative OWS connection spec.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-01'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import sys
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import connections
+from backends import MemorySettings
+
+
+class ConnectionsTest(unittest.TestCase):
+    """Test connection specs compile to the expected settings."""
+
+    def test_default_spec(self):
+        """Default spec defines the WMS, WCS and WFS sample connections."""
+        spec = connections.load_spec()
+        self.assertEqual(
+            connections.connection_names(spec),
+            ['My WMS SSL Server', 'My WCS SSL Server', 'My WFS SSL Server'])
+
+        settings = MemorySettings()
+        connections.apply_writes(
+            settings, connections.compile_spec(spec), 'abc1234')
+        values = settings.values
+        self.assertEqual(len(values), 26)
+        self.assertEqual(values['/Qgis/WCS/My WCS SSL Server/authid'],
+                         'abc1234')
+        self.assertEqual(
+            values['/Qgis/connections-wms/My WMS SSL Server/url'],
+            'https://localhost:8443/geoserver/wms')
+        self.assertEqual(
+            values['/Qgis/connections-wms/My WMS SSL Server/dpiMode'], '7')
+        self.assertNotIn(
+            '/Qgis/connections-wfs/My WFS SSL Server/dpiMode', values)
+
+    def test_reapply_skips_unchanged(self):
+        """Re-applying the same spec and config ID writes nothing."""
+        writes = connections.compile_spec(connections.load_spec())
+        settings = MemorySettings()
+        self.assertEqual(
+            connections.apply_writes(settings, writes, 'abc1234'), (26, 0))
+        self.assertEqual(settings.syncs, 1)
+        self.assertEqual(
+            connections.apply_writes(settings, writes, 'abc1234'), (0, 26))
+        self.assertEqual(settings.syncs, 1)
+        self.assertEqual(
+            connections.apply_writes(settings, writes, 'def5678'), (3, 23))
+        self.assertEqual(settings.syncs, 2)
+
+    def test_connection_overrides_default(self):
+        """Connection members override the defaults of its kind."""
+        spec = {
+            'defaults': {'WMS': {'dpiMode': 7, 'referer': ''}},
+            'connections': [
+                {'kind': 'wms', 'name': 'A', 'url': 'https://a/wms',
+                 'dpiMode': 4}]
+        }
+        writes = dict(connections.compile_spec(spec))
+        self.assertEqual(writes['/Qgis/connections-wms/A/dpiMode'], 4)
+        self.assertEqual(writes['/Qgis/connections-wms/A/referer'], '')
+        self.assertIs(writes['/Qgis/WMS/A/authid'], connections.AUTHID)
+
+    def test_missing_member(self):
+        """Connections without a url are rejected."""
+        spec = {'connections': [{'kind': 'WFS', 'name': 'A'}]}
+        self.assertRaises(connections.SpecError,
+                          connections.compile_spec, spec)
+
+if __name__ == '__main__':
+    unittest.main()
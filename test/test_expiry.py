@@ -0,0 +1,146 @@
+# coding=utf-8
+"""Tests for the certificate expiry scanner, with the sample PKI data.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-20'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import expiry_scan
+import pkiutils
+from backends import MemoryBackend
+from manifest import make_record
+from populate_qgis_creds import ProvisionSession
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+# The sample certificates expire on 2018-02-25
+BEFORE_EXPIRY = 1518000000  # 2018-02-07
+
+
+class ExpiryScanTest(unittest.TestCase):
+    """Test files are parsed once, cached by content, and reported by date."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pkidir = os.path.join(self.tmpdir, 'pki')
+        os.mkdir(self.pkidir)
+        for name in ('ca.pem', 'rod.p12', 'rod_key.pem', 'wrong_cert.pem'):
+            shutil.copy(os.path.join(PKIDATA, name), self.pkidir)
+        self.cache = expiry_scan.ExpiryCache(
+            os.path.join(self.tmpdir, expiry_scan.CACHENAME))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def scan(self, refs, days=30):
+        return expiry_scan.scan(refs, self.cache, processes=1, days=days,
+                                now=BEFORE_EXPIRY)
+
+    def test_pki_refs(self):
+        """Certificates and bundles are scanned, keys are not."""
+        refs = expiry_scan.pki_refs(self.pkidir, ['password'])
+        self.assertEqual(
+            [(os.path.basename(r['path']), r['kind']) for r in refs],
+            [('ca.pem', pkiutils.CERT), ('rod.p12', pkiutils.PKCS12),
+             ('wrong_cert.pem', pkiutils.CERT)])
+
+    def test_scan(self):
+        """Expiring certs are reported soonest first, after unreadable ones."""
+        refs = expiry_scan.pki_refs(self.pkidir, ['password'])
+        report, stats = self.scan(refs)
+        self.assertEqual(stats, {'parsed': 3, 'cached': 0, 'hashed': 3})
+        self.assertEqual([os.path.basename(r['path']) for r in report],
+                         ['wrong_cert.pem', 'ca.pem', 'rod.p12'])
+        self.assertTrue(report[0]['error'])
+        self.assertEqual(report[2]['days_left'], 17)
+        self.assertEqual(report[2]['subject'],
+                         'CN=rod,OU=Spring Security,O=Spring Framework')
+
+        report, _ = self.scan(refs, days=7)
+        self.assertEqual(len(report), 1)
+
+        # A bundle that can not be decrypted is an error, cached apart
+        refs = expiry_scan.pki_refs(self.pkidir, ['wrong'])
+        report, stats = self.scan(refs, days=7)
+        self.assertEqual(stats['parsed'], 1)
+        self.assertEqual(len(report), 2)
+
+    def test_cache(self):
+        """Only files whose content changed are parsed again."""
+        refs = expiry_scan.pki_refs(self.pkidir, ['password'])
+        self.scan(refs)
+        self.cache.hashed = 0
+        _, stats = self.scan(refs)
+        self.assertEqual(stats, {'parsed': 0, 'cached': 3, 'hashed': 0})
+
+        # Same content, new mtime: re-hashed, not re-parsed
+        ca = os.path.join(self.pkidir, 'ca.pem')
+        os.utime(ca, (0, 0))
+        _, stats = self.scan(refs)
+        self.assertEqual(stats, {'parsed': 0, 'cached': 3, 'hashed': 1})
+
+        shutil.copy(os.path.join(PKIDATA, 'server_cert.pem'), ca)
+        _, stats = self.scan(refs)
+        self.assertEqual(stats['parsed'], 1)
+
+    def test_scan_db(self):
+        """A user's configs are loaded for the files they reference."""
+        session = ProvisionSession(backend=MemoryBackend()).start()
+        session.provision('rod', 'pass', self.pkidir,
+                          os.path.join(self.tmpdir, 'rod'))
+        expiry_scan._WORKER_SESSION = session
+        try:
+            res = expiry_scan._scan_db(
+                (make_record({'user': 'rod', 'masterpass': 'pass'}),
+                 self.tmpdir))
+            self.assertTrue(res['ok'], res.get('error'))
+            self.assertEqual([(r['role'], r['passphrases'])
+                              for r in res['refs']],
+                             [('bundle', ['password']), ('issuer', [])])
+            self.assertEqual(res['refs'][0]['user'], 'rod')
+
+            # Shared files are parsed once, but reported per reference
+            report, stats = self.scan(res['refs'] + res['refs'])
+            self.assertEqual(stats['parsed'], 2)
+            self.assertEqual(len(report), 4)
+
+            res = expiry_scan._scan_db(
+                (make_record({'user': 'rod', 'masterpass': 'bad'}),
+                 self.tmpdir))
+            self.assertEqual(res['error'], 'Failed to verify master password')
+
+            # An unreadable auth db fails its user, not the scan
+            def corrupt(authdbdir):
+                raise sqlite3.DatabaseError('file is not a database')
+
+            session.switch_db = corrupt
+            refs, failed = expiry_scan.db_refs(
+                [make_record({'user': 'rod', 'masterpass': 'pass'})],
+                self.tmpdir, processes=1)
+            self.assertEqual(refs, [])
+            self.assertEqual(failed[0]['error'], 'file is not a database')
+        finally:
+            expiry_scan._WORKER_SESSION = None
+            session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+# coding=utf-8
+"""Tests for the shared directory queue of fleet provisioning.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-24'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import stat
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from utilities import AUTH_SYSTEM_DIR, Clock
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import fleet_queue as fq
+import populate_qgis_creds as pqc
+from backends import MemoryBackend
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class FileQueueTest(unittest.TestCase):
+    """Test batches are claimed once, and reclaimed from dead workers."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = Clock()
+        self.queue = fq.FileQueue(os.path.join(self.tmpdir, 'q'), self.clock)
+        self.queue.create({'outdir': self.tmpdir})
+        self.assertIsNone(self.queue.batches())
+        self.assertEqual(
+            self.queue.enqueue(({'user': str(n)} for n in range(5)), 2), 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_claim(self):
+        """Each batch goes to one worker, then its results to done/."""
+        self.assertEqual(self.queue.batches(), 3)
+        self.assertEqual(self.queue.config(), {'outdir': self.tmpdir})
+        name, records = self.queue.claim('a')
+        self.assertEqual((name, records),
+                         ('batch-000001', [{'user': '0'}, {'user': '1'}]))
+        self.assertEqual(self.queue.claim('b')[0], 'batch-000002')
+        self.assertEqual(self.queue.claims(),
+                         {'a': ['batch-000001'], 'b': ['batch-000002']})
+        mode = os.stat(os.path.join(self.queue.queuedir, fq.CLAIMED, 'a',
+                                    name)).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0600)
+
+        self.queue.complete('a', name, [{'user': '0', 'ok': True}])
+        self.assertEqual(self.queue.done(), [name])
+        self.assertEqual(self.queue.results(name),
+                         [{'user': '0', 'ok': True}])
+        self.queue.release('b', 'batch-000002')
+        self.assertEqual(self.queue.claims(), {'a': [], 'b': []})
+        self.assertEqual(self.queue.pending(),
+                         ['batch-000002', 'batch-000003'])
+        self.assertEqual(self.queue.claim('a')[0], 'batch-000002')
+        self.queue.claim('a')
+        self.assertIsNone(self.queue.claim('a'))
+
+    def test_reclaim(self):
+        """Claims of workers without a recent heartbeat are requeued."""
+        self.queue.heartbeat('a', batch='batch-000001')
+        self.queue.claim('a')
+        self.queue.claim('b')
+        self.assertEqual(self.queue.workers()['a']['batch'], 'batch-000001')
+        # b never had a heartbeat
+        self.assertEqual(self.queue.reclaim(60), [('b', 'batch-000002')])
+
+        self.clock.now += 30
+        self.assertEqual(self.queue.reclaim(60), [])
+        self.clock.now += 31
+        self.assertEqual(self.queue.reclaim(60), [('a', 'batch-000001')])
+        self.assertEqual(self.queue.pending(), ['batch-000001',
+                                                'batch-000002',
+                                                'batch-000003'])
+
+        # A batch done, but whose claim remains, is not requeued
+        name, _ = self.queue.claim('c')
+        self.queue.complete('c', name, [])
+        os.makedirs(os.path.join(self.queue.queuedir, fq.CLAIMED, 'd'))
+        with open(os.path.join(self.queue.queuedir, fq.CLAIMED, 'd', name),
+                  'wb'):
+            pass
+        self.assertEqual(self.queue.reclaim(60), [])
+        self.assertNotIn(name, self.queue.pending())
+
+    def test_no_workers(self):
+        """A coordinator fails once no worker is left to do the batches."""
+        report = pqc.BatchReport(StringIO())
+        alive = iter([True, False])
+        name, _ = self.queue.claim('a')
+        self.queue.complete('a', name, [{'user': '0', 'ok': False,
+                                         'error': 'bad'}])
+        with self.assertRaises(fq.QueueError) as cm:
+            fq.coordinate(self.queue, report, interval=0,
+                          alive=lambda: next(alive))
+        self.assertEqual(str(cm.exception),
+                         'No workers left, with 1 of 3 batches done')
+        self.assertEqual(report.done, 1)
+        self.assertFalse(self.queue.finished())
+
+
+class LocalRunTest(unittest.TestCase):
+    """Test a coordinator and worker processes provision a manifest."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tmpdir, 'users.csv')
+        with open(self.manifest, 'wb') as f:
+            f.write('user,masterpass\nrod,pass\njane,pass\nbob,\nann,pass\n')
+        self.queuedir = os.path.join(self.tmpdir, 'q')
+        self.outdir = os.path.join(self.tmpdir, 'out')
+        self.out = StringIO()
+        self.report = pqc.BatchReport(self.out)
+        # Inherited by the forked workers, see batch_worker_init()
+        pqc._WORKER_SESSION = pqc.ProvisionSession(
+            backend=MemoryBackend()).start()
+
+    def tearDown(self):
+        pqc._WORKER_SESSION.close()
+        pqc._WORKER_SESSION = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_local(self):
+        """Every user is provisioned once, and workers exit when done."""
+        failures = fq.local_main(self.manifest, self.queuedir, self.outdir,
+                                 processes=2, interval=0.01, heartbeat=0.05,
+                                 report=self.report, pkidir=PKIDATA, size=2)
+        self.assertEqual(failures, 1)
+        self.assertEqual(self.report.done, 4)
+        self.assertIn('FAIL  bob: Missing masterpass in manifest',
+                      self.out.getvalue())
+        self.assertIn('OK    rod:', self.out.getvalue())
+        queue = fq.FileQueue(self.queuedir)
+        self.assertTrue(queue.finished())
+        self.assertEqual(queue.workers(), {})
+        self.assertEqual(len(queue.done()), 2)
+
+        self.assertRaises(fq.QueueError, fq.start_main, self.manifest,
+                          self.queuedir, self.outdir)
+
+    def test_dead_worker(self):
+        """A batch claimed by a worker that died is reclaimed and done."""
+        queue, batches = fq.start_main(self.manifest, self.queuedir,
+                                       self.outdir, pkidir=PKIDATA, size=3,
+                                       report=self.report)
+        self.assertEqual(batches, 2)
+        # Last heard from long ago
+        fq.FileQueue(self.queuedir, lambda: 0.0).heartbeat('dead-node-1')
+        queue.claim('dead-node-1')
+        procs = fq.start_workers(self.queuedir, 1, interval=0.01,
+                                 heartbeat=0.05)
+        try:
+            self.assertEqual(fq.coordinate(queue, self.report, 60, 0.01), 1)
+        finally:
+            for proc in procs:
+                proc.join()
+        self.assertIn('Reclaimed batch-000001 from dead-node-1',
+                      self.out.getvalue())
+        self.assertEqual(self.report.done, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
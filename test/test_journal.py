@@ -0,0 +1,148 @@
+# coding=utf-8
+"""Tests for the batch run journal, and resuming batch runs from it.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-26'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from utilities import AUTH_SYSTEM_DIR, Clock
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import populate_qgis_creds as pqc
+from backends import MemoryBackend
+from journal import JOURNALNAME, Journal, output_hash
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class JournalTest(unittest.TestCase):
+    """Test results are journaled, synced in batches, and resumed."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, JOURNALNAME)
+        self.clock = Clock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def journal(self, resume=False):
+        return Journal(self.path, resume, sync_every=2, sync_seconds=10,
+                       clock=self.clock)
+
+    def test_sync_batches(self):
+        """Syncs every sync_every results, or sync_seconds, and on close."""
+        journal = self.journal()
+        journal.record({'user': 'rod', 'ok': True, 'configid': 'abc',
+                        'hash': 'f00', 'written': 12})
+        self.assertEqual(journal.syncs, 0)
+        journal.record({'user': 'jane', 'ok': False, 'error': 'bad'})
+        self.assertEqual(journal.syncs, 1)
+        self.clock.now += 11
+        journal.record({'user': 'bob', 'ok': True})
+        self.assertEqual(journal.syncs, 2)
+        journal.record({'user': 'ann', 'ok': True})
+        journal.close()
+        self.assertEqual(journal.syncs, 3)
+
+        with open(self.path, 'rb') as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(entries[0], {'user': 'rod', 'ok': True,
+                                      'configid': 'abc', 'hash': 'f00',
+                                      'time': 1000.0})
+        self.assertEqual([e['user'] for e in entries],
+                         ['rod', 'jane', 'bob', 'ann'])
+
+    def test_resume(self):
+        """Users whose last result was a success are done; torn lines go."""
+        journal = self.journal()
+        for user, ok in (('rod', True), ('jane', False), ('bob', True),
+                         ('bob', False), ('ann', False), ('ann', True)):
+            journal.record({'user': user, 'ok': ok})
+        journal.close()
+        with open(self.path, 'ab') as f:
+            f.write('{"user": "tom", "ok": tr')
+
+        journal = self.journal(resume=True)
+        self.assertEqual(sorted(journal.done), ['ann', 'rod'])
+        self.assertTrue(journal.is_done('rod'))
+        self.assertFalse(journal.is_done('tom'))
+        journal.record({'user': 'jane', 'ok': True})
+        journal.close()
+        self.assertEqual(sorted(self.journal(resume=True).done),
+                         ['ann', 'jane', 'rod'])
+        # Without resume, a journal starts anew
+        self.assertEqual(len(self.journal()), 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_output_hash(self):
+        """The hash covers the auth db and settings, if any."""
+        self.assertIsNone(output_hash(self.tmpdir))
+        with open(os.path.join(self.tmpdir, pqc.SETTINGSNAME), 'wb') as f:
+            f.write('[Qgis]\n')
+        first = output_hash(self.tmpdir)
+        with open(os.path.join(self.tmpdir, pqc.AUTHDBNAME), 'wb') as f:
+            f.write('db')
+        self.assertNotEqual(output_hash(self.tmpdir), first)
+
+
+class ResumeTest(unittest.TestCase):
+    """Test a resumed batch run only provisions the users not done."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tmpdir, 'users.csv')
+        self.outdir = os.path.join(self.tmpdir, 'out')
+        # Inherited by the forked workers, see batch_worker_init()
+        pqc._WORKER_SESSION = pqc.ProvisionSession(
+            backend=MemoryBackend()).start()
+
+    def tearDown(self):
+        pqc._WORKER_SESSION.close()
+        pqc._WORKER_SESSION = None
+        shutil.rmtree(self.tmpdir)
+
+    def run_batch(self, rows, resume=False):
+        with open(self.manifest, 'wb') as f:
+            f.write('user,masterpass\n' + rows)
+        report = pqc.BatchReport(StringIO())
+        failures = pqc.batch_main(self.manifest, self.outdir, PKIDATA,
+                                  processes=1, report=report, resume=resume)
+        return failures, report
+
+    def test_resume(self):
+        """Done users are skipped, failed ones retried."""
+        failures, report = self.run_batch('rod,pass\njane,\nbob,pass\n')
+        self.assertEqual((failures, report.done), (1, 3))
+        journal = Journal(os.path.join(self.outdir, JOURNALNAME), True)
+        self.assertEqual(sorted(journal.done), ['bob', 'rod'])
+        self.assertTrue(journal.done['rod']['configid'])
+        journal.close()
+
+        failures, report = self.run_batch('rod,pass\njane,pass\nbob,pass\n',
+                                          resume=True)
+        self.assertEqual((failures, report.done, report.skipped), (0, 1, 2))
+        self.assertIn('Skipped 2 users already done', report.out.getvalue())
+
+        # Not resumed: everyone again
+        failures, report = self.run_batch('rod,pass\njane,pass\n')
+        self.assertEqual((report.done, report.skipped), (2, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
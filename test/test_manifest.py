@@ -0,0 +1,120 @@
+# coding=utf-8
+"""Tests for streaming user manifests.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-14'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+from manifest import (
+    CSV,
+    JSONL,
+    ManifestError,
+    iter_manifest,
+    manifest_passphrases,
+    parse_manifest,
+    read_manifest,
+    record_error
+)
+
+
+class ManifestTest(unittest.TestCase):
+    """Test CSV and JSON lines manifests are read as streams."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(text)
+        return path
+
+    def test_csv(self):
+        """CSV rows get the fallback pkidir and default passphrase."""
+        path = self.write('users.csv', 'user,masterpass,pkidir\n'
+                                       'rod,pass,\n'
+                                       'jane,secret,/srv/PKI/jane\n')
+        records = read_manifest(path, '/srv/PKI')
+        self.assertEqual([r['pkidir'] for r in records],
+                         ['/srv/PKI', '/srv/PKI/jane'])
+        self.assertEqual(records[0]['passphrase'], 'password')
+
+    def test_jsonl(self):
+        """JSON lines are detected without an extension, past blank lines."""
+        path = self.write('users', '\n{"user": "rod", "masterpass": "p"}\n'
+                                   '\n{"user": "jane", "masterpass": "s",'
+                                   ' "passphrase": "k"}\n')
+        records = read_manifest(path, '/srv/PKI')
+        self.assertEqual([r['user'] for r in records], ['rod', 'jane'])
+        self.assertEqual(records[1]['passphrase'], 'k')
+
+        path = self.write('bad.jsonl', '{"user": "rod"}\n\n[1, 2]\n')
+        with self.assertRaisesRegexp(ManifestError, 'line 3'):
+            read_manifest(path)
+        path = self.write('bad.jsonl', '{"user": "rod"}\n{"user": 5}\n')
+        with self.assertRaisesRegexp(ManifestError,
+                                     'line 2 field user is not a string'):
+            read_manifest(path)
+
+    def test_streamed(self):
+        """Records are yielded as lines are read, not after the last one."""
+        consumed = []
+
+        def lines():
+            for line in ('user,masterpass\n', 'rod,p\n', 'jane,s\n'):
+                consumed.append(line)
+                yield line
+
+        records = parse_manifest(lines(), CSV)
+        self.assertEqual(next(records)['user'], 'rod')
+        self.assertEqual(len(consumed), 2)
+        self.assertEqual([r['user'] for r in parse_manifest(
+            ['{"user": "rod"}\n'], JSONL)], ['rod'])
+
+    def test_passphrases(self):
+        """Distinct passphrases are collected, with the default."""
+        path = self.write('users.csv', 'user,masterpass,passphrase\n'
+                                       'rod,p,k\njane,s,\nbob,t,k\n')
+        self.assertEqual(manifest_passphrases(path, ['x', '']), ['k', 'x'])
+        path = self.write('users.jsonl', '{"user": "rod"}\n')
+        self.assertEqual(manifest_passphrases(path), ['password'])
+
+    def test_missing(self):
+        """A missing manifest fails when opened, before any iteration."""
+        with self.assertRaises(IOError):
+            iter_manifest(os.path.join(self.tmpdir, 'missing.csv'))
+
+    def test_record_error(self):
+        """Missing fields, and user names that are paths, are errors."""
+        record = {'user': 'rod', 'masterpass': '', 'pkidir': '/srv/PKI'}
+        self.assertEqual(record_error(record),
+                         'Missing masterpass in manifest')
+        self.assertIsNone(record_error(record, ('user', 'pkidir')))
+        record['masterpass'] = 'pass'
+        self.assertIsNone(record_error(record))
+        for user in ('../../x', '/etc/x', 'a/b', '..', '.'):
+            record['user'] = user
+            self.assertTrue(record_error(record).startswith('Bad user name'),
+                            user)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# coding=utf-8
+"""Tests for master password sources.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-15'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import passwords
+from manifest import make_record
+
+
+class StandInDirectory(object):
+    """Local stand-in for an LDAP server, answering OR-ed uid searches."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.searches = []
+        self.binds = 0
+
+    def connect(self):
+        self.binds += 1
+        return StandInConnection(self)
+
+
+class StandInConnection(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def search_s(self, base, scope, filt, attrs):
+        users = [re.sub(r'\\([0-9a-f]{2})',
+                        lambda m: chr(int(m.group(1), 16)), u)
+                 for u in re.findall(r'\(uid=([^()]*)\)', filt)]
+        self.server.searches.append(users)
+        return [('uid={0},{1}'.format(u, base),
+                 {'uid': [u], 'qgisMasterPassword': [self.server.entries[u]]})
+                for u in users if u in self.server.entries]
+
+    def unbind_s(self):
+        pass
+
+
+class PasswordsTest(unittest.TestCase):
+    """Test password sources, and batching of directory lookups."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def directory(self, server, **kwargs):
+        return passwords.DirectoryPasswordSource(
+            'ldap://localhost', 'ou=people,dc=example,dc=com',
+            connect=server.connect, **kwargs)
+
+    def test_file(self):
+        """File lines are user:password, and the password may hold ':'."""
+        path = os.path.join(self.tmpdir, 'passwords')
+        with open(path, 'wb') as f:
+            f.write('# users\nrod:pass:word\n\njane:secret\n')
+        source = passwords.source_from_uri('file:' + path)
+        self.assertEqual(source.lookup(['rod', 'jane', 'bob']),
+                         {'rod': 'pass:word', 'jane': 'secret'})
+        self.assertRaises(passwords.PasswordError,
+                          passwords.FilePasswordSource(path + 'x').get, 'rod')
+
+    def test_env(self):
+        """Environment variables are per user, with {user} in the name."""
+        os.environ['TEST_MASTERPASS_rod'] = 'pass'
+        os.environ['TEST_{0}_rod'] = 'braced'
+        try:
+            source = passwords.source_from_uri('env:TEST_MASTERPASS_{user}')
+            self.assertEqual(source.lookup(['rod', 'jane']), {'rod': 'pass'})
+            # Other braces in the name are left as they are
+            source = passwords.source_from_uri('env:TEST_{0}_{user}')
+            self.assertEqual(source.lookup(['rod']), {'rod': 'braced'})
+        finally:
+            del os.environ['TEST_MASTERPASS_rod']
+            del os.environ['TEST_{0}_rod']
+
+    def test_directory_batches(self):
+        """Users are searched for in batches, and cached."""
+        server = StandInDirectory(dict(
+            ('user{0}'.format(i), 'pass{0}'.format(i)) for i in range(1200)))
+        source = self.directory(server, batch_size=500)
+        users = ['user{0}'.format(i) for i in range(1200)] + ['nobody']
+        found = source.lookup(users)
+        self.assertEqual(len(found), 1200)
+        self.assertEqual(found['user7'], 'pass7')
+        self.assertEqual(sorted(len(s) for s in server.searches),
+                         [201, 500, 500])
+        self.assertEqual(server.binds, 1)
+
+        # found and not found users are both cached
+        self.assertEqual(source.get('user7'), 'pass7')
+        self.assertIsNone(source.get('nobody'))
+        self.assertEqual(len(server.searches), 3)
+
+        # expired users are searched for again
+        source.close()
+        source = self.directory(server, ttl=-1)
+        self.assertEqual(source.get('user7'), 'pass7')
+        self.assertEqual(source.get('user7'), 'pass7')
+        self.assertEqual(len(server.searches), 5)
+        source.close()
+
+    def test_directory_escapes(self):
+        """User names can not widen the search filter."""
+        server = StandInDirectory({'a*': 'pass'})
+        self.assertEqual(self.directory(server).lookup(['a*', 'a)(uid=*']),
+                         {'a*': 'pass'})
+        self.assertEqual(sorted(server.searches[0]), ['a)(uid=*', 'a*'])
+
+    def test_fill_passwords(self):
+        """Records without a master password are filled in, in batches."""
+        server = StandInDirectory({'rod': 'pass', 'jane': 'secret'})
+        records = [make_record({'user': 'rod'}),
+                   make_record({'user': 'jane', 'masterpass': 'given'}),
+                   make_record({'user': 'bob'})]
+        filled = list(passwords.fill_passwords(
+            iter(records), self.directory(server), batch_size=2))
+        self.assertEqual([r['masterpass'] for r in filled],
+                         ['pass', 'given', ''])
+        self.assertEqual(server.searches, [['rod'], ['bob']])
+
+    def test_uri(self):
+        """LDAP URIs name the base DN and attributes."""
+        source = passwords.source_from_uri(
+            'ldap://ldap.example.com:389/ou=people,dc=example,dc=com'
+            '?cn,userPassword', connect=StandInDirectory({}).connect)
+        self.assertEqual(source.uri, 'ldap://ldap.example.com:389')
+        self.assertEqual(source.base, 'ou=people,dc=example,dc=com')
+        self.assertEqual((source.user_attr, source.password_attr),
+                         ('cn', 'userPassword'))
+        self.assertRaises(passwords.PasswordError,
+                          passwords.source_from_uri, 'ftp://host')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# coding=utf-8
+"""Tests for the indexed PKI directory scanner.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-04'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import pkiutils
+from pki_index import PkiIndex, index_path, user_credentials
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class PkiIndexTest(unittest.TestCase):
+    """Test indexing of the sample PKI data."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.pkidir = tempfile.mkdtemp()
+        for name in os.listdir(PKIDATA):
+            shutil.copy(os.path.join(PKIDATA, name), self.pkidir)
+        self.cachedir = tempfile.mkdtemp()
+        self.index = self.open(['password'])
+
+    def tearDown(self):
+        """Runs after each test."""
+        self.index.close()
+        shutil.rmtree(self.pkidir)
+        shutil.rmtree(self.cachedir)
+
+    def open(self, passphrases=()):
+        return PkiIndex(self.pkidir, index_path(self.pkidir, self.cachedir),
+                        passphrases)
+
+    def test_credentials(self):
+        """Users' components are found by name, CN and public key."""
+        self.assertEqual(self.index.update()['parsed'], 11)
+        creds = self.index.credentials('rod')
+        self.assertEqual(creds['bundle'], os.path.join(self.pkidir, 'rod.p12'))
+        self.assertEqual(creds['cert'],
+                         os.path.join(self.pkidir, 'rod_cert.pem'))
+        self.assertIn(os.path.basename(creds['key']),
+                      ('rod_key.pem', 'rod_key_pass.pem'))
+        self.assertEqual(creds['issuer'], os.path.join(self.pkidir, 'ca.pem'))
+        self.assertTrue(creds['issuer_self_signed'])
+
+        creds = self.index.credentials('nobody')
+        self.assertIsNone(creds['bundle'])
+        self.assertIsNone(creds['cert'])
+        # Nothing is written to the PKI directory, which may be read-only
+        self.assertEqual(sorted(os.listdir(self.pkidir)),
+                         sorted(os.listdir(PKIDATA)))
+
+    def test_user_credentials(self):
+        """Users with their own PKI directory are not looked up."""
+        self.index.update()
+        os.rename(os.path.join(self.pkidir, 'rod.p12'),
+                  os.path.join(self.pkidir, 'rod_2014.p12'))
+        self.index.update()
+        creds = user_credentials('rod', self.pkidir + os.sep, self.index)
+        self.assertEqual(creds['bundle'],
+                         os.path.join(self.pkidir, 'rod_2014.p12'))
+        self.assertEqual(user_credentials('rod', PKIDATA, self.index),
+                         user_credentials('rod', PKIDATA))
+        self.assertEqual(user_credentials('rod', PKIDATA)['bundle'],
+                         os.path.join(PKIDATA, 'rod.p12'))
+
+    def test_incremental_update(self):
+        """Only changed files are re-parsed, removed files are dropped."""
+        self.index.update()
+        self.assertEqual(self.index.update(),
+                         {'parsed': 0, 'unchanged': 11, 'removed': 0})
+
+        os.remove(os.path.join(self.pkidir, 'server_cert.pem'))
+        path = os.path.join(self.pkidir, 'ca.pem')
+        os.utime(path, (1, 1))
+        self.assertEqual(self.index.update(),
+                         {'parsed': 1, 'unchanged': 9, 'removed': 1})
+
+        entries = dict((e['path'], e) for e in self.index.entries())
+        self.assertEqual(entries[path]['kind'], pkiutils.CERT)
+        self.assertEqual(entries[path]['subject'], entries[path]['issuer'])
+        self.assertTrue(entries[os.path.join(self.pkidir, 'wrong_cert.pem')]
+                        ['error'])
+
+    def test_update_paths(self):
+        """Only the given paths, or trees, are re-checked."""
+        self.index.update()
+        ca = os.path.join(self.pkidir, 'ca.pem')
+        os.utime(ca, (1, 1))
+        os.remove(os.path.join(self.pkidir, 'server_cert.pem'))
+        self.assertEqual(self.index.update([ca]),
+                         {'parsed': 1, 'unchanged': 0, 'removed': 0})
+        self.assertEqual(
+            self.index.update([os.path.join(self.pkidir, 'server_cert.pem'),
+                               os.path.join(self.pkidir, '.hidden')]),
+            {'parsed': 0, 'unchanged': 0, 'removed': 1})
+        self.assertEqual(self.index.update([self.pkidir + os.sep]),
+                         {'parsed': 0, 'unchanged': 10, 'removed': 0})
+
+    def test_passphrases_changed(self):
+        """Encrypted files that failed are re-parsed with new candidates."""
+        self.index.close()
+        self.index = self.open()
+        self.index.update()
+        bundle = os.path.join(self.pkidir, 'rod.p12')
+        entries = dict((e['path'], e) for e in self.index.entries())
+        self.assertTrue(entries[bundle]['error'])
+        self.assertIsNone(entries[bundle]['issuer'])
+        self.assertEqual(self.index.update()['parsed'], 0)
+        self.index.close()
+
+        self.index = self.open(['password'])
+        # The bundle, and the encrypted key
+        self.assertEqual(self.index.update([bundle])['parsed'], 2)
+        entries = dict((e['path'], e) for e in self.index.entries())
+        self.assertIsNone(entries[bundle]['error'])
+        self.assertTrue(entries[bundle]['issuer'])
+        self.assertEqual(self.index.update()['parsed'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# coding=utf-8
+"""Tests for planning the changes to users' auth dbs and settings.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-16'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import authstore
+import connections
+import planner
+import populate_qgis_creds as pqc
+from backends import MemoryBackend, PKI_PKCS12
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+AUTHDBDIR = '/srv/qgis-auth/rod'
+
+
+class PlannerTest(unittest.TestCase):
+    """Test plans hold only the changes needed, and apply only those."""
+
+    def setUp(self):
+        self.backend = MemoryBackend()
+        self.session = pqc.ProvisionSession(backend=self.backend).start()
+
+    def tearDown(self):
+        self.session.close()
+
+    def config(self):
+        return pqc.build_config(
+            'rod', PKIDATA, configcls=self.backend.config_class(PKI_PKCS12))
+
+    def test_dry_run(self):
+        """A dry run plans from empty, without creating the auth db."""
+        res = self.session.provision('rod', 'pass', PKIDATA, AUTHDBDIR,
+                                     dryrun=True, describe=True)
+        self.assertEqual((res['action'], res['configid']),
+                         (authstore.STORED, None))
+        self.assertEqual((res['written'], res['skipped']), (26, 0))
+        self.assertEqual(res['plan'][0], 'store config: My PKI PKCS#12 Config')
+        self.assertFalse(self.backend.db_exists(AUTHDBDIR))
+
+        self.session.provision('rod', 'pass', PKIDATA, AUTHDBDIR)
+        res = self.session.provision('rod', 'pass', PKIDATA, AUTHDBDIR,
+                                     dryrun=True)
+        self.assertEqual((res['action'], res['written'], res['removed']),
+                         (authstore.UNCHANGED, 0, 0))
+
+    def test_minimal_writes(self):
+        """Only changed settings are planned, and nothing else is synced."""
+        first = self.session.provision('rod', 'pass', PKIDATA, AUTHDBDIR)
+        settings = self.session.settings()
+        settings.setValue('/Qgis/connections-wms/My WMS SSL Server/dpiMode',
+                          4)
+        syncs = settings.syncs
+
+        plan = self.session.plan('rod', 'pass', PKIDATA, AUTHDBDIR)
+        self.assertEqual(plan.writes, [
+            ('/Qgis/connections-wms/My WMS SSL Server/dpiMode', 7)])
+        self.assertEqual(plan.unchanged, 25)
+        self.assertEqual(
+            planner.apply_plan(self.session.authm, settings, plan),
+            first['configid'])
+        self.assertEqual(settings.syncs, syncs + 1)
+
+        plan = self.session.plan('rod', 'pass', PKIDATA, AUTHDBDIR)
+        self.assertTrue(plan.empty)
+        planner.apply_plan(self.session.authm, settings, plan)
+        self.assertEqual(settings.syncs, syncs + 1)
+
+    def test_duplicates(self):
+        """Duplicates are removed, and their other connections relinked."""
+        self.session.switch_db(AUTHDBDIR)
+        authm = self.session.authm
+        authm.setMasterPassword('pass', True)
+        stale = self.config()
+        stale.setIssuerSelfSigned(False)
+        authm.storeAuthenticationConfig(stale)
+        current = self.config()
+        authm.storeAuthenticationConfig(current)
+        settings = self.session.settings()
+        settings.setValue('/Qgis/WFS/Other Server/authid', stale.id())
+
+        plan = planner.plan_user(authm, settings, self.config(),
+                                 connections.compile_spec(
+                                     connections.load_spec()))
+        self.assertEqual((plan.action, plan.configid, plan.removals),
+                         (authstore.UNCHANGED, current.id(), [stale.id()]))
+        self.assertIn(('/Qgis/WFS/Other Server/authid', connections.AUTHID),
+                      plan.writes)
+
+        planner.apply_plan(authm, settings, plan)
+        self.assertEqual(authm.configIds(), [current.id()])
+        self.assertEqual(settings.value('/Qgis/WFS/Other Server/authid'),
+                         current.id())
+        authm.clearMasterPassword()
+
+if __name__ == '__main__':
+    unittest.main()
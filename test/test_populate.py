@@ -0,0 +1,166 @@
+# coding=utf-8
+"""Tests for provisioning, against the in-memory backend, without QGIS.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-13'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import authstore
+import populate_qgis_creds as pqc
+from backends import MemoryBackend
+from manifest import make_record
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class PopulateTest(unittest.TestCase):
+    """Test provisioning logic runs, and QGIS is only loaded when needed."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_no_qgis_import(self):
+        """Importing the script does not load QGIS."""
+        # In a fresh interpreter, as this one may have loaded anything
+        loaded = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys; sys.path.insert(0, {0!r}); '
+            'import populate_qgis_creds; '
+            'print sorted(set(m.split(".")[0] for m in sys.modules))'.format(
+                AUTH_SYSTEM_DIR)])
+        self.assertIn("'populate_qgis_creds'", loaded)
+        self.assertNotIn("'qgis'", loaded)
+        self.assertNotIn("'PyQt4'", loaded)
+
+    def test_provision(self):
+        """Users are provisioned once, and re-runs change nothing."""
+        session = pqc.ProvisionSession(backend=MemoryBackend()).start()
+        authdbdir = os.path.join(self.tmpdir, 'rod')
+        first = session.provision('rod', 'pass', PKIDATA, authdbdir)
+        self.assertEqual(first['action'], authstore.STORED)
+        self.assertEqual((first['written'], first['skipped']), (26, 0))
+
+        again = session.provision('rod', 'pass', PKIDATA, authdbdir)
+        self.assertEqual(again['configid'], first['configid'])
+        self.assertEqual(again['action'], authstore.UNCHANGED)
+        self.assertEqual((again['written'], again['skipped']), (0, 26))
+
+        settings = session.settings()
+        self.assertEqual(
+            settings.value('/Qgis/WMS/My WMS SSL Server/authid'),
+            first['configid'])
+        self.assertFalse(session.authm.masterPasswordIsSet())
+
+        with self.assertRaises(pqc.PopulateError):
+            session.provision('rod', 'wrong', PKIDATA, authdbdir)
+        session.close()
+
+    def test_check(self):
+        """Check mode validates users without provisioning them."""
+        records = [make_record({'user': 'rod', 'masterpass': 'pass'},
+                               PKIDATA),
+                   make_record({'user': 'jane', 'masterpass': 'pass'},
+                               PKIDATA)]
+        out = StringIO()
+        sys.stdout, stdout = out, sys.stdout
+        try:
+            failures = pqc.check_main(records, self.tmpdir, processes=1,
+                                      allow_expired=True)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(failures, 1)
+        self.assertIn('Would provision 1 of 2 users', out.getvalue())
+
+    def test_batch_provision(self):
+        """Batch workers pre-flight users, and report why they failed."""
+        pqc._WORKER_SESSION = pqc.ProvisionSession(
+            backend=MemoryBackend()).start()
+        try:
+            rod = make_record({'user': 'rod', 'masterpass': 'p'}, PKIDATA)
+            options = {'checkfirst': True, 'allow_expired': True}
+            res = pqc.batch_provision((rod, self.tmpdir, options))
+            self.assertTrue(res['ok'], res.get('error'))
+            self.assertEqual(res['action'], authstore.STORED)
+
+            res = pqc.batch_provision((rod, self.tmpdir,
+                                       {'checkfirst': True}))
+            self.assertFalse(res['ok'])
+            self.assertTrue(res['error'].startswith('Pre-flight expiry'))
+
+            res = pqc.batch_provision(
+                (make_record({'user': 'jane'}, PKIDATA), self.tmpdir,
+                 options))
+            self.assertEqual(res['error'], 'Missing masterpass in manifest')
+        finally:
+            pqc._WORKER_SESSION.close()
+            pqc._WORKER_SESSION = None
+
+    def test_batch_user_error(self):
+        """Any error provisioning a user fails them, not the batch."""
+        session = pqc.ProvisionSession(backend=MemoryBackend()).start()
+        provision = session.provision
+
+        def broken(user, *args):
+            if user == 'jane':
+                raise IOError('Corrupt auth db')
+            return provision(user, *args)
+
+        session.provision = broken
+        # Inherited by the forked workers, see batch_worker_init()
+        pqc._WORKER_SESSION = session
+        manifest = os.path.join(self.tmpdir, 'users.csv')
+        with open(manifest, 'wb') as f:
+            f.write('user,masterpass\nrod,pass\njane,pass\nbob,pass\n')
+        out = StringIO()
+        report = pqc.BatchReport(out)
+        try:
+            failures = pqc.batch_main(manifest,
+                                      os.path.join(self.tmpdir, 'out'),
+                                      PKIDATA, processes=1, report=report)
+        finally:
+            pqc._WORKER_SESSION.close()
+            pqc._WORKER_SESSION = None
+        self.assertEqual((failures, report.done), (1, 3))
+        self.assertIn('FAIL  jane: Corrupt auth db', out.getvalue())
+
+    def test_batch_report(self):
+        """Results stream as JSON lines, with periodic progress."""
+        out = StringIO()
+        report = pqc.BatchReport(out, jsonl=True, every=2)
+        report.start('-', self.tmpdir, 1)
+        for user in ('rod', 'jane', 'bob'):
+            report.result({'user': user, 'ok': user != 'jane',
+                           'error': 'bad'})
+        self.assertEqual(report.finish(), 1)
+
+        events = [json.loads(l) for l in out.getvalue().splitlines()]
+        self.assertEqual([e['event'] for e in events],
+                         ['start', 'result', 'result', 'progress', 'result',
+                          'summary'])
+        self.assertEqual((events[3]['done'], events[3]['failed']), (2, 1))
+        self.assertEqual((events[-1]['ok'], events[-1]['failed']), (2, 1))
+
+if __name__ == '__main__':
+    unittest.main()
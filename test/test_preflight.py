@@ -0,0 +1,99 @@
+# coding=utf-8
+"""Tests for pre-flight validation of PKI components.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-05'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+from preflight import check_credentials, preflight
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+def creds(bundle=None, cert=None, key=None, issuer='ca.pem'):
+    return dict(
+        (k, os.path.join(PKIDATA, v) if v else None) for k, v in
+        (('bundle', bundle), ('cert', cert), ('key', key), ('issuer', issuer)))
+
+
+class PreflightTest(unittest.TestCase):
+    """Test pre-flight checks against the sample PKI data."""
+
+    def failed(self, checks):
+        """Name of the failed check, or None if all ran and passed."""
+        for check, passed, _ in checks:
+            if not passed:
+                return check
+        self.assertEqual(len(checks), 5)
+        return None
+
+    def test_bundle(self):
+        """PKCS#12 bundle passes only with its passphrase."""
+        self.assertIsNone(self.failed(check_credentials(
+            creds(bundle='rod.p12'), 'password', allow_expired=True)))
+        self.assertEqual(self.failed(check_credentials(
+            creds(bundle='rod.p12'), 'wrong', allow_expired=True)), 'decrypt')
+        # sample certs expired in 2018
+        self.assertEqual(self.failed(check_credentials(
+            creds(bundle='rod.p12'), 'password')), 'expiry')
+
+    def test_cert_key_pairs(self):
+        """PEM pairs must decrypt, match and chain to the issuer."""
+        self.assertIsNone(self.failed(check_credentials(
+            creds(cert='rod_cert.pem', key='rod_key_pass.pem'), 'password',
+            allow_expired=True)))
+        self.assertEqual(self.failed(check_credentials(
+            creds(cert='rod_cert.pem', key='rod_key_pass.pem'), 'wrong',
+            allow_expired=True)), 'decrypt')
+        self.assertEqual(self.failed(check_credentials(
+            creds(cert='server_cert.pem', key='rod_key.pem'), '',
+            allow_expired=True)), 'keymatch')
+        self.assertEqual(self.failed(check_credentials(
+            creds(cert='wrong_cert.pem', key='rod_key.pem'), '',
+            allow_expired=True)), 'decrypt')
+        self.assertEqual(self.failed(check_credentials(
+            creds(cert='rod_cert.pem', key='rod_key.pem',
+                  issuer='server_cert.pem'), '', allow_expired=True)),
+            'chain')
+        self.assertEqual(self.failed(check_credentials(
+            creds(cert='nobody_cert.pem', key='rod_key.pem'), '')), 'found')
+
+    def test_der(self):
+        """DER certs, keys and issuers are converted to verify the chain."""
+        self.assertIsNone(self.failed(check_credentials(
+            creds(cert='rod_cert.der', key='rod_key.der', issuer='ca.der'),
+            '', allow_expired=True)))
+        self.assertEqual(self.failed(check_credentials(
+            creds(cert='rod_cert.der', key='rod_key.der',
+                  issuer='server_cert.pem'), '', allow_expired=True)),
+            'chain')
+
+    def test_preflight_pool(self):
+        """Results come back per record, in order."""
+        records = [
+            {'user': 'rod', 'masterpass': 'pass', 'pkidir': PKIDATA,
+             'passphrase': 'password'},
+            {'user': 'rod', 'masterpass': 'pass', 'pkidir': PKIDATA,
+             'passphrase': 'wrong'},
+            {'user': 'rod', 'masterpass': '', 'pkidir': PKIDATA,
+             'passphrase': 'password'},
+        ]
+        results = preflight(records, processes=2, allow_expired=True)
+        self.assertEqual([r['ok'] for r in results], [True, False, False])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# coding=utf-8
+"""Tests for the provisioning profiler mode.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-12'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import glob
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import profiling
+
+
+def busy(n):
+    return sum(i * i for i in xrange(n))
+
+
+class ProfilingTest(unittest.TestCase):
+    """Test profiles are written as pstats and collapsed stacks."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpdir, 'run')
+
+    def tearDown(self):
+        os.environ.pop(profiling.PROFILE_VAR, None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_profiler(self):
+        """Profiled calls show up in both outputs."""
+        profiler = profiling.Profiler(self.prefix, interval=0.001).start()
+        busy(2000000)
+        paths = profiler.stop()
+        self.assertEqual(paths[0], self.prefix + '.pstats')
+        funcs = [f[2] for f in pstats.Stats(paths[0]).stats]
+        self.assertIn('busy', funcs)
+
+        if len(paths) > 1:
+            with open(paths[1]) as f:
+                lines = f.read().splitlines()
+            self.assertTrue(lines)
+            stack, weight = lines[0].rsplit(' ', 1)
+            self.assertTrue(int(weight) >= 0)
+            self.assertTrue(any('busy (test_profiling.py' in l
+                                for l in lines))
+        self.assertEqual(profiler.stop(), [])
+
+    def test_profiled(self):
+        """Decorated calls are only profiled with POPULATE_PROFILE set."""
+        func = profiling.profiled(busy)
+        self.assertEqual(func(10), busy(10))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        os.environ[profiling.PROFILE_VAR] = self.prefix
+        self.assertEqual(func(10), busy(10))
+        self.assertEqual(len(glob.glob(self.prefix + '.*.pstats')), 1)
+
+if __name__ == '__main__':
+    unittest.main()
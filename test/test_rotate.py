@@ -0,0 +1,156 @@
+# coding=utf-8
+"""Tests for master password rotation, against the in-memory backend.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-18'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import rotate_masterpass as rot
+from backends import MemoryBackend
+from manifest import ManifestError, make_record
+from populate_qgis_creds import ProvisionSession
+from scheduler import Scheduler
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class RotateTest(unittest.TestCase):
+    """Test rotation verifies, restores on failure, and checkpoints."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.session = ProvisionSession(backend=MemoryBackend()).start()
+        self.authdbdir = os.path.join(self.tmpdir, 'rod')
+        self.session.provision('rod', 'old', PKIDATA, self.authdbdir)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def unlocks(self, masterpass):
+        self.session.switch_db(self.authdbdir)
+        try:
+            return self.session.authm.setMasterPassword(masterpass, True)
+        finally:
+            self.session.authm.clearMasterPassword()
+
+    def test_rotate(self):
+        """The new password unlocks every config, and re-runs are no-ops."""
+        res = rot.rotate_db(self.session, self.authdbdir, 'old', 'new', 's1')
+        self.assertEqual(res['action'], rot.ROTATED)
+        self.assertEqual(res['configs'], 1)
+        self.assertEqual(res['backup'], rot.backup_path(self.authdbdir, 's1'))
+        self.assertIn(res['backup'], self.session.backend.backups)
+        self.assertTrue(self.unlocks('new'))
+        self.assertFalse(self.unlocks('old'))
+        self.assertFalse(self.session.authm.masterPasswordIsSet())
+
+        res = rot.rotate_db(self.session, self.authdbdir, 'old', 'new', 's2')
+        self.assertEqual(res['action'], rot.ALREADY)
+
+        with self.assertRaises(rot.RotateError):
+            rot.rotate_db(self.session, self.authdbdir, 'bad', 'worse', 's3')
+        with self.assertRaises(rot.RotateError):
+            rot.rotate_db(self.session, os.path.join(self.tmpdir, 'jane'),
+                          'old', 'new', 's3')
+
+    def test_restore(self):
+        """A rotation that fails verification is rolled back."""
+        authm = self.session.authm
+        reset = authm.resetMasterPassword
+
+        def half_reset(newpass, *args):
+            # Re-keys the db, then reports failure
+            reset(newpass, *args)
+            return False
+        authm.resetMasterPassword = half_reset
+        with self.assertRaises(rot.RotateError) as cm:
+            rot.rotate_db(self.session, self.authdbdir, 'old', 'new', 's1')
+        self.assertIn('restored from', str(cm.exception))
+        del authm.resetMasterPassword
+        self.assertTrue(self.unlocks('old'))
+        self.assertFalse(self.unlocks('new'))
+
+    def test_rotate_user(self):
+        """Workers report missing passwords, and rotate through a scheduler."""
+        rot._WORKER_SESSION = self.session
+        rot._WORKER_SCHEDULER = Scheduler(retries=0)
+        try:
+            record = make_record({'user': 'rod', 'masterpass': 'old',
+                                  'newpass': 'new'})
+            res = rot._rotate_user((record, self.tmpdir, 's1'))
+            self.assertTrue(res['ok'], res.get('error'))
+            self.assertEqual((res['action'], res['retries']),
+                             (rot.ROTATED, 0))
+
+            res = rot._rotate_user(
+                (make_record({'user': 'rod', 'masterpass': 'new'}),
+                 self.tmpdir, 's2'))
+            self.assertEqual(res['error'], 'Missing newpass in manifest')
+        finally:
+            rot._WORKER_SESSION = rot._WORKER_SCHEDULER = None
+
+    def test_bad_manifest(self):
+        """A manifest error stops the pool, and is raised as it is."""
+        manifest = os.path.join(self.tmpdir, 'users.jsonl')
+        with open(manifest, 'wb') as f:
+            f.write('{"user": "rod", "masterpass": "old", "newpass": "new"}\n'
+                    '{"user": "jane", \n')
+        # Inherited by the forked workers, see _worker_init()
+        rot._WORKER_SESSION = self.session
+        sys.stdout, stdout = StringIO(), sys.stdout
+        try:
+            self.assertRaises(ManifestError, rot.rotate_main, manifest,
+                              self.tmpdir, processes=1)
+        finally:
+            sys.stdout = stdout
+            rot._WORKER_SESSION = None
+
+    def test_checkpoint(self):
+        """Successful users are skipped on resume, to the same password."""
+        path = os.path.join(self.tmpdir, rot.CHECKPOINT)
+        checkpoint = rot.Checkpoint(path)
+        target = checkpoint.target('new')
+        checkpoint.record({'user': 'rod', 'ok': True, 'target': target})
+        checkpoint.record({'user': 'jane', 'ok': False, 'error': 'x',
+                           'target': target})
+        checkpoint.close()
+        with open(path, 'ab') as f:
+            f.write('{"user": "fre')  # interrupted mid-line
+        with open(path, 'rb') as f:
+            self.assertNotIn('new', f.read())
+
+        resumed = rot.Checkpoint(path)
+        self.assertEqual(resumed.done, {'rod': target})
+        self.assertTrue(resumed.is_done({'user': 'rod', 'newpass': 'new'}))
+        # The next rotation, to another password
+        self.assertFalse(resumed.is_done({'user': 'rod', 'newpass': 'newer'}))
+        self.assertFalse(resumed.is_done({'user': 'jane', 'newpass': 'new'}))
+        resumed.close()
+        restarted = rot.Checkpoint(path, restart=True)
+        self.assertEqual(restarted.done, {})
+        self.assertNotEqual(restarted.target('new'), target)
+        restarted.close()
+        with open(path, 'rb') as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# coding=utf-8
+"""Tests for lock-aware scheduling of jobs on auth dbs.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-17'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import scheduler
+from scheduler import LockError, Scheduler, is_locked
+
+
+class SchedulerTest(unittest.TestCase):
+    """Test jobs retry on locks, with backoff, and are held apart."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sleeps = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def new_scheduler(self, **kwargs):
+        return Scheduler(sleep=self.sleeps.append, rand=lambda: 1.0,
+                         **kwargs)
+
+    def test_backoff(self):
+        """Backoff doubles from the base delay, up to the cap."""
+        sched = self.new_scheduler(base_delay=0.1, max_delay=0.5)
+        self.assertEqual([sched.backoff(n) for n in range(4)],
+                         [0.1, 0.2, 0.4, 0.5])
+        sched = Scheduler(base_delay=0.1, rand=lambda: 0.25)
+        self.assertEqual(sched.backoff(1), 0.05)
+
+    def test_retry_lock_errors(self):
+        """Lock errors are retried; other errors are not."""
+        calls = []
+
+        def job():
+            calls.append(1)
+            if len(calls) < 3:
+                raise sqlite3.OperationalError('database is locked')
+            return 'done'
+
+        sched = self.new_scheduler(base_delay=0.1)
+        self.assertEqual(sched.run(self.tmpdir, job), 'done')
+        self.assertEqual(sched.last['retries'], 2)
+        self.assertEqual(self.sleeps, [0.1, 0.2])
+        self.assertAlmostEqual(sched.stats()['backoff_wait'], 0.3)
+
+        def broken():
+            raise ValueError('not a lock')
+
+        self.assertRaises(ValueError, sched.run, self.tmpdir, broken)
+        self.assertEqual(sched.stats()['retries'], 2)
+
+        del calls[:]
+        sched = self.new_scheduler(retries=1)
+        self.assertRaises(sqlite3.OperationalError, sched.run, self.tmpdir,
+                          job)
+        self.assertEqual(len(calls), 2)
+
+    def test_locked_db(self):
+        """Failures while the auth db is locked are retried."""
+        dbpath = os.path.join(self.tmpdir, 'qgis-auth.db')
+        holder = sqlite3.connect(dbpath)
+        holder.execute('CREATE TABLE t (x)')
+        holder.commit()
+        self.assertFalse(is_locked(dbpath))
+        holder.execute('BEGIN EXCLUSIVE')
+        self.assertTrue(is_locked(dbpath))
+
+        def job():
+            if is_locked(dbpath):
+                raise ValueError('Failed to store config')
+            return 'stored'
+
+        def release(delay):
+            self.sleeps.append(delay)
+            holder.rollback()
+
+        sched = Scheduler(sleep=release)
+        self.assertEqual(sched.run(self.tmpdir, job, dbpath=dbpath),
+                         'stored')
+        self.assertEqual(sched.last['retries'], 1)
+        holder.close()
+
+    @unittest.skipIf(scheduler.fcntl is None, 'Lock files need fcntl')
+    def test_one_job_per_target(self):
+        """A target whose lock file is held times out with LockError."""
+        target = os.path.join(self.tmpdir, 'rod')
+        sched = self.new_scheduler(lock_timeout=0.05)
+        with sched.slot(target):
+            other = Scheduler(lock_timeout=0.05)
+            self.assertRaises(LockError, other.run, target, lambda: None)
+            # other targets are not held up
+            self.assertEqual(other.run(self.tmpdir, lambda: 'ok'), 'ok')
+        self.assertEqual(other.run(target, lambda: 'ok'), 'ok')
+        # No lock file is left behind
+        self.assertEqual(os.listdir(target), [])
+        self.assertNotIn(scheduler.LOCKNAME, os.listdir(self.tmpdir))
+
+    @unittest.skipIf(scheduler.fcntl is None, 'Lock files need fcntl')
+    def test_removed_lock_file(self):
+        """A lock on a lock file removed by its last holder is taken anew."""
+        path = os.path.join(self.tmpdir, scheduler.LOCKNAME)
+        sched = self.new_scheduler(lock_timeout=0.05)
+        opened = []
+
+        def reopen(path, mode):
+            # The file opened first is removed, as by the holder before
+            f = open(path, mode)
+            if not opened:
+                os.remove(path)
+            opened.append(f)
+            return f
+        scheduler.open = reopen
+        try:
+            with sched.slot(self.tmpdir):
+                self.assertEqual(len(opened), 2)
+                self.assertTrue(opened[0].closed)
+                self.assertTrue(os.path.samestat(
+                    os.fstat(opened[1].fileno()), os.stat(path)))
+        finally:
+            del scheduler.open
+        self.assertFalse(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# coding=utf-8
+"""Tests for cloning auth dbs from a template, against the in-memory backend.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-08'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import auth_template as tpl
+from backends import MemoryBackend
+from populate_qgis_creds import SETTINGSNAME, PopulateError, ProvisionSession
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+WMS_AUTHID = 'Qgis/WMS/My WMS SSL Server/authid'
+
+
+class TemplateTest(unittest.TestCase):
+    """Test clones get the template's configs and settings, for their user."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.session = ProvisionSession(backend=MemoryBackend()).start()
+        self.templatedir = os.path.join(self.tmpdir, '.template')
+        self.templateid = tpl.build_template(
+            self.session, self.templatedir, 'tpass')['configid']
+        self.configs, self.settings = tpl.load_template(
+            self.session, self.templatedir, 'tpass')
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.tmpdir)
+
+    def clone(self, user, masterpass='pass'):
+        authdbdir = os.path.join(self.tmpdir, user)
+        ids = tpl.clone_template(self.session, self.configs, authdbdir, user,
+                                 PKIDATA, masterpass)
+        tpl.finalize_clone(self.session, self.settings, authdbdir, user,
+                           PKIDATA, ids)
+        return authdbdir, ids
+
+    def test_load_template(self):
+        """The template holds placeholders, and needs its own password."""
+        kind, config = self.configs[self.templateid]
+        self.assertEqual(config.bundlePath(),
+                         os.path.join(tpl.PLACEHOLDER_PKIDIR, '@USER@.p12'))
+        self.assertIn((WMS_AUTHID, self.templateid), self.settings)
+        self.assertRaises(PopulateError, tpl.load_template, self.session,
+                          self.templatedir, 'wrong')
+
+    def test_clone(self):
+        """A clone has the user's paths, password and linked settings."""
+        authdbdir, ids = self.clone('rod')
+        self.assertEqual(ids.keys(), [self.templateid])
+        cloneid = ids[self.templateid]
+        self.assertNotEqual(cloneid, self.templateid)
+
+        authm = self.session.authm
+        self.session.switch_db(authdbdir)
+        self.assertTrue(authm.setMasterPassword('pass', True))
+        kind, config = tpl.load_configs(self.session)[cloneid]
+        self.assertEqual(config.bundlePath(),
+                         os.path.join(PKIDATA, 'rod.p12'))
+        self.assertEqual(config.issuerPath(), os.path.join(PKIDATA, 'ca.pem'))
+        authm.clearMasterPassword()
+
+        settings = self.session.backend.settings(
+            os.path.join(authdbdir, SETTINGSNAME))
+        self.assertEqual(settings.value(WMS_AUTHID), cloneid)
+        self.assertEqual(len(settings.allKeys()), len(self.settings))
+
+        # The template's configs are left as they were
+        kind, config = self.configs[self.templateid]
+        self.assertEqual(config.id(), self.templateid)
+        self.assertIn(tpl.PLACEHOLDER_USER, config.bundlePath())
+
+    def test_existing(self):
+        """A user that already has an auth db is refused, and left as is."""
+        authdbdir, ids = self.clone('rod')
+        self.assertRaises(PopulateError, tpl.clone_template, self.session,
+                          self.configs, authdbdir, 'rod', PKIDATA, 'other')
+        self.session.switch_db(authdbdir)
+        self.assertEqual(self.session.authm.configIds(), ids.values())
+        self.assertTrue(self.session.authm.setMasterPassword('pass', True))
+        self.session.authm.clearMasterPassword()
+
+    def test_verify(self):
+        """Verify reports missing PKI components and a wrong password."""
+        authdbdir, _ = self.clone('rod')
+        self.assertEqual(tpl.verify_clone(self.session, authdbdir, 'pass'),
+                         [])
+        self.assertEqual(tpl.verify_clone(self.session, authdbdir, 'wrong'),
+                         ['Failed to verify master password'])
+
+        authdbdir, _ = self.clone('jane')
+        problems = tpl.verify_clone(self.session, authdbdir, 'pass')
+        self.assertEqual(len(problems), 1)
+        self.assertIn('bundlePath does not exist', problems[0])
+
+    def test_clone_main(self):
+        """Users are cloned by workers; failures are counted, not raised."""
+        manifest = os.path.join(self.tmpdir, 'users.jsonl')
+        with open(manifest, 'wb') as f:
+            f.write('{"user": "rod", "masterpass": "pass"}\n'
+                    '{"user": "jane", "masterpass": "pass"}\n'
+                    '{"user": "bob"}\n')
+        # Inherited by the forked workers, see _worker_init()
+        tpl._WORKER_SESSION = self.session
+        out = StringIO()
+        sys.stdout, stdout = out, sys.stdout
+        try:
+            failed = tpl.clone_main(manifest, self.tmpdir, 'tpass',
+                                    pkidir=PKIDATA, processes=1, verify=True)
+        finally:
+            sys.stdout = stdout
+            tpl._WORKER_SESSION = None
+        self.assertEqual(failed, 2)
+        self.assertIn('  OK    rod: 1 configs, ', out.getvalue())
+        self.assertIn('  FAIL  jane: ', out.getvalue())
+        self.assertIn('Cloned 1 of 3 users', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
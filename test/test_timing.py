@@ -0,0 +1,83 @@
+# coding=utf-8
+"""Tests for provisioning phase timers.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-11'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+from utilities import AUTH_SYSTEM_DIR
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import timing
+
+
+class TimingTest(unittest.TestCase):
+    """Test phases are traced only when tracing is started."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tracer = timing.Tracer()
+
+    def tearDown(self):
+        self.tracer.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_disabled(self):
+        """Phases are shared no-ops until tracing starts."""
+        self.assertIs(self.tracer.phase('a'), self.tracer.phase('b', x=1))
+        with self.tracer.phase('a'):
+            pass
+
+    def test_jsonl(self):
+        """Each phase is a JSON line, appended to by later tracers."""
+        path = os.path.join(self.tmpdir, 'trace.jsonl')
+        self.tracer.start(path)
+        with self.tracer.phase('store_config', user='rod'):
+            pass
+        with self.assertRaises(ValueError):
+            with self.tracer.phase('settings'):
+                raise ValueError()
+        worker = timing.Tracer()
+        worker.start(path, truncate=False)
+        with worker.phase('provision'):
+            pass
+        worker.stop()
+
+        with open(path) as f:
+            records = [json.loads(l) for l in f]
+        self.assertEqual([r['phase'] for r in records],
+                         ['store_config', 'settings', 'provision'])
+        self.assertEqual(records[0]['user'], 'rod')
+        self.assertEqual(records[1]['error'], 'ValueError')
+        self.assertTrue(records[0]['duration'] >= 0)
+
+    def test_chrome(self):
+        """Chrome trace events load as a JSON array once closed."""
+        path = os.path.join(self.tmpdir, 'trace.json')
+        self.tracer.start(path, timing.CHROME)
+        with self.tracer.phase('auth_init'):
+            pass
+        self.tracer.stop()
+
+        with open(path) as f:
+            events = json.loads(f.read().rstrip().rstrip(',') + ']')
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0]['name'], events[0]['ph']),
+                         ('auth_init', 'X'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,232 @@
+# coding=utf-8
+"""Tests for the PKI directory watcher, against the in-memory backend.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'lshaffer@boundlessgeo.com'
+__date__ = '2014-12-23'
+__copyright__ = 'Copyright 2014, Larry Shaffer/Boundless Spatial Inc.'
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from utilities import AUTH_SYSTEM_DIR, Clock
+sys.path.insert(0, AUTH_SYSTEM_DIR)
+
+import authstore
+import watch_pki
+from auth_template import load_configs
+from backends import MemoryBackend
+from manifest import make_record
+from pki_index import PkiIndex, index_path
+from populate_qgis_creds import BatchReport, ProvisionSession
+
+PKIDATA = os.path.join(AUTH_SYSTEM_DIR, 'pki_sample_data')
+
+
+class ScriptedWatcher(object):
+    """Watcher that reports scripted changes, each a second apart."""
+
+    def __init__(self, clock, changes):
+        self.clock = clock
+        self.changes = list(changes)
+        self.timeouts = []
+
+    def poll(self, timeout=None):
+        self.timeouts.append(timeout)
+        self.clock.now += 1
+        return set(self.changes.pop(0)) if self.changes else set()
+
+
+def write(path, data='x'):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class WatcherTest(unittest.TestCase):
+    """Test watchers report changed files, and bursts are debounced."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_watcher(self, watcher):
+        try:
+            path = os.path.join(self.tmpdir, 'rod.p12')
+            write(path)
+            write(os.path.join(self.tmpdir, '.pki-index.db'))
+            self.assertEqual(watcher.poll(5), set([path]))
+            self.assertEqual(watcher.poll(0.05), set())
+            os.remove(path)
+            self.assertEqual(watcher.poll(5), set([path]))
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        """Polling reports added, changed and removed files."""
+        self.check_watcher(watch_pki.PollingWatcher(self.tmpdir, 0.01))
+
+    @unittest.skipIf(watch_pki._LIBC is None, 'inotify is not available')
+    def test_inotify(self):
+        """inotify reports files, and new directories as trees."""
+        self.check_watcher(watch_pki.InotifyWatcher(self.tmpdir))
+
+        watcher = watch_pki.make_watcher(self.tmpdir)
+        try:
+            self.assertEqual(watcher.method, 'inotify')
+            subdir = os.path.join(self.tmpdir, 'renewed')
+            os.mkdir(subdir)
+            self.assertEqual(watcher.poll(5), set([subdir + os.sep]))
+            write(os.path.join(subdir, 'rod.p12'))
+            self.assertEqual(watcher.poll(5),
+                             set([os.path.join(subdir, 'rod.p12')]))
+        finally:
+            watcher.close()
+
+    def test_debounce(self):
+        """A burst is gathered until it settles, or for at most maxdelay."""
+        clock = Clock()
+        watcher = ScriptedWatcher(clock, [['a'], ['b'], ['a', 'c'], [],
+                                          ['d']])
+        self.assertEqual(watch_pki.debounce(watcher, 2, 30, clock=clock),
+                         set(['a', 'b', 'c']))
+        self.assertEqual(watcher.timeouts, [None, 2, 2, 2])
+        self.assertEqual(watch_pki.debounce(watcher, 2, 30, 5, clock),
+                         set(['d']))
+        self.assertEqual(watch_pki.debounce(watcher, 2, 30, 5, clock),
+                         set())
+
+        watcher = ScriptedWatcher(clock, [['a']] * 10)
+        self.assertEqual(watch_pki.debounce(watcher, 2, 3, clock=clock),
+                         set(['a']))
+        self.assertEqual(len(watcher.timeouts), 4)
+
+
+class PkiWatchTest(unittest.TestCase):
+    """Test only users whose components changed are re-provisioned."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pkidir = os.path.join(self.tmpdir, 'pki')
+        self.outdir = os.path.join(self.tmpdir, 'out')
+        shutil.copytree(PKIDATA, self.pkidir)
+        self.records = [make_record({'user': u, 'masterpass': 'pass'},
+                                    self.pkidir) for u in ('rod', 'jane')]
+        self.session = self.index = None
+        self.out = StringIO()
+        self.report = BatchReport(self.out)
+
+    def tearDown(self):
+        if self.session is not None:
+            self.session.close()
+        if self.index is not None:
+            self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, index=False):
+        if index:
+            self.index = PkiIndex(self.pkidir,
+                                  index_path(self.pkidir, self.tmpdir),
+                                  ['password'])
+            self.index.update()
+        self.session = ProvisionSession(backend=MemoryBackend(),
+                                        pkiindex=self.index).start()
+        self.session.provision('rod', 'pass', self.pkidir,
+                               os.path.join(self.outdir, 'rod'))
+        return watch_pki.PkiWatch(self.session, self.records, self.outdir)
+
+    def bundle_path(self):
+        self.session.switch_db(os.path.join(self.outdir, 'rod'))
+        self.assertTrue(self.session.authm.setMasterPassword('pass', True))
+        try:
+            configs = load_configs(self.session)
+        finally:
+            self.session.authm.clearMasterPassword()
+        self.assertEqual(len(configs), 1)
+        return configs.values()[0][1].bundlePath()
+
+    def test_affected(self):
+        """Users are affected by their own files, or trees holding them."""
+        watch = self.start()
+        path = os.path.join(self.pkidir, 'rod.p12')
+        self.assertEqual(watch.affected([path]), set(['rod']))
+        self.assertEqual(watch.affected([os.path.join(self.pkidir, 'ca.pem')]),
+                         set(['rod', 'jane']))
+        self.assertEqual(
+            watch.affected([os.path.join(self.pkidir, 'server_cert.pem')]),
+            set())
+        self.assertEqual(watch.affected([self.pkidir + os.sep]),
+                         set(['rod', 'jane']))
+
+        self.assertEqual(watch.handle([path], self.report), 1)
+        self.assertEqual(self.report.done, 1)
+        self.assertIn('1 paths changed, 1 users affected', self.out.getvalue())
+        self.assertIn(authstore.UNCHANGED, self.out.getvalue())
+
+    def test_renewed_file(self):
+        """With an index, a renewal under a new name updates the config."""
+        os.rename(os.path.join(self.pkidir, 'rod.p12'),
+                  os.path.join(self.pkidir, 'rod_2014.p12'))
+        watch = self.start(index=True)
+        self.assertEqual(self.bundle_path(),
+                         os.path.join(self.pkidir, 'rod_2014.p12'))
+
+        renewed = os.path.join(self.pkidir, 'rod.p12')
+        shutil.copy(os.path.join(PKIDATA, 'rod.p12'), renewed)
+        self.assertEqual(watch.affected([renewed]), set(['rod']))
+        self.assertEqual(watch.byfile.get(renewed), None)
+
+        result = watch.reprovision('rod')
+        self.assertTrue(result['ok'])
+        self.assertEqual(result['action'], authstore.UPDATED)
+        self.assertEqual(self.bundle_path(), renewed)
+        self.assertEqual(watch.byfile[renewed], set(['rod']))
+        # The same files again: nothing is re-parsed, nobody is affected
+        self.assertEqual(watch.affected([renewed]), set(['rod']))
+        self.assertEqual(
+            watch.affected([os.path.join(self.pkidir, 'server_cert.pem')]),
+            set())
+
+    def test_failures(self):
+        """A user whose components fail pre-flight is left as they are."""
+        watch = self.start()
+        watch.checkfirst = True
+        result = watch.reprovision('jane')
+        self.assertFalse(result['ok'])
+        self.assertTrue(result['error'].startswith('Pre-flight'))
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, 'jane')))
+
+    def test_provision_error(self):
+        """Any error re-provisioning a user fails them, not the watch."""
+        def corrupt(*args):
+            raise sqlite3.DatabaseError('file is not a database')
+
+        watch = self.start()
+        self.session.provision = corrupt
+        result = watch.reprovision('rod')
+        self.assertEqual((result['ok'], result['error']),
+                         (False, 'file is not a database'))
+
+    def test_watched(self):
+        """Users are only tracked if their PKI directory is watched."""
+        self.assertTrue(watch_pki.is_watched(self.pkidir, self.pkidir))
+        self.assertTrue(watch_pki.is_watched(
+            os.path.join(self.pkidir, 'renewed'), self.pkidir + os.sep))
+        self.assertFalse(watch_pki.is_watched(self.pkidir + '2', self.pkidir))
+        self.assertFalse(watch_pki.is_watched(PKIDATA, self.pkidir))
+
+
+if __name__ == '__main__':
+    unittest.main()
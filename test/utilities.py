@@ -1,11 +1,15 @@
 # coding=utf-8
 """Common functionality used by regression tests."""
 
+import os
 import sys
 import logging
 
 
 LOGGER = logging.getLogger('QGIS')
+# Directory of the auth_system scripts and their sibling modules
+AUTH_SYSTEM_DIR = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), os.pardir, 'auth_system'))
 QGIS_APP = None  # Static variable used to hold hand to running QGIS app
 CANVAS = None
 PARENT = None
@@ -59,3 +63,13 @@ def get_qgis_app():
         IFACE = QgisInterface(CANVAS)
 
     return QGIS_APP, CANVAS, IFACE, PARENT
+
+
+class Clock(object):
+    """Fake time.time(), advanced by adding to `now`."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now